@@ -1,4 +1,6 @@
 from machine import SoftI2C,Pin
+import micropython
+import struct
 import time
 
 class VEML7700:
@@ -16,6 +18,11 @@ class VEML7700:
     >>> als.set_
 
     1.参数设置，所有可以设置的参数共有11个,包括config寄存器的设置,psm寄存器的设置,wh和wl寄存器的设置。参数可以在创建对象时,设置寄存器时,或者之后独立设置。未设置参数保持默认。
+    2.寄存器读写改为16位小端整数运算，读使用readfrom_mem_into写入预分配缓冲区，写使用struct.pack_into，
+    不再经过hex字符串和二进制字符串；read_als,read_white,read_als_white直接返回16位计数值
+    3.read_lux返回照度，按上一次读数自动选择增益和积分时间，低增益时做非线性修正
+    4.set_wl误写到ALS_WH，已修正；plan_refresh按需要的采样周期和分辨率选择省电模式，返回实际刷新时间和估计电流
+    5.enable_events开启阈值中断模式，只有光照越过窗口才回调，之后自动重设窗口，代替轮询
     '''
     # 设备地址和读写模式设置命令
     Device_ADDR = 0x10
@@ -48,72 +55,91 @@ class VEML7700:
                         "2200ms":22,"4200ms":42,'900ms': 9, '1400ms': 14, '2400ms': 24,
                           '4400ms': 44, '1300ms': 13, '1800ms': 18, '2800ms': 28, 
                           '4800ms': 48}
+    # 增益倍数和积分时间(ms)，键为寄存器取值
+    GAIN_VALUE = {0b00:1,0b01:2,0b10:0.125,0b11:0.25}
+    IT_MS = {0b1100:25,0b1000:50,0b0000:100,0b0001:200,0b0010:400,0b0011:800}
+    # 自动量程档位，从最不灵敏到最灵敏。增益不增加测量时间，所以先在25ms下提高增益，再延长积分时间
+    AUTO_RANGES = (('1/8x','25ms'),('1/4x','25ms'),('1x','25ms'),('2x','25ms'),('2x','50ms'),
+                   ('2x','100ms'),('2x','200ms'),('2x','400ms'),('2x','800ms'))
+    AUTO_LOW = 100     # 计数低于此值精度不够，换更灵敏的档位
+    AUTO_SAT = 65000   # 计数高于此值视为饱和，当次读数无效
+    RANGE_TABLE = () # (gain,it,it_ms,lx/count)，由_range_table在类定义后生成
+    # 省电模式下的平均电流(uA)，键为(psm,ALS_IT)，取自数据手册典型值
+    PSM_CURRENT_UA = {(0,0b0000):8,(1,0b0000):5,(2,0b0000):3,(3,0b0000):2,
+                      (0,0b0001):13,(1,0b0001):8,(2,0b0001):5,(3,0b0001):3,
+                      (0,0b0010):20,(1,0b0010):13,(2,0b0010):8,(3,0b0010):5,
+                      (0,0b0011):28,(1,0b0011):20,(2,0b0011):13,(3,0b0011):8}
 
 
+    # config寄存器各字段的(位移,掩码)，对应bit 12:11,9:6,5:4,1,0
+    CONF_FIELDS = ((11,0b11),(6,0b1111),(4,0b11),(1,0b1),(0,0b1))
+
     def __init__(self,i2c):
         self.i2c = i2c
+        # 预分配的读写缓冲区，ALS和WHITE各占2字节，寄存器均为小端16位
+        self._rbuf = bytearray(4)
+        self._rmv = memoryview(self._rbuf)
+        self._rmv_als = self._rmv[0:2]
+        self._rmv_white = self._rmv[2:4]
+        self._wbuf = bytearray(2)
+        # 已写入的config和psm寄存器，set_config中为None的字段保持原值
+        self.config = 0
+        self.psm = 0
+        # 自动量程状态
+        self.range_index = None
+        self.range_ready = None # 换档后第一次完整积分结束的ticks_ms，之前的读数仍属于旧档位
+        self.lux = None
+        self.plan = None
+        # 阈值中断模式
+        self.int_pin = None
+        self.event_callback = None
+        self.event_flag = None
+        self.last_event = None
+        self.events = 0
+        self.events_missed = 0
+
+    @staticmethod
+    def _field(value):
+        '''参数既可以是int，也可以是二进制字符串如'01' '''
+        if isinstance(value,str):
+            return int(value,2)
+        return value
+
+    def write_register(self,register_addr,word):
+        '''写一个16位寄存器'''
+        struct.pack_into('<H',self._wbuf,0,word & 0xFFFF)
+        return self.i2c.writeto_mem(VEML7700.Device_ADDR,register_addr,self._wbuf)
+
+    def read_register(self,register_addr):
+        '''读一个16位寄存器，返回int'''
+        self.i2c.readfrom_mem_into(VEML7700.Device_ADDR,register_addr,self._rmv_als)
+        return self._rbuf[0] | self._rbuf[1]<<8
+
     def communicate_with_register(self,register_addr,*args):
-        args = list(args)
         if register_addr == 0x00: # 配置寄存器
-            
-            '''bit对应12:11,9:6,5:4,1,0'''
-            for i,f in zip(range(0,len(args)),[2,4,2,1,0]):
-                if isinstance(args[i],str):
-                    pass
-                if isinstance(args[i],int):
-                    args[i] = f"{args[i]:b}"[-f:]
-            ALS_GAIN,ALS_IT,ALS_PERS,ALS_INT_EN,ALS_SD = args
-            bytenumber = '000'+ALS_GAIN+'0'+ALS_IT+ALS_PERS+'00'+ALS_INT_EN+ALS_SD
-            buf = bytearray([int(bytenumber,2)])
-            return self.i2c.writeto_mem(VEML7700.Device_ADDR,register_addr,buf)
-        elif register_addr == 0x01:#15:8 MSB高阈值窗口设置 7:0 LSB高阈值窗口设置
-            for i,f in zip(range(0,len(args)),[8,8]):
-                if isinstance(args[i],str):
-                    pass
-                elif isinstance(args[i],int):
-                    args[i] = f"{args[i]:b}"[-f:]
-                else:
-                    raise TypeError("not implement")
-            MSB_HIGH_WINDOW,LSB_HIGH_WINDOW = args
-            bytenumber = MSB_HIGH_WINDOW+LSB_HIGH_WINDOW
-            buf = bytearray([int(bytenumber,2)])
-            return self.i2c.writeto_mem(VEML7700.Device_ADDR,register_addr,buf)
-        elif register_addr == 0x02:
-            for i,f in zip(range(0,len(args)),[8,8]):
-                if isinstance(args[i],str):
-                    pass
-                elif isinstance(args[i],int):
-                    args[i] = f"{args[i]:b}"[-f:]
-                else:
-                    raise TypeError("not implement")
-            MSB_LOW_WINDOW,LSB_LOW_WINDOW = args
-            bytenumber = MSB_LOW_WINDOW+LSB_LOW_WINDOW
-            buf = bytearray([int(bytenumber,2)])
-            return self.i2c.writeto_mem(VEML7700.Device_ADDR,register_addr,buf)
+            word = self.config
+            for value,(shift,mask) in zip(args,VEML7700.CONF_FIELDS):
+                if value is None:
+                    continue
+                word = (word & ~(mask<<shift)) | (VEML7700._field(value) & mask)<<shift
+            self.config = word
+            return self.write_register(register_addr,word)
+        elif register_addr == 0x01 or register_addr == 0x02:#15:8 MSB阈值窗口设置 7:0 LSB阈值窗口设置
+            msb,lsb = args
+            word = (VEML7700._field(msb) & 0xFF)<<8 | (VEML7700._field(lsb) & 0xFF)
+            return self.write_register(register_addr,word)
         elif register_addr == 0x03:#15:3 保留 2:1 模式设置 0 开启或关闭
-            for i,f in zip(range(0,len(args)),[2,1]):
-                if isinstance(args[i],str):
-                    pass
-                elif isinstance(args[i],int):
-                    args[i] = f"{args[i]:b}"[-f:]
-                else:
-                    raise TypeError("not implement")
-            PSM,PSM_EN = args
-            bytenumber = '0'*13+PSM+PSM_EN
-            buf = bytearray([int(bytenumber,2)])
-            return self.i2c.writeto_mem(VEML7700.Device_ADDR,register_addr,buf)
+            psm,psm_en = args
+            word = (VEML7700._field(psm) & 0b11)<<1 | (VEML7700._field(psm_en) & 0b1)
+            self.psm = word
+            return self.write_register(register_addr,word)
         #读数据
-        elif register_addr == 0x04:
-            buf = self.i2c.readfrom_mem(VEML7700.Device_ADDR,register_addr,2).hex()
-            ALS_OUT_MSB,ALS_OUT_LSB = int(buf[0:2],16),int(buf[-2:],16)
-            return ALS_OUT_MSB,ALS_OUT_LSB
-        elif register_addr == 0x05:
-            buf = self.i2c.readfrom_mem(VEML7700.Device_ADDR,register_addr,2).hex()
-            WHITE_OUT_MSB,WHITE_OUT_LSB = int(buf[0:2],16),int(buf[-2:],16)
-            return WHITE_OUT_MSB,WHITE_OUT_LSB
+        elif register_addr == 0x04 or register_addr == 0x05:
+            word = self.read_register(register_addr)
+            return word>>8,word & 0xFF # MSB,LSB
         elif register_addr == 0x06:# 15 低阈值溢出，14高阈值溢出，13:0 保留
-            buf = f'{int(self.i2c.readfrom_mem(VEML7700.Device_ADDR,register_addr,2).hex(),16):b}'[:2]
-            int_th_low ,int_th_high = int(buf[0],2),int(buf[1],2)
+            word = self.read_register(register_addr)
+            int_th_low ,int_th_high = word>>15 & 1,word>>14 & 1
             return int_th_low,int_th_high
         else:
             raise Exception(f"no register address is {register_addr}")
@@ -123,7 +149,7 @@ class VEML7700:
     def set_wh(self,msb_wh,lsb_wh):
         return self.communicate_with_register(VEML7700.ALS_WH,msb_wh,lsb_wh)
     def set_wl(self,msb_wl,lsb_wl):
-        return self.communicate_with_register(VEML7700.ALS_WH,msb_wl,lsb_wl)
+        return self.communicate_with_register(VEML7700.ALS_WL,msb_wl,lsb_wl)
     def set_psm(self,psm,psm_en):
         return self.communicate_with_register(VEML7700.ALS_PSM,psm,psm_en)
     def read_als_out(self):
@@ -132,6 +158,85 @@ class VEML7700:
         return self.communicate_with_register(register_addr=VEML7700.WHITE)
     def read_ALS_INT(self):
         return self.communicate_with_register(register_addr=VEML7700.ALS_INT)
+    def read_als(self):
+        '''ALS输出的16位计数值'''
+        return self.read_register(VEML7700.ALS)
+    def read_white(self):
+        '''WHITE输出的16位计数值'''
+        return self.read_register(VEML7700.WHITE)
+    def read_als_white(self):
+        '''依次读取ALS和WHITE到同一个预分配缓冲区，返回(als,white)。命令码0x04和0x05虽然相邻，
+        但器件每个命令码只对应一个16位字，不会跨命令码自动递增，连续读4个字节得不到WHITE，所以需要两次事务'''
+        self.i2c.readfrom_mem_into(VEML7700.Device_ADDR,VEML7700.ALS,self._rmv_als)
+        self.i2c.readfrom_mem_into(VEML7700.Device_ADDR,VEML7700.WHITE,self._rmv_white)
+        buf = self._rbuf
+        return buf[0] | buf[1]<<8,buf[2] | buf[3]<<8
+
+    def set_range(self,index,wait = True):
+        '''切换到RANGE_TABLE[index]的增益和积分时间。旧的一次积分和新的一次积分都完成后读数才属于新档位，
+        wait为True时在这里等待，否则只记下时刻，由下一次read_lux等待剩余的时间'''
+        gain,it,it_ms,res = VEML7700.RANGE_TABLE[index]
+        old_ms = VEML7700.IT_MS.get(self.config>>6 & 0b1111,0)
+        self.set_config(ALS_GAIN = gain,ALS_IT = it)
+        self.range_index = index
+        self.range_ready = time.ticks_add(time.ticks_ms(),old_ms+it_ms+5)
+        if wait:
+            self.wait_range()
+
+    def wait_range(self):
+        '''等到上一次换档后的第一次完整积分结束'''
+        if self.range_ready is None:
+            return
+        remain = time.ticks_diff(self.range_ready,time.ticks_ms())
+        if remain > 0:
+            time.sleep_ms(remain)
+        self.range_ready = None
+
+    def _pick_range(self,counts):
+        '''根据本次计数估计照度，选出计数不低于AUTO_LOW的最快档位'''
+        table = VEML7700.RANGE_TABLE
+        index = self.range_index
+        if counts >= VEML7700.AUTO_SAT:
+            return 0
+        lux = counts*table[index][3]
+        for i in range(len(table)):
+            if lux >= VEML7700.AUTO_LOW*table[i][3]:
+                if i < index and lux < 2*VEML7700.AUTO_LOW*table[i][3]:#回差，避免在相邻档位间来回切换
+                    return i+1
+                return i
+        return len(table)-1
+
+    @staticmethod
+    def correct_lux(lux):
+        '''低增益(1/4x,1/8x)时的非线性修正，系数来自Vishay应用笔记'''
+        return (((6.0135e-13*lux-9.3924e-9)*lux+8.1488e-5)*lux+1.0023)*lux
+
+    def read_lux(self,auto = True):
+        '''返回照度(lx)。auto为True时根据上一次的读数自动选择增益和积分时间：
+        读数有效时直接返回，并为下一次换到更合适的档位；读数饱和或过小时立即换档重测。
+        上一次换档后新档位的积分还没完成时，先等待剩余的时间，不会读到旧档位的计数'''
+        table = VEML7700.RANGE_TABLE
+        if self.range_index is None:
+            self.set_range(0)
+        self.wait_range()
+        for _ in range(len(table)):
+            counts = self.read_als()
+            index = self.range_index
+            if not auto:
+                break
+            target = self._pick_range(counts)
+            valid = counts < VEML7700.AUTO_SAT and (counts >= VEML7700.AUTO_LOW or target <= index)
+            if valid:
+                if target != index:
+                    self.set_range(target,False)
+                break
+            self.set_range(target)
+        gain,it,it_ms,res = table[index]
+        lux = counts*res
+        if VEML7700.GAIN_VALUE[gain] < 1:
+            lux = VEML7700.correct_lux(lux)
+        self.lux = lux
+        return lux
     '''def setArgs(self,**kwargs):
         config_flag,wh_flag,wl_flag,psm_flag = False,False,False,False
         for key in kwargs.keys():
@@ -152,14 +257,127 @@ class VEML7700:
         if wl_flag: self.set_wl(**self.config)
         if psm_flag: self.set_psm(**self.config)
         return True'''
-    '''def set_refresh_time(self,refresh_time):
-        # 若未处于省电状态，报错
-        #2**config_ALS_IT+5*2**PSM = refresh_time
-        t = [(0, 0, 6), (1, 0, 7), (2, 0, 9), (3, 0, 13), (0, 1, 11), (1, 1, 12), (2, 1, 14), (3, 1, 18), (0, 2, 21), (1, 2, 22), (2, 2, 24), (3, 2, 28), (0, 3, 41), (1, 3, 42), (2, 3, 44), (3, 3, 48)]
-        for i in t:
-            if refresh_time == i[2]:
-                return self.setArgs(psm_PSM = i[0],config_ALS_IT = i[1])
-        raise Exception(f"no refresh_time like {refresh_time}")'''
+    def set_refresh_time(self,refresh_time):
+        '''按刷新时间设置省电模式，refresh_time为psm_refresh_time的键如'600ms'，或者毫秒数'''
+        if isinstance(refresh_time,str):
+            refresh_time = VEML7700.psm_refresh_time[refresh_time]*100
+        for refresh_ms,res,current,psm,it in VEML7700.psm_plans():
+            if refresh_ms == refresh_time:
+                return self.apply_plan(psm,it)
+        raise ValueError(f"no refresh_time like {refresh_time}")
+
+    @staticmethod
+    def psm_plans():
+        '''列出全部省电模式组合(refresh_ms,lx/count,uA,psm,it)，增益固定为2x'''
+        plans = []
+        for key,it in VEML7700.config_resolution.items():
+            it_ms = VEML7700.IT_MS[it]
+            for psm in range(4):
+                #2**config_ALS_IT+5*2**PSM = refresh_time
+                refresh_ms = it_ms+500*(1<<psm)
+                plans.append((refresh_ms,float(key[:-2]),VEML7700.PSM_CURRENT_UA[(psm,it)],psm,it))
+        return plans
+
+    def plan_refresh(self,period_ms,resolution = None,wh = None,wl = None):
+        '''选出刷新时间不超过period_ms、分辨率(lx/count)不低于resolution的组合中电流最小的一个并写入，
+        wh,wl为16位阈值窗口，不传则不修改，返回实际的刷新时间、分辨率和估计电流'''
+        best = None
+        for plan in VEML7700.psm_plans():
+            refresh_ms,res,current = plan[:3]
+            if refresh_ms > period_ms or (resolution is not None and res > resolution):
+                continue
+            if best is None or (current,res) < (best[2],best[1]):
+                best = plan
+        if best is None:
+            raise ValueError(f"no psm plan for period {period_ms}ms, resolution {resolution}")
+        return self.apply_plan(best[3],best[4],wh,wl)
+
+    def apply_plan(self,psm,it,wh = None,wl = None):
+        '''在关断状态下一次性写入config,阈值窗口和psm，再开启测量'''
+        self.set_config(ALS_SD = VEML7700.config_ALS_SD['als_down'])
+        if wh is not None:
+            self.write_register(VEML7700.ALS_WH,wh)
+        if wl is not None:
+            self.write_register(VEML7700.ALS_WL,wl)
+        self.set_psm(psm,VEML7700.psm_PSM_EN['psm_enable'])
+        gain = VEML7700.config_ALS_GAIN['2x']
+        self.set_config(ALS_GAIN = gain,ALS_IT = it,ALS_SD = VEML7700.config_ALS_SD['als_on'])
+        #read_lux按计划的档位换算，不会先退回RANGE_TABLE[0]
+        self.range_index = [i for i,r in enumerate(VEML7700.RANGE_TABLE) if r[0] == gain and r[1] == it][0]
+        it_ms = VEML7700.IT_MS[it]
+        res = [float(key[:-2]) for key,value in VEML7700.config_resolution.items() if value == it][0]
+        self.plan = {'refresh_ms':it_ms+500*(1<<psm),'resolution':res,
+                     'current_ua':VEML7700.PSM_CURRENT_UA[(psm,it)],'psm':psm,'it':it}
+        return self.plan
+
+    def enable_events(self,int_pin,callback = None,window = 0.1,min_span = 10,pers = 'protect_2'):
+        '''阈值中断模式：以当前读数为中心设置回差窗口(相对宽度window，至少min_span个计数)并打开ALS_INT_EN，
+        光照越过窗口时INT引脚拉低，在主线程中调用callback(counts,int_th_low,int_th_high)并重新设置窗口。
+        也可以在协程中await wait_event()'''
+        self.event_callback = callback
+        self.event_window = window
+        self.event_min_span = min_span
+        self._event_ref = self._on_event#预先绑定，避免在中断里分配内存
+        try:
+            import asyncio
+        except ImportError:
+            import uasyncio as asyncio
+        self.event_flag = asyncio.ThreadSafeFlag()
+        self.arm_window(self.read_als())
+        self.set_config(ALS_PERS = VEML7700.config_ALS_PERS[pers],ALS_INT_EN = VEML7700.config_ALS_INT_EN['int_enable'])
+        self.read_ALS_INT()#清除之前的中断状态
+        self.int_pin = Pin(int_pin,Pin.IN,Pin.PULL_UP)#INT为开漏输出，低电平有效
+        self.int_pin.irq(trigger = Pin.IRQ_FALLING,handler = self._irq)
+
+    def disable_events(self):
+        if self.int_pin:
+            self.int_pin.irq(handler = None)
+            self.int_pin = None
+        self.set_config(ALS_INT_EN = VEML7700.config_ALS_INT_EN['int_disable'])
+
+    def arm_window(self,counts):
+        '''以counts为中心写入WH和WL'''
+        span = max(int(counts*self.event_window),self.event_min_span)
+        self.write_register(VEML7700.ALS_WH,min(counts+span,0xFFFF))
+        self.write_register(VEML7700.ALS_WL,max(counts-span,0))
+
+    def _irq(self,pin):
+        try:
+            micropython.schedule(self._event_ref,0)
+        except RuntimeError:#调度队列已满
+            self.events_missed += 1
+
+    def _on_event(self,_):
+        int_th_low,int_th_high = self.read_ALS_INT()#读取同时清除中断
+        counts = self.read_als()
+        self.arm_window(counts)
+        self.events += 1
+        self.last_event = (counts,int_th_low,int_th_high)
+        if self.event_callback:
+            self.event_callback(counts,int_th_low,int_th_high)
+        self.event_flag.set()
+
+    async def wait_event(self):
+        '''等待下一次越过窗口，返回(counts,int_th_low,int_th_high)'''
+        await self.event_flag.wait()
+        return self.last_event
+
+
+def _range_table():
+    '''由config_resolution(2x增益下各积分时间的分辨率)推算AUTO_RANGES各档位的分辨率，
+    分辨率与增益和积分时间成反比，25ms和50ms由100ms外推'''
+    res_2x = {}
+    for key,it in VEML7700.config_resolution.items():
+        res_2x[VEML7700.IT_MS[it]] = float(key[:-2])
+    table = []
+    for gain_key,it_key in VEML7700.AUTO_RANGES:
+        gain,it = VEML7700.config_ALS_GAIN[gain_key],VEML7700.config_ALS_IT[it_key]
+        it_ms = VEML7700.IT_MS[it]
+        res = res_2x[it_ms] if it_ms in res_2x else res_2x[100]*100/it_ms
+        table.append((gain,it,it_ms,res*2/VEML7700.GAIN_VALUE[gain]))
+    return tuple(table)
+
+VEML7700.RANGE_TABLE = _range_table()
 
 if __name__ == '__main__':
     #参数设置
@@ -1,4 +1,38 @@
-from _device.xgzp import XGZP
-from _device.ble import BaseBLESever,BLESever,IRQ,FLAG
-from _device.netConnect import wlan_do_connected,wlan_must_connected,wlan_wait_connected,wlan_AP_open
-from _device.socket_client import UDPClient,TCPClient
\ No newline at end of file
+'''按需导入：import _device只加载VEML7700，第一次访问_device.XGZP等名字时才导入对应的模块，
+只用XGZP的脚本不会引入bluetooth,network,socket，主机(CPython)上也可以直接使用wire,delta等纯Python模块
+
+VEML7700与子模块同名：先执行import _device.VEML7700时，导入系统把子模块设为包的属性，
+之后from _device import VEML7700得到的是模块而不是类，__getattr__也不会再被调用。
+所以这个类在这里直接导入，子模块已在sys.modules中，之后的导入不会再覆盖它
+
+    >>> from _device import XGZP#只加载_device.xgzp
+
+各模块的导入耗时和内存见tools/import_profile.py
+'''
+_LAZY = {
+    'XGZP':'xgzp','RetryPolicy':'xgzp','I2CReadError':'xgzp',
+    'convert_frames':'xgzp_convert',
+    'RingBuffer':'ringbuf',
+    'FlashLog':'flashlog',
+    'Sampler':'scheduler',
+    'FrameEncoder':'wire','decode_frame':'wire',
+    'BaseBLESever':'ble','BLESever':'ble','IRQ':'ble','FLAG':'ble',
+    'wlan_do_connected':'netConnect','wlan_must_connected':'netConnect','wlan_wait_connected':'netConnect',
+    'wlan_AP_open':'netConnect','wlan_fast_connect':'netConnect','wlan_connect_stats':'netConnect','WLANManager':'netConnect',
+    'get_logger':'log','set_level':'log','dump':'log',
+    'UDPClient':'socket_client','TCPClient':'socket_client','AsyncTCPClient':'socket_client',
+}
+
+try:
+    from .VEML7700 import VEML7700
+except ImportError:#主机(CPython)上没有machine
+    pass
+
+
+def __getattr__(name):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(name)
+    value = getattr(__import__('_device.'+module,None,None,[name]),name)
+    globals()[name] = value#之后直接命中，不再经过__getattr__
+    return value
@@ -1,6 +1,13 @@
 '''此模块实现了蓝牙的基础配置，包含了一些常量IRQ，特性值FLAG和一个BLESever类用于配置控制传感器的类'''
 import bluetooth
+import micropython
+import struct
+import time
 from machine import Pin,Timer
+from _device.log import get_logger
+from _device.ringbuf import RECORD_FMT,RECORD_SIZE,CH_PRESSURE,CH_TEMPERATURE
+
+_log = get_logger('ble')
 
 
 class IRQ:
@@ -54,15 +61,50 @@ class FLAG:
 
 class BaseBLESever:
     '''BleSever的基类,BaseBleSever(name,servicer,ble_irq)
+
+    支持多个中心设备同时连接，max_connections为最多连接数，未满时保持广播。
+    self.connections记录每个连接协商的参数{'interval_ms','latency','timeout_ms','mtu'}，
+    自定义ble_irq时可以先调用self.handle_conn_event(event,data)维护连接状态。
+    set_conn_profile(fast)切换广播中的首选连接间隔(AD类型0x12)，中心设备在建立连接时采用；
+    MicroPython没有外设端主动更新连接参数的接口，已建立的连接不受影响。
+    广播数据最多31字节，名称较长放不下0x12时它改放在扫描响应(resp_data)中，名称本身超过26字节时截断为短名称(AD类型0x08)
+
+    L2CAP批量传输:
+
+    ble.l2cap_listen(rb)#rb为RingBuffer，不会被消耗
+
+    中心设备连接PSM 0x80的面向连接信道后，发送4字节小端uint32起始序号(0xFFFFFFFF表示从最旧的开始)，
+    外设按SDU连续发送记录：头部uint32 第一条记录的序号+uint16 记录数，之后每条记录为RECORD_FMT。
+    发完缓冲区中已有的记录后发送一个记录数为0的SDU表示结束。断线重连后发送上次收到的最后序号+1即可续传，
+    头部序号大于请求序号说明中间的记录已被覆盖。流控依据l2cap_send的返回值和IRQ_L2CAP_SEND_READY
+
+    ble.l2cap_listen(rb,delta = DeltaEncoder({CH_PRESSURE:1,CH_TEMPERATURE:2}))
+
+    压缩模式下SDU头部为L2CAP_DELTA_HEADER，多一个uint32 base_ticks，记录部分为_device.delta的编码，
+    主机端用delta.decode(sdu,10,len(sdu),base_ticks)解码。每个SDU的记录数按上一次的压缩率自适应调整
+
+    ble.l2cap_listen(rb,log = log)#log为FlashLog
+
+    中心设备发送起始序号0xFFFFFFFE时改为发送FlashLog中积压的记录，格式与上面相同，头部序号为日志的已提交记录数，
+    每个SDU交给协议栈后即提交，发完后发送记录数为0的SDU并保存读指针
     '''
+    L2CAP_PSM = 0x80
+    L2CAP_HEADER = '<IH'
+    L2CAP_DELTA_HEADER = '<IHI'
+    L2CAP_LOG = -2 # 请求序号0xFFFFFFFE，发送FlashLog
+    # 首选连接间隔(单位1.25ms)：推送数据时7.5~15ms，空闲时100~200ms
+    FAST_INTERVAL = (6,12)
+    SLOW_INTERVAL = (80,160)
+    ADV_MAX = 31 # 传统广播数据和扫描响应的字节数上限
 
-    def __init__(self,name,servicer = None,ble_irq = None,led_pin = 2):
+    def __init__(self,name,servicer = None,ble_irq = None,led_pin = 2,max_connections = 1):
         self.name = bytes(name,'utf-8')
         self.servicer = servicer
         #
         self.ble = bluetooth.BLE()
         self.timer = Timer(0)
         self.led = Pin(led_pin,Pin.OUT)
+        self._init_connections(max_connections)
         #
         self.ble.active(True)
         self.ble.config(gap_name = name)
@@ -72,24 +114,238 @@ class BaseBLESever:
         self.ble.irq(self.irq)#蓝牙中断函数挂载
            
         self.advertise()# 开始广播
-        
+
+    def _init_connections(self,max_connections):
+        self.max_connections = max_connections
+        self.connections = {}#conn_handle -> 连接参数
+        self.conn_interval = BaseBLESever.SLOW_INTERVAL
+        self.adv_interval_us = 100
+        self.adv_resp_data = None
+        self.l2cap_source = None
+        self.l2cap_chan = None#(conn_handle,cid)
+
+    def l2cap_listen(self,source,psm = L2CAP_PSM,mtu = 512,delta = None,log = None):
+        '''在psm上监听L2CAP面向连接信道，source为RingBuffer，delta为DeltaEncoder时压缩发送，log为FlashLog'''
+        self.l2cap_source = source
+        self.l2cap_delta = delta
+        self.l2cap_log = log
+        if delta is not None:
+            #压缩后的长度事先未知，先编码到足够大的暂存区，放得进SDU再发送
+            self.l2cap_delta_max = mtu//2
+            self.l2cap_delta_n = mtu//RECORD_SIZE
+            self.l2cap_scratch = bytearray(struct.calcsize(BaseBLESever.L2CAP_DELTA_HEADER)+delta.max_size(self.l2cap_delta_max))
+            self.l2cap_scratch_mv = memoryview(self.l2cap_scratch)
+        self.l2cap_psm = psm
+        self.l2cap_mtu = mtu
+        self.l2cap_chan = None
+        self.l2cap_seq = None
+        self.l2cap_stalled = False
+        self.l2cap_sdu = bytearray(mtu)
+        self.l2cap_mv = memoryview(self.l2cap_sdu)
+        self.l2cap_sdu_size = mtu
+        self.l2cap_rx = bytearray(mtu)#中心设备发来的SDU不超过我方MTU
+        self.l2cap_sent = 0
+        self._l2cap_pump_ref = self._l2cap_pump
+        self.ble.l2cap_listen(psm,mtu)
+
+    def handle_l2cap_event(self,event,data):
+        '''处理L2CAP事件，IRQ_L2CAP_ACCEPT时返回非0表示拒绝'''
+        if event == IRQ.IRQ_L2CAP_ACCEPT:
+            conn_handle,cid,psm,our_mtu,peer_mtu = data
+            if self.l2cap_source is None or psm != self.l2cap_psm or self.l2cap_chan is not None:
+                return 1
+            return 0
+        elif event == IRQ.IRQ_L2CAP_CONNECT:
+            conn_handle,cid,psm,our_mtu,peer_mtu = data
+            self.l2cap_chan = (conn_handle,cid)
+            self.l2cap_sdu_size = min(our_mtu,peer_mtu,self.l2cap_mtu)
+            self.l2cap_seq = None
+            self.l2cap_stalled = False
+        elif event == IRQ.IRQ_L2CAP_DISCONNECT:
+            if self.l2cap_chan and self.l2cap_chan[0] == data[0] and self.l2cap_chan[1] == data[1]:
+                self.l2cap_chan = None
+                self.l2cap_seq = None
+        elif event == IRQ.IRQ_L2CAP_RECV:
+            conn_handle,cid = data[0],data[1]
+            n = self.ble.l2cap_recvinto(conn_handle,cid,self.l2cap_rx)
+            if n and n >= 4:
+                seq = struct.unpack_from('<I',self.l2cap_rx,0)[0]
+                if seq == 0xFFFFFFFE and self.l2cap_log is not None:
+                    self.l2cap_seq = BaseBLESever.L2CAP_LOG
+                else:
+                    self.l2cap_seq = -1 if seq == 0xFFFFFFFF else seq
+                self._l2cap_schedule()
+            while n:#读完本次收到的数据，留在协议栈中的字节会占住接收窗口
+                n = self.ble.l2cap_recvinto(conn_handle,cid,self.l2cap_rx)
+        elif event == IRQ.IRQ_L2CAP_SEND_READY:
+            self.l2cap_stalled = False
+            self._l2cap_schedule()
+        return None
+
+    def _l2cap_schedule(self):
+        try:
+            micropython.schedule(self._l2cap_pump_ref,0)
+        except RuntimeError:#调度队列已满，等下一次SEND_READY或请求
+            pass
+
+    def _l2cap_pump(self,_):
+        '''在中断之外连续发送SDU，直到信道阻塞或者发完'''
+        if self.l2cap_seq == BaseBLESever.L2CAP_LOG:
+            return self._l2cap_pump_log()
+        if self.l2cap_delta is not None:
+            return self._l2cap_pump_delta()
+        chan = self.l2cap_chan
+        sdu = self.l2cap_sdu
+        header = struct.calcsize(BaseBLESever.L2CAP_HEADER)
+        per_sdu = (self.l2cap_sdu_size-header)//RECORD_SIZE
+        while chan is not None and self.l2cap_seq is not None and not self.l2cap_stalled:
+            seq,ticks,channels,values = self.l2cap_source.span_from(max(self.l2cap_seq,0),per_sdu)
+            n = len(ticks)
+            struct.pack_into(BaseBLESever.L2CAP_HEADER,sdu,0,seq,n)
+            offset = header
+            for i in range(n):
+                struct.pack_into(RECORD_FMT,sdu,offset,ticks[i],channels[i],values[i])
+                offset += RECORD_SIZE
+            ready = self.ble.l2cap_send(chan[0],chan[1],self.l2cap_mv[:offset])
+            self.l2cap_sent += n
+            self.l2cap_seq = None if n == 0 else seq+n#空SDU表示已经发完
+            if not ready:
+                self.l2cap_stalled = True
+
+    def _l2cap_pump_log(self):
+        chan = self.l2cap_chan
+        sdu = self.l2cap_sdu
+        log = self.l2cap_log
+        header = struct.calcsize(BaseBLESever.L2CAP_HEADER)
+        per_sdu = (self.l2cap_sdu_size-header)//RECORD_SIZE
+        while chan is not None and self.l2cap_seq == BaseBLESever.L2CAP_LOG and not self.l2cap_stalled:
+            seq = log.seq
+            ticks,channels,values = log.read_chunk(per_sdu)
+            n = len(ticks)
+            struct.pack_into(BaseBLESever.L2CAP_HEADER,sdu,0,seq,n)
+            offset = header
+            for i in range(n):
+                struct.pack_into(RECORD_FMT,sdu,offset,ticks[i],channels[i],values[i])
+                offset += RECORD_SIZE
+            ready = self.ble.l2cap_send(chan[0],chan[1],self.l2cap_mv[:offset])
+            log.commit(persist = n == 0)
+            self.l2cap_sent += n
+            if n == 0:
+                self.l2cap_seq = None
+            if not ready:
+                self.l2cap_stalled = True
+
+    def _l2cap_pump_delta(self):
+        chan = self.l2cap_chan
+        buf = self.l2cap_scratch
+        delta = self.l2cap_delta
+        header = struct.calcsize(BaseBLESever.L2CAP_DELTA_HEADER)
+        while chan is not None and self.l2cap_seq is not None and not self.l2cap_stalled:
+            seq,ticks,channels,values = self.l2cap_source.span_from(max(self.l2cap_seq,0),self.l2cap_delta_n)
+            n = len(ticks)
+            base = ticks[0] if n else 0
+            end,n = delta.encode(ticks,channels,values,n,base,self.l2cap_scratch_mv[:self.l2cap_sdu_size],header)#只编码放得进SDU的记录
+            if n == len(ticks) and end*5 < self.l2cap_sdu_size*4 and self.l2cap_delta_n < self.l2cap_delta_max:
+                self.l2cap_delta_n = min(self.l2cap_delta_n+self.l2cap_delta_n//8+1,self.l2cap_delta_max)#还有余量，下次多取一些
+            elif n < len(ticks):
+                self.l2cap_delta_n = n
+            struct.pack_into(BaseBLESever.L2CAP_DELTA_HEADER,buf,0,seq,n,base)
+            ready = self.ble.l2cap_send(chan[0],chan[1],self.l2cap_scratch_mv[:end])
+            self.l2cap_sent += n
+            self.l2cap_seq = None if n == 0 else seq+n
+            if not ready:
+                self.l2cap_stalled = True
+
+    def _service_uuid16(self):
+        '''已注册服务中16位UUID的小端字节，用于广播的AD 0x03；bytes(UUID)不是2字节的(128位UUID)跳过'''
+        raw = b''
+        for service in self.servicer or ():
+            try:
+                uuid = bytes(service[0])
+            except TypeError:
+                continue
+            if len(uuid) == 2 and uuid not in raw:
+                raw += uuid
+        return raw
 
     def advertise(self,interval_us=100,resp_data=None):
-        '''转换状态为广播员，开始广播，注意不连接就是广播态，通过led和print显示状态'''
-        adv_data = bytearray(b'\x02\x01\x06')+bytearray([len(self.name)+1,0x09])+self.name
+        '''转换状态为广播员，开始广播，注意不连接就是广播态，通过led和日志显示状态
+
+        adv_data依次为标志、名称、服务UUID列表(AD 0x03，网关按它识别)和连接间隔(AD 0x12)，
+        后两项放不下时移到扫描响应resp_data中'''
+        self.adv_interval_us = interval_us
+        self.adv_resp_data = resp_data
+        adv_max = BaseBLESever.ADV_MAX
+        name,name_type = self.name,0x09
+        if 5+len(name) > adv_max:#完整名称放不下，截断为短名称
+            name,name_type = name[:adv_max-5],0x08
+        adv_data = bytearray(b'\x02\x01\x06')+bytearray([len(name)+1,name_type])+name
+        fields = []
+        uuids = self._service_uuid16()
+        if uuids:
+            fields.append(bytes([len(uuids)+1,0x03])+uuids)
+        fields.append(struct.pack('<BBHH',5,0x12,self.conn_interval[0],self.conn_interval[1]))
+        resp = bytes(resp_data) if resp_data else b''
+        for field in fields:
+            if len(adv_data)+len(field) <= adv_max:
+                adv_data += field
+            elif len(resp)+len(field) <= adv_max:
+                resp += field
+            else:
+                _log.warn('no room for AD type 0x%02x in adv_data or resp_data',field[1])
+        if resp:
+            resp_data = resp
         self.ble.gap_advertise(interval_us = interval_us,adv_data = adv_data,resp_data = resp_data)
-        self.disconnected()#状态显示
+        if not self.connections:
+            self.disconnected()#状态显示
+
+    def handle_conn_event(self,event,data):
+        '''维护连接表，处理了事件时返回True'''
+        if event == IRQ.IRQ_CENTRAL_CONNECT:
+            conn_handle = data[0]
+            self.connections[conn_handle] = {'interval_ms':None,'latency':None,'timeout_ms':None,'mtu':23}
+            self.connected()
+            if len(self.connections) < self.max_connections:#还有空位，继续广播
+                self.advertise(self.adv_interval_us,self.adv_resp_data)
+            return True
+        elif event == IRQ.IRQ_CENTRAL_DISCONNECT:
+            self.connections.pop(data[0],None)
+            self.advertise(self.adv_interval_us,self.adv_resp_data)
+            return True
+        elif event == IRQ.IRQ_CONNECTION_UPDATE:
+            conn_handle,interval,latency,timeout,status = data
+            info = self.connections.get(conn_handle)
+            if info is not None and status == 0:
+                info['interval_ms'] = interval*1.25
+                info['latency'] = latency
+                info['timeout_ms'] = timeout*10
+            return True
+        elif event == IRQ.IRQ_MTU_EXCHANGED:
+            info = self.connections.get(data[0])
+            if info is not None:
+                info['mtu'] = data[1]
+            return True
+        return False
+
+    def set_conn_profile(self,fast):
+        '''fast为True时请求较短的连接间隔，用于持续推送数据，否则请求较长的间隔以省电'''
+        interval = BaseBLESever.FAST_INTERVAL if fast else BaseBLESever.SLOW_INTERVAL
+        if interval == self.conn_interval:
+            return
+        self.conn_interval = interval
+        if len(self.connections) < self.max_connections:
+            self.advertise(self.adv_interval_us,self.adv_resp_data)
 
     def disconnected(self):
         '''未连接态状态显示'''
         self.timer.init(mode = Timer.PERIODIC,period=100,callback= lambda blink:self.led.value(not self.led.value()))
-        print("ble disconnected...")
+        _log.info('disconnected')
     
     def connected(self):
         '''连接态状态显示'''
         self.led.on()
         self.timer.deinit()
-        print("ble connected...")
+        _log.info('connected')
     
     def register(self,servicer):
         '''充当gatts注册服务'''
@@ -128,6 +384,28 @@ class BLESever(BaseBLESever):
                     ]
 
     ble = BLESever('XGZP',getBuffers=getBuffers,servicers=servicer)#集中配置
+
+    缓存模式:
+
+    ble = BLESever('XGZP',getBuffers=getBuffers,cache_period_ms = 1000)
+
+    传感器在中断之外按周期读取，结果用gatts_write写入特性值，读请求直接由协议栈返回缓存值，
+    中断里不再访问i2c，读延迟与总线无关(ESP32上的读请求本来就不经过IRQ_GATTS_READ_REQUEST)
+
+    通知推送:
+
+    ble.start_stream(period_ms = 200,threshold = 0.5)
+
+    每个周期刷新特性值后，向订阅了该特性的连接gatts_notify，threshold不为None时只有变化量达到threshold才推送。
+    部分移植版本不会把CCCD的写入报告给IRQ_GATTS_WRITE，所以默认连接后即视为订阅了全部带FLAG_NOTIFY的特性，
+    subscribe_on_connect = False时只按CCCD的写入(句柄为特性值句柄+1)维护订阅
+
+    数据格式:
+
+    特性值按GATT规范的二进制格式编码(见CODECS)，未列出的特性按float32小端。
+    start_stream传入batch_latency_ms且协商后的MTU大于23时，一次通知打包多个采样：
+    uint32 第一条的ticks_ms，之后每条为uint16 相对第一条的毫秒数+特性值编码，
+    装满(MTU-3)或第一条已等待batch_latency_ms时发出
     '''
     #默认服务配置
     dft_character_pres = (bluetooth.UUID(0x2A6D),bluetooth.FLAG_READ | bluetooth.FLAG_NOTIFY,)#读通知
@@ -135,16 +413,44 @@ class BLESever(BaseBLESever):
     dft_servicer = (
             (bluetooth.UUID(0x181A),(dft_character_pres,dft_character_temp)),
         )
+    # 特性值编码(UUID,struct格式,比例,最小值,最大值)
+    # 0x2A6D Pressure为uint32，单位0.1Pa，负压记为0；0x2A6E Temperature为sint16，单位0.01℃
+    CODECS = (
+        (bluetooth.UUID(0x2A6D),'<I',10,0,0xFFFFFFFF),
+        (bluetooth.UUID(0x2A6E),'<h',100,-32768,32767),
+    )
+    DFT_CODEC = ('<f',1,None,None)
+    MAX_PAYLOAD = 244 # MTU最大247减去3字节ATT头
     
-    def __init__(self,name,getBuffers,servicer = None,led_pin = 2):
+    def __init__(self,name,getBuffers,servicer = None,led_pin = 2,cache_period_ms = None,cache_timer_id = 2,mtu = None,
+                 max_connections = 1):
         self.ble = bluetooth.BLE()
         self.timer = Timer(0)
         self.led = Pin(led_pin,Pin.OUT)
+        self._init_connections(max_connections)
 
         self.name = bytes(name,'utf-8')
         self.ble.config(gap_name=name)
+        if mtu:
+            self.ble.config(mtu = mtu)#首选MTU，由中心设备发起交换
         self.getBuffers = getBuffers
         self.servicer = servicer if servicer else BLESever.dft_servicer
+        self.cache_timer = None
+        self.cache_timer_id = cache_timer_id
+        self.refresh_errors = 0
+        self._refresh_ref = self.refresh#预先绑定，避免在中断里分配内存
+        # 通知推送
+        self.subscribe_on_connect = True
+        self.subscriptions = {}#conn_handle -> set(value_handle)
+        self.streaming = False
+        self.stream_threshold = None
+        self.last_sent = {}
+        self.notify_sent = 0
+        self.notify_dropped = 0
+        self.notify_failed = 0
+        self.notify_suppressed = 0
+        self.payload_limit = 20
+        self.batch_latency_ms = None
         #
         self.ble.active(True)
         self.register(self.servicer)#蓝牙注册
@@ -152,22 +458,442 @@ class BLESever(BaseBLESever):
         self.ble.irq(self._dft_iqr)#蓝牙中断函数挂载
            
         self.advertise()# 开始广播
+        if cache_period_ms:
+            self.start_cache(cache_period_ms)
+
+    def register(self,servicer):
+        '''注册服务，并建立特性值句柄到getBuffers中函数的索引'''
+        super().register(servicer)
+        self.handle_map = {}
+        for i in range(len(self.handles)):
+            for j in range(len(self.handles[i])):
+                self.handle_map[self.handles[i][j]] = self.getBuffers[i][j]
+        self.handle_items = list(self.handle_map.items())
+        # 带通知属性的特性，其CCCD句柄为特性值句柄+1
+        self.notify_handles = set()
+        self.cccd_map = {}
+        for i in range(len(self.handles)):
+            for j in range(len(self.handles[i])):
+                if servicer[i][1][j][1] & (bluetooth.FLAG_NOTIFY | bluetooth.FLAG_INDICATE):
+                    handle = self.handles[i][j]
+                    self.notify_handles.add(handle)
+                    self.cccd_map[handle+1] = handle
+        # 每个特性的编码方式和预分配缓冲区
+        self.codecs = {}
+        self.value_bufs = {}
+        self.batches = {}
+        for i in range(len(self.handles)):
+            for j in range(len(self.handles[i])):
+                handle = self.handles[i][j]
+                codec = BLESever.DFT_CODEC
+                for uuid,fmt,scale,lo,hi in BLESever.CODECS:
+                    if servicer[i][1][j][0] == uuid:
+                        codec = fmt,scale,lo,hi
+                        break
+                self.codecs[handle] = codec
+                self.value_bufs[handle] = bytearray(struct.calcsize(codec[0]))
+                if handle in self.notify_handles:
+                    self.batches[handle] = NotifyBatch(struct.calcsize(codec[0]),BLESever.MAX_PAYLOAD)
+
+    def pack_value(self,handle,buf,offset,value):
+        '''按handle对应的编码把value写入buf[offset:]'''
+        fmt,scale,lo,hi = self.codecs[handle]
+        if lo is None:
+            struct.pack_into(fmt,buf,offset,value)
+            return
+        value = int(round(value*scale))
+        if value < lo:
+            value = lo
+        elif value > hi:
+            value = hi
+        struct.pack_into(fmt,buf,offset,value)
+
+    def encode(self,handle,value):
+        buf = self.value_bufs[handle]
+        self.pack_value(handle,buf,0,value)
+        return buf
+
+    def refresh(self,_ = None):
+        '''在中断之外调用全部getter，并把结果写入各自的特性值'''
+        for handle,getter in self.handle_items:
+            try:
+                value = getter()
+            except OSError:
+                self.refresh_errors += 1
+                continue
+            self.ble.gatts_write(handle,self.encode(handle,value))
+            if self.streaming and handle in self.notify_handles:
+                self.notify(handle,value)
+
+    def notify(self,handle,value):
+        '''把handle当前的特性值推送给所有订阅的连接'''
+        batch = self.batches[handle]
+        if batch.used and self.batch_latency_ms is not None and batch.age() >= self.batch_latency_ms:#先检查等待时间，被抑制的采样不能让已攒下的一直等
+            self.flush(handle)
+        threshold = self.stream_threshold
+        if threshold is not None:
+            last = self.last_sent.get(handle)
+            if last is not None and abs(value-last) < threshold:
+                self.notify_suppressed += 1
+                return
+        self.last_sent[handle] = value
+        if self.batch_latency_ms is None or self.payload_limit <= 20:
+            self._notify_all(handle,None)
+            return
+        if batch.add(self,handle,value,self.payload_limit) or batch.age() >= self.batch_latency_ms:
+            self.flush(handle)
+
+    def flush(self,handle):
+        '''发出handle未发送的多采样通知'''
+        batch = self.batches[handle]
+        if batch.used:
+            self._notify_all(handle,batch.mv[:batch.used])
+            batch.used = 0
+
+    def _notify_all(self,handle,data):
+        '''data为None时发送当前特性值'''
+        for conn_handle,handles in self.subscriptions.items():
+            if handle not in handles:
+                continue
+            try:
+                if data is None:
+                    self.ble.gatts_notify(conn_handle,handle)
+                else:
+                    self.ble.gatts_notify(conn_handle,handle,data)
+                self.notify_sent += 1
+            except OSError as e:
+                if e.args and e.args[0] == 12:#ENOMEM,发送队列已满
+                    self.notify_dropped += 1
+                else:
+                    self.notify_failed += 1
+
+    def _update_payload_limit(self):
+        '''多个连接时按最小的MTU打包，上限变小时先按旧的上限发出已攒下的通知'''
+        limit = BLESever.MAX_PAYLOAD
+        for info in self.connections.values():
+            if info['mtu']-3 < limit:
+                limit = info['mtu']-3
+        if not self.connections:
+            limit = 20
+        if limit < self.payload_limit:
+            for handle in self.batches:
+                self.flush(handle)
+        self.payload_limit = limit
+
+    def start_stream(self,period_ms = 1000,threshold = None,batch_latency_ms = None):
+        '''按period_ms周期读取并推送通知，threshold为触发推送的最小变化量，
+        batch_latency_ms不为None时在MTU允许的情况下打包多个采样，最多延迟batch_latency_ms；
+        重新调用时先发出按旧设置攒下的通知'''
+        for handle in self.batches:
+            self.flush(handle)
+        self.stream_threshold = threshold
+        self.batch_latency_ms = batch_latency_ms
+        self.last_sent = {}
+        self.streaming = True
+        self.set_conn_profile(True)
+        self.stop_cache()
+        self.start_cache(period_ms)
+
+    def stop_stream(self):
+        self.streaming = False
+        self.set_conn_profile(False)
+        for handle in self.batches:
+            self.flush(handle)
+
+    def start_cache(self,period_ms = 1000):
+        '''按period_ms周期刷新特性值，读请求直接返回缓存'''
+        self.refresh()
+        self.cache_timer = Timer(self.cache_timer_id)
+        self.cache_timer.init(mode = Timer.PERIODIC,period = period_ms,callback = self._cache_irq)
+
+    def stop_cache(self):
+        if self.cache_timer:
+            self.cache_timer.deinit()
+            self.cache_timer = None
+
+    def _cache_irq(self,timer):
+        try:
+            micropython.schedule(self._refresh_ref,0)
+        except RuntimeError:#调度队列已满，跳过这一次
+            self.refresh_errors += 1
 
     def _dft_iqr(self,event,data):
-        if event == IRQ.IRQ_CENTRAL_CONNECT:
-            self.connected()
-        elif event == IRQ.IRQ_CENTRAL_DISCONNECT:
-            self.advertise()
+        if event >= IRQ.IRQ_L2CAP_ACCEPT and event <= IRQ.IRQ_L2CAP_SEND_READY:
+            return self.handle_l2cap_event(event,data)
+        if self.handle_conn_event(event,data):
+            self._update_payload_limit()#新连接加入订阅之前，按旧的上限发出已攒下的通知
+            if event == IRQ.IRQ_CENTRAL_CONNECT:
+                self.subscriptions[data[0]] = set(self.notify_handles) if self.subscribe_on_connect else set()
+            elif event == IRQ.IRQ_CENTRAL_DISCONNECT:
+                self.subscriptions.pop(data[0],None)
+        elif event == IRQ.IRQ_GATTS_WRITE:
+            conn_handle,attr_handle = data[0],data[1]
+            handle = self.cccd_map.get(attr_handle)
+            if handle is not None:
+                cccd = self.ble.gatts_read(attr_handle)
+                handles = self.subscriptions.setdefault(conn_handle,set())
+                if cccd and cccd[0] & 0b11:
+                    handles.add(handle)
+                else:
+                    handles.discard(handle)
         elif event == IRQ.IRQ_GATTS_READ_REQUEST:
-            for i in range(len(self.handles)):
-                for j in range(len(self.handles[i])):
-                    if data[1] == self.handles[i][j]:
-                        buf = getBuffers[i][j]()
-                        buf = bytes(str(round(buf,3)),'uft-8')
-                        print(f'buf is {buf},handle is handles[{i}][{j}]')
-                        self.ble.gatts_write(self.handles[i][j],buf)
+            if self.cache_timer:#缓存模式，协议栈直接返回已写入的值
+                return
+            handle = data[1]
+            getter = self.handle_map.get(handle)
+            if getter:
+                buf = self.encode(handle,getter())
+                _log.debug('read request handle %s, %s bytes',handle,len(buf))
+                self.ble.gatts_write(handle,buf)
                         
+
+class NotifyBatch:
+    '''一个特性的多采样通知缓冲，格式见BLESever的说明'''
+    HEADER = 4
+
+    def __init__(self,value_size,max_payload):
+        self.buf = bytearray(max_payload)
+        self.mv = memoryview(self.buf)
+        self.record_size = 2+value_size
+        self.used = 0
+        self.base = 0
+
+    def age(self):
+        return time.ticks_diff(time.ticks_ms(),self.base) if self.used else 0
+
+    def add(self,sever,handle,value,limit):
+        '''追加一条记录，再放不下一条时返回True'''
+        now = time.ticks_ms()
+        if not self.used:
+            self.base = now
+            struct.pack_into('<I',self.buf,0,now)
+            self.used = NotifyBatch.HEADER
+        dt = time.ticks_diff(now,self.base)
+        struct.pack_into('<H',self.buf,self.used,dt if dt < 0xFFFF else 0xFFFF)
+        sever.pack_value(handle,self.buf,self.used+2,value)
+        self.used += self.record_size
+        return self.used+self.record_size > limit
+
     
+class BLEGateway:
+    '''中心设备网关BLEGateway(buffer,name_prefix = None,max_nodes = 4)，扫描并连接多个BLESever外设，
+    订阅它们的通知，把采样合并写入buffer(RingBuffer)，再通过UDPClient/TCPClient批量转发
+
+    example:
+
+    from _device import RingBuffer,UDPClient,wlan_wait_connected
+
+    from _device.ble import BLEGateway
+
+    wlan_wait_connected(ssid,password)
+
+    rb = RingBuffer(1024)
+
+    gateway = BLEGateway(rb,name_prefix = 'XGZP')
+
+    gateway.scan()
+
+    udp_client = UDPClient(('10.195.86.44',46545),node_id = 1)#forward需要二进制帧，文本格式没有时间戳
+
+    while True:
+
+        gateway.forward(udp_client)
+
+        time.sleep(1)
+
+    合并后的通道号为 节点序号*8+本地通道号(CH_PRESSURE,CH_TEMPERATURE...)，节点序号按连接顺序分配。
+    外设发来的多采样通知(格式见BLESever)按网关自己的ticks_ms还原时间戳。
+    同一时间只进行一个连接的服务发现和订阅，完成后再连接下一个。
+    已订阅的外设断开后记入missing并重新扫描(每次rescan_ms)，它重新广播时再连上，节点序号不变
+    '''
+    NODE_CHANNELS = 8
+    # 特性UUID -> 本地通道号
+    UUID_CHANNELS = (
+        (bluetooth.UUID(0x2A6D),CH_PRESSURE),
+        (bluetooth.UUID(0x2A6E),CH_TEMPERATURE),
+    )
+
+    def __init__(self,buffer,name_prefix = None,max_nodes = 4,service = bluetooth.UUID(0x181A),rescan_ms = 5000):
+        self.buffer = buffer
+        self.name_prefix = bytes(name_prefix,'utf-8') if name_prefix else None
+        self.max_nodes = max_nodes
+        self.service = service
+        self.rescan_ms = rescan_ms
+        self.nodes = {}#conn_handle -> 节点信息
+        self.pending = []#扫描到、等待连接的(addr_type,addr)
+        self.seen = set()
+        self.indexes = {}#addr -> 节点序号，重连后沿用
+        self.missing = set()#断开后等待重连的addr
+        self.next_index = 0
+        self.busy = False
+        self.connecting = None#正在连接或订阅的addr
+        self.scanning = False
+        self.reconnects = 0
+        self.notifications = 0
+        self.decode_errors = 0
+        self.forwarded = 0
+        #
+        self.ble = bluetooth.BLE()
+        self.ble.active(True)
+        self.ble.irq(self._irq)
+
+    def scan(self,duration_ms = 5000):
+        self.scanning = True
+        self.ble.gap_scan(duration_ms,30000,30000,True)
+
+    def _rescan(self):
+        '''有断开的外设、没有待连接的外设且不在扫描时重新扫描'''
+        if self.missing and self.rescan_ms and not self.scanning and not self.busy and not self.pending:
+            self.scan(self.rescan_ms)
+
+    def _match(self,adv_data):
+        '''广播数据中含有名称前缀或者环境传感服务UUID时返回True'''
+        i = 0
+        uuid16 = self.service
+        while i+1 < len(adv_data):
+            length,ad_type = adv_data[i],adv_data[i+1]
+            payload = adv_data[i+2:i+1+length]
+            if ad_type in (0x08,0x09) and self.name_prefix and bytes(payload).startswith(self.name_prefix):
+                return True
+            if ad_type in (0x02,0x03):
+                for j in range(0,len(payload)-1,2):
+                    if bluetooth.UUID(payload[j] | payload[j+1]<<8) == uuid16:
+                        return True
+            i += 1+length
+        return False
+
+    def _connect_next(self):
+        if self.busy or not self.pending or len(self.nodes) >= self.max_nodes:
+            return
+        addr_type,addr = self.pending.pop(0)
+        self.busy = True
+        self.connecting = addr
+        self.ble.gap_connect(addr_type,addr)
+
+    def _subscribe_next(self,conn_handle):
+        '''逐个写CCCD订阅通知，全部完成后连接下一个外设'''
+        node = self.nodes[conn_handle]
+        if node['todo']:
+            value_handle = node['todo'].pop(0)
+            self.ble.gattc_write(conn_handle,value_handle+1,b'\x01\x00',1)
+        else:
+            self.busy = False
+            self.connecting = None
+            if node['addr'] in self.missing:
+                self.missing.discard(node['addr'])
+                self.reconnects += 1
+            self._connect_next()
+            self._rescan()
+
+    def _irq(self,event,data):
+        if event == IRQ.IRQ_SCAN_RESULT:
+            addr_type,addr,adv_type,rssi,adv_data = data
+            addr = bytes(addr)#addr和adv_data只在中断内有效
+            if addr not in self.seen and len(self.nodes)+len(self.pending) < self.max_nodes and self._match(adv_data):
+                self.seen.add(addr)
+                self.pending.append((addr_type,addr))
+        elif event == IRQ.IRQ_SCAN_DONE:
+            self.scanning = False
+            self._connect_next()
+            self._rescan()
+        elif event == IRQ.IRQ_PERIPHERAL_CONNECT:
+            conn_handle,addr_type,addr = data
+            addr = bytes(addr)
+            index = self.indexes.get(addr)
+            if index is None:
+                index = self.indexes[addr] = self.next_index
+                self.next_index += 1
+            self.nodes[conn_handle] = {'addr':addr,'index':index,'range':None,'chars':{},'todo':[],'rejected':False}
+            self.ble.gattc_discover_services(conn_handle)
+        elif event == IRQ.IRQ_GATTC_SERVICE_RESULT:
+            conn_handle,start_handle,end_handle,uuid = data
+            if uuid == self.service:
+                self.nodes[conn_handle]['range'] = (start_handle,end_handle)
+        elif event == IRQ.IRQ_GATTC_SERVICE_DONE:
+            conn_handle = data[0]
+            node = self.nodes.get(conn_handle)
+            if node and node['range']:
+                self.ble.gattc_discover_characteristics(conn_handle,*node['range'])
+            else:
+                if node:#没有环境传感服务，断开后不再连接
+                    node['rejected'] = True
+                    self.missing.discard(node['addr'])
+                self.ble.gap_disconnect(conn_handle)
+        elif event == IRQ.IRQ_GATTC_CHARACTERISTIC_RESULT:
+            conn_handle,end_handle,value_handle,properties,uuid = data
+            if properties & bluetooth.FLAG_NOTIFY:
+                for char_uuid,channel in BLEGateway.UUID_CHANNELS:
+                    if uuid == char_uuid:
+                        node = self.nodes[conn_handle]
+                        node['chars'][value_handle] = (char_uuid,node['index']*BLEGateway.NODE_CHANNELS+channel)
+                        node['todo'].append(value_handle)
+        elif event == IRQ.IRQ_GATTC_CHARACTERISTIC_DONE:
+            self._subscribe_next(data[0])
+        elif event == IRQ.IRQ_GATTC_WRITE_DONE:
+            if data[0] in self.nodes:
+                self._subscribe_next(data[0])
+        elif event == IRQ.IRQ_GATTC_NOTIFY:
+            conn_handle,value_handle,notify_data = data
+            node = self.nodes.get(conn_handle)
+            if node and value_handle in node['chars']:
+                self._on_notify(node['chars'][value_handle],notify_data)
+        elif event == IRQ.IRQ_PERIPHERAL_DISCONNECT:
+            conn_handle,addr_type,addr = data
+            addr = bytes(addr)
+            node = self.nodes.pop(conn_handle,None)
+            if node is None or not node['rejected']:#连接超时或者外设断开，重新扫描到时再连
+                self.seen.discard(addr)
+                if node or addr in self.missing:
+                    self.missing.add(addr)
+            if addr == self.connecting:
+                self.busy = False
+                self.connecting = None
+            self._connect_next()
+            self._rescan()
+
+    def _on_notify(self,char,data):
+        '''解码单个值或多采样通知，写入buffer'''
+        uuid,channel = char
+        fmt,scale = '<f',1
+        for codec_uuid,codec_fmt,codec_scale,lo,hi in BLESever.CODECS:
+            if uuid == codec_uuid:
+                fmt,scale = codec_fmt,codec_scale
+                break
+        size = struct.calcsize(fmt)
+        now = time.ticks_ms()
+        try:
+            if len(data) == size:
+                self.buffer.put(channel,struct.unpack_from(fmt,data,0)[0]/scale,now)
+            else:
+                record = 2+size
+                n = (len(data)-NotifyBatch.HEADER)//record
+                if n <= 0 or NotifyBatch.HEADER+n*record != len(data):#空的或不完整的多采样通知
+                    raise ValueError
+                last = struct.unpack_from('<H',data,NotifyBatch.HEADER+(n-1)*record)[0]
+                offset = NotifyBatch.HEADER
+                for i in range(n):
+                    dt = struct.unpack_from('<H',data,offset)[0]
+                    value = struct.unpack_from(fmt,data,offset+2)[0]/scale
+                    self.buffer.put(channel,value,time.ticks_add(now,dt-last))
+                    offset += record
+            self.notifications += 1
+        except (ValueError,IndexError):#长度不对的通知
+            self.decode_errors += 1
+
+    def forward(self,client,max_n = 64):
+        '''把buffer中的采样按每批最多max_n条交给client.sendRecords发送，返回发送的条数；
+        client需要用node_id创建，以二进制帧发送，帧中保留每条采样的ticks'''
+        if client.encoder is None:
+            raise ValueError("forward needs binary frames, create the client with node_id")
+        total = 0
+        while not self.buffer.is_empty():
+            ticks,channels,values = self.buffer.peek(max_n)
+            client.sendRecords(ticks,channels,values)
+            total += self.buffer.consume(len(ticks))
+        self.forwarded += total
+        return total
+
+
 if __name__ == '__main__':
     from _device import XGZP
     from machine import SoftI2C,Pin
@@ -0,0 +1,241 @@
+'''采样批的增量+zigzag varint压缩，设备端编码，主机端(CPython)解码
+
+传感器的值相对采样率变化很慢，相邻两次读数只差几个最低位。一批记录按通道分块编码：
+
+    通道块: uint8 channel, uint8 小数位数exp, varint 记录数
+    记录:   varint (zigzag(本次-上次)<<1), varint 与上一条的毫秒差
+    重复:   varint (count<<1 | 1), varint 毫秒差      —— count条记录，值与上一条相同、间隔都为该毫秒差
+
+值按10**exp量化成整数后相减(压力exp = 1即0.1Pa，温度exp = 2即0.01℃)，每个通道的上一值从0开始，
+上一时刻从base_ticks开始，所以每批可以独立解码。解码结果按通道分组，需要时间顺序可以按ticks排序。
+编码只写入预分配的bytearray，不创建中间对象。
+
+量化后的值限制在±Q_MAX之内(超出的和inf取边界，NaN取通道的上一值，计入clamped)，毫秒差不超过TICKS_MASK，
+所以每条记录最多10字节，max_size(n)是n条记录的上限。encode先按编码后的长度算出buf中放得下的前k条，
+只编码这k条，返回(结束位置,k)，剩下的记录由调用者放进下一批。
+
+example:
+
+    >>> from _device.delta import DeltaEncoder,decode
+    >>> enc = DeltaEncoder(exps = {CH_PRESSURE:1,CH_TEMPERATURE:2})
+    >>> buf = bytearray(enc.max_size(n))
+    >>> end,k = enc.encode(ticks,channels,values,n,base_ticks,buf,0)
+    主机端:
+    >>> records = decode(buf,0,end,base_ticks)
+'''
+TICKS_MASK = 0x3FFFFFFF
+RUN = 1
+Q_MAX = 0x3FFFFFFF # 量化值的范围，MicroPython的小整数，增量的zigzag<<1不超过5字节varint
+
+
+def write_varint(buf,offset,value):
+    '''把非负整数value写入buf[offset:]，返回新的offset'''
+    while value >= 0x80:
+        buf[offset] = (value & 0x7F) | 0x80
+        value >>= 7
+        offset += 1
+    buf[offset] = value
+    return offset+1
+
+
+def read_varint(buf,offset):
+    '''返回(value,新的offset)'''
+    value = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7F)<<shift
+        if byte < 0x80:
+            return value,offset
+        shift += 7
+
+
+def varint_size(value):
+    '''write_varint写入value的字节数'''
+    n = 1
+    while value >= 0x80:
+        value >>= 7
+        n += 1
+    return n
+
+
+def _clamp(v,last_v):
+    '''超出±Q_MAX的量化值取边界，NaN取上一值'''
+    if v != v:
+        return last_v
+    return Q_MAX if v > 0 else -Q_MAX
+
+
+def _run_size(run_n,run_dt):
+    '''_flush_run写入的字节数'''
+    return (1 if run_n == 1 else varint_size(run_n<<1 | RUN))+varint_size(run_dt)
+
+
+def zigzag(value):
+    return value<<1 if value >= 0 else ((-value)<<1)-1
+
+
+def unzigzag(value):
+    return value>>1 if not value & 1 else -((value+1)>>1)
+
+
+class DeltaEncoder:
+    '''DeltaEncoder(exps = None,default_exp = 2,rle = True)，exps为{channel:小数位数}'''
+    MAX_CHANNELS = 32
+
+    def __init__(self,exps = None,default_exp = 2,rle = True):
+        self.exps = exps if exps else {}
+        self.default_exp = default_exp
+        self.rle = rle
+        m = DeltaEncoder.MAX_CHANNELS
+        self._channels = bytearray(m)
+        self._counts = [0]*m
+        self._scales = [1]*m
+        # _fit中各通道的上一值,上一时刻和当前游程
+        self._last_v = [0]*m
+        self._last_t = [0]*m
+        self._run_n = [0]*m
+        self._run_dt = [0]*m
+        self.clamped = 0
+
+    def max_size(self,n):
+        '''n条记录编码后的最大字节数'''
+        return n*10+DeltaEncoder.MAX_CHANNELS*7
+
+    def _fit(self,ticks,channels,values,n,base_ticks,room):
+        '''按出现顺序收集通道，并按编码后的长度算出放得进room字节的前k条记录，返回(k,通道数)；
+        _counts为前k条中各通道的记录数'''
+        chs = self._channels
+        counts = self._counts
+        scales = self._scales
+        last_v = self._last_v
+        last_t = self._last_t
+        run_n = self._run_n
+        run_dt = self._run_dt
+        rle = self.rle
+        m = 0
+        size = 0
+        for i in range(n):
+            ch = channels[i]
+            for j in range(m):
+                if chs[j] == ch:
+                    break
+            else:
+                if m >= DeltaEncoder.MAX_CHANNELS:
+                    raise ValueError("too many channels in one batch")
+                j = m
+                m += 1
+                chs[j] = ch
+                counts[j] = 0
+                scales[j] = 10**self.exps.get(ch,self.default_exp)
+                last_v[j] = 0
+                last_t[j] = base_ticks
+                run_n[j] = 0
+                size += 3#channel,exp和1字节的记录数
+            v = values[i]*scales[j]
+            q = int(round(v)) if -Q_MAX <= v <= Q_MAX else _clamp(v,last_v[j])
+            dt = (ticks[i]-last_t[j]) & TICKS_MASK
+            last_t[j] = ticks[i]
+            cost = varint_size(counts[j]+1)-varint_size(counts[j])
+            if rle and q == last_v[j]:
+                r = run_n[j]
+                if r and dt == run_dt[j]:
+                    cost += _run_size(r+1,dt)-_run_size(r,dt)
+                    run_n[j] = r+1
+                else:
+                    cost += _run_size(1,dt)
+                    run_n[j] = 1
+                    run_dt[j] = dt
+            else:
+                cost += varint_size(zigzag(q-last_v[j])<<1)+varint_size(dt)
+                run_n[j] = 0
+                last_v[j] = q
+            if size+cost > room:
+                if not counts[j]:#新通道的第一条就放不下，通道块也不写
+                    m -= 1
+                return i,m
+            size += cost
+            counts[j] += 1
+        return n,m
+
+    def encode(self,ticks,channels,values,n,base_ticks,buf,offset):
+        '''编码前n条记录中放得进buf[offset:]的前k条，返回(结束位置,k)'''
+        k,m = self._fit(ticks,channels,values,n,base_ticks,len(buf)-offset)
+        chs = self._channels
+        counts = self._counts
+        rle = self.rle
+        for j in range(m):
+            ch = chs[j]
+            scale = self._scales[j]
+            buf[offset] = ch
+            buf[offset+1] = self.exps.get(ch,self.default_exp)
+            offset = write_varint(buf,offset+2,counts[j])
+            last_v = 0
+            last_t = base_ticks
+            run_n = 0
+            run_dt = 0
+            for i in range(k):
+                if channels[i] != ch:
+                    continue
+                v = values[i]*scale
+                if -Q_MAX <= v <= Q_MAX:
+                    q = int(round(v))
+                else:
+                    q = _clamp(v,last_v)
+                    self.clamped += 1
+                dt = (ticks[i]-last_t) & TICKS_MASK
+                last_t = ticks[i]
+                if rle and q == last_v:
+                    if run_n and dt == run_dt:
+                        run_n += 1
+                        continue
+                    if run_n:
+                        offset = self._flush_run(buf,offset,run_n,run_dt)
+                    run_n = 1
+                    run_dt = dt
+                    continue
+                if run_n:
+                    offset = self._flush_run(buf,offset,run_n,run_dt)
+                    run_n = 0
+                offset = write_varint(buf,offset,zigzag(q-last_v)<<1)
+                offset = write_varint(buf,offset,dt)
+                last_v = q
+            if run_n:
+                offset = self._flush_run(buf,offset,run_n,run_dt)
+        return offset,k
+
+    @staticmethod
+    def _flush_run(buf,offset,run_n,run_dt):
+        if run_n == 1:#单条时按增量0记录，长度相同
+            offset = write_varint(buf,offset,0)
+        else:
+            offset = write_varint(buf,offset,run_n<<1 | RUN)
+        return write_varint(buf,offset,run_dt)
+
+
+def decode(buf,offset,end,base_ticks):
+    '''解码buf[offset:end]，返回[(ticks,channel,value),...]'''
+    records = []
+    while offset < end:
+        ch = buf[offset]
+        exp = buf[offset+1]
+        scale = 10**exp
+        count,offset = read_varint(buf,offset+2)
+        last_v = 0
+        last_t = base_ticks
+        done = 0
+        while done < count:
+            token,offset = read_varint(buf,offset)
+            dt,offset = read_varint(buf,offset)
+            if token & RUN:
+                for _ in range(token>>1):
+                    last_t = (last_t+dt) & TICKS_MASK
+                    records.append((last_t,ch,last_v/scale))
+                done += token>>1
+            else:
+                last_v += unzigzag(token>>1)
+                last_t = (last_t+dt) & TICKS_MASK
+                records.append((last_t,ch,last_v/scale))
+                done += 1
+    return records
@@ -0,0 +1,375 @@
+'''掉线期间的采样日志，写在ESP32的文件系统上，恢复连接后按顺序成块读出发送
+
+记录为ringbuf.RECORD_FMT的9字节定长格式，与L2CAP批量传输的记录相同。日志由若干段文件组成：
+
+    path/00000001.seg, path/00000002.seg ...
+
+每段由block_size(默认4096，即flash的一个扇区)字节的块组成，一块放block_size//9条记录，余下的字节填0xFF。
+写入先攒在一块大小的缓冲区里，满了才整块追加到当前段。写缓冲区有两个：一块写满后与另一个交换，
+写满的一块由micropython.schedule推迟到主线程写入(defer为False时等append_from,flush或drain)，
+所以append总是只有一次pack_into，不会在采样路径上等待flash；上一块还没写入时另一块又满了，才同步写入并计入stalls。
+段写满segment_size后换下一段，段数超过max_segments时删除最旧的一段，其中未读的记录计入lost。
+segment_size缺省按os.statvfs的剩余空间计算，只用budget比例的空间，并对齐到块大小，
+这样littlefs每次都是整块写入，同一扇区不会被反复部分改写。
+
+读端用read_chunk取得一段连续的记录，发送成功后commit，读指针(段号,偏移,序号)写入path/cursor，
+先写cursor.tmp再rename，掉电时不会留下半个文件；读完的段直接删除。读端追上flash后，read_chunk直接从写缓冲区中
+取还没写入的记录，不为此写一块；这一块以后写入flash时读指针跳过已经提交的部分。flush只在关机或掉电前调用，
+否则每次重连都会多写一块不满的扇区。
+开机时总是从新的一段开始写，上次掉电时没写完的半条记录留在旧段末尾，读端会跳过。
+
+example:
+
+    >>> from _device.flashlog import FlashLog
+    >>> log = FlashLog('/log')
+    >>> log.append(CH_PRESSURE,p)
+    >>> log.append_from(rb)#或者把环形缓冲区中的记录整体转存
+    恢复连接后:
+    >>> client.drainLog(log)
+'''
+from array import array
+import os
+import micropython
+import struct
+import time
+from _device.ringbuf import RECORD_FMT,RECORD_SIZE
+
+CURSOR_FMT = '<III' # 段号,段内偏移,已提交的记录数
+PAD = 0xFF # 块末尾和未写满的块用0xFF填充，通道号为0xFF的记录无效
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+class FlashLog:
+    '''FlashLog(path = '/log',segment_size = None,max_segments = 8,block_size = 4096,budget = 0.5,chunk_records = 128,defer = True)'''
+    def __init__(self,path = '/log',segment_size = None,max_segments = 8,block_size = 4096,budget = 0.5,chunk_records = 128,
+                 defer = True):
+        self.path = path
+        if not _exists(path):
+            os.mkdir(path)
+        self.block_size = block_size
+        self.per_block = block_size//RECORD_SIZE
+        if segment_size is None:
+            st = os.statvfs(path)
+            segment_size = int(st[0]*st[4]*budget)//max_segments
+        self.segment_size = max(1,segment_size//block_size)*block_size
+        self.max_segments = max_segments
+        # 两个一块大小的写缓冲区，wbuf正在追加，另一个是等待写入的满块
+        self._blank = b'\xff'*block_size
+        self._blank_mv = memoryview(self._blank)
+        self._bufs = (bytearray(self._blank),bytearray(self._blank))
+        self._mvs = (memoryview(self._bufs[0]),memoryview(self._bufs[1]))
+        self._wi = 0
+        self.wbuf = self._bufs[0]
+        self._wmv = self._mvs[0]
+        self.wn = 0
+        self._full = False#另一个缓冲区是否有等待写入的满块
+        self._taken = [0,0]#各缓冲区开头已经从内存中读出并提交的记录数
+        self._gens = [0,0]#各缓冲区写入flash的次数
+        self._busy = False#正在写flash，推迟的drain不能插进来
+        self.defer = defer
+        self._drain_ref = self.drain#预先绑定，schedule时不分配
+        self.file = None
+        # 读缓冲区
+        self.chunk_records = chunk_records
+        self.rbuf = bytearray(chunk_records*RECORD_SIZE+block_size % RECORD_SIZE)
+        self.rmv = memoryview(self.rbuf)
+        self.ticks = array('i',bytes(4*chunk_records))
+        self.channels = array('B',bytes(chunk_records))
+        self.values = array('f',bytes(4*chunk_records))
+        self._ticks_mv = memoryview(self.ticks)
+        self._channels_mv = memoryview(self.channels)
+        self._values_mv = memoryview(self.values)
+        self._pending_off = None
+        self._pending_ram = None#上一次read_chunk从内存读出时为缓冲区序号
+        self._pending_gen = 0
+        self._pending_n = 0
+        # 统计
+        self.appended = 0
+        self.lost = 0
+        self.blocks = 0
+        self.partial_blocks = 0
+        self.stalls = 0
+        self.write_us_max = 0
+        # 恢复段列表和读指针，写端从新的一段开始
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.seg'))
+        self._load_cursor()
+        self.head = (self.segments[-1] if self.segments else 0)+1
+        self.head_size = 0
+
+    def _seg_path(self,seg):
+        return f"{self.path}/{seg:08d}.seg"
+
+    def _load_cursor(self):
+        self.rseg,self.roff,self.seq = 0,0,0
+        try:
+            with open(self.path+'/cursor','rb') as f:
+                self.rseg,self.roff,self.seq = struct.unpack(CURSOR_FMT,f.read())
+        except (OSError,ValueError):
+            pass
+        if self.rseg not in self.segments:#读指针所在的段已被删除
+            self.rseg = self.segments[0] if self.segments else 0
+            self.roff = 0
+
+    def _save_cursor(self):
+        tmp = self.path+'/cursor.tmp'
+        with open(tmp,'wb') as f:
+            f.write(struct.pack(CURSOR_FMT,self.rseg,self.roff,self.seq))
+        os.rename(tmp,self.path+'/cursor')
+
+    def _size(self,seg):
+        if seg == self.head:
+            return self.head_size
+        try:
+            return os.stat(self._seg_path(seg))[6]
+        except OSError:
+            return 0
+
+    def _slots(self,off):
+        '''段内偏移off之前的记录位置数'''
+        return (off//self.block_size)*self.per_block+min((off % self.block_size)//RECORD_SIZE,self.per_block)
+
+    def __len__(self):
+        '''未读的记录数(约数，填充的位置也计算在内)'''
+        n = 0
+        for seg in self.segments:
+            if seg >= self.rseg:
+                n += self._slots(self._size(seg))-(self._slots(self.roff) if seg == self.rseg else 0)
+        n += self.wn-self._taken[self._wi]
+        return n+(self.per_block-self._taken[self._wi ^ 1] if self._full else 0)
+
+    def append(self,channel,value,ticks = None):
+        '''追加一条记录，写满一块时换另一个缓冲区，满块推迟写入flash'''
+        struct.pack_into(RECORD_FMT,self.wbuf,self.wn*RECORD_SIZE,time.ticks_ms() if ticks is None else ticks,channel,value)
+        self.wn += 1
+        self.appended += 1
+        if self.wn == self.per_block:
+            self._swap()
+
+    def _swap(self):
+        if self._full:#上一块还没写入，只能在这里同步写
+            self.stalls += 1
+            self.drain()
+        self._full = True
+        self._wi ^= 1
+        self.wbuf = self._bufs[self._wi]
+        self._wmv = self._mvs[self._wi]
+        self.wn = 0
+        if self.defer:
+            try:
+                micropython.schedule(self._drain_ref,0)
+            except RuntimeError:#调度队列已满，留给append_from,flush或下一次_swap
+                pass
+
+    def drain(self,_ = None):
+        '''写入等待中的满块，返回写入的块数'''
+        if not self._full or self._busy:
+            return 0
+        self._write_block(self._wi ^ 1)
+        self._full = False
+        return 1
+
+    def append_from(self,source,max_n = None):
+        '''把RingBuffer中的记录转存到日志并从缓冲区中移除，返回条数'''
+        total = 0
+        while max_n is None or total < max_n:
+            ticks,channels,values = source.peek(None if max_n is None else max_n-total)
+            n = len(ticks)
+            if not n:
+                break
+            for i in range(n):
+                self.append(channels[i],values[i],ticks[i])
+            source.consume(n)
+            total += n
+        self.drain()
+        return total
+
+    def flush(self):
+        '''先写入等待中的满块，再把写缓冲区中不满一块的记录写入flash，会占用一整块；
+        关机或掉电前调用，读端不需要，read_chunk会直接读写缓冲区'''
+        self.drain()
+        if self.wn:
+            start = self.wn*RECORD_SIZE
+            self._wmv[start:] = self._blank_mv[start:]#未写的位置恢复为填充，不能留下上一块的记录
+            self.partial_blocks += 1
+            self._write_block(self._wi)
+            self.wn = 0
+
+    def _write_block(self,i):
+        '''把第i个写缓冲区作为一块追加到当前段'''
+        buf = self._bufs[i]
+        self._busy = True
+        start = time.ticks_us()
+        try:
+            if self.file is None or self.head_size+self.block_size > self.segment_size:
+                self._rotate()
+            self.file.write(buf)
+            self.file.flush()
+        finally:
+            self._busy = False
+        self.head_size += self.block_size
+        self.blocks += 1
+        self._gens[i] += 1
+        taken = self._taken[i]
+        if taken:#读端已经从内存中读出并提交了这一块的前taken条，读指针跳过它们
+            self._taken[i] = 0
+            off = self.head_size-self.block_size
+            while self.rseg != self.head and self._slots(self._size(self.rseg)) <= self._slots(self.roff):
+                self._finish_segment()
+            if self.rseg == self.head and self._slots(self.roff) == self._slots(off):#读指针可能停在上一块末尾的填充处
+                self.roff = off+taken*RECORD_SIZE
+                self._save_cursor()
+        dt = time.ticks_diff(time.ticks_us(),start)
+        if dt > self.write_us_max:
+            self.write_us_max = dt
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+            self.head += 1
+        self.head_size = 0
+        self.segments.append(self.head)
+        self.file = open(self._seg_path(self.head),'wb')
+        while len(self.segments) > self.max_segments:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        seg = self.segments.pop(0)
+        if seg == self.rseg:#未读完的记录被覆盖，填充的位置也计入，lost为约数
+            lost = self._slots(self._size(seg))-self._slots(self.roff)
+            self.lost += lost
+            self.seq += lost
+            self.rseg,self.roff = self.segments[0],0
+            self._pending_off = None
+        os.remove(self._seg_path(seg))
+
+    def read_chunk(self,max_n = None):
+        '''返回一段连续的未读记录(ticks,channels,values)memoryview，不移动读指针，发送成功后调用commit；
+        一次只读一个段内的数据，flash中的记录读完后从写缓冲区读，都读完时返回空的切片'''
+        if max_n is None or max_n > self.chunk_records:
+            max_n = self.chunk_records
+        self.drain()
+        while True:
+            while self.rseg != self.head and self._slots(self._size(self.rseg)) <= self._slots(self.roff):
+                self._finish_segment()
+            n,i = self._read(max_n)
+            if n or not i:
+                break
+            self.roff += i#只有填充，直接跳过
+        if not n and not self._full and self.rseg == self.head:
+            return self._read_ram(max_n)
+        self._pending_ram = None
+        self._pending_off = self.roff+i
+        self._pending_n = n
+        return self._ticks_mv[:n],self._channels_mv[:n],self._values_mv[:n]
+
+    def _read_ram(self,max_n):
+        '''从写缓冲区中取还没写入flash、也还没提交的记录'''
+        wi = self._wi
+        start = self._taken[wi]
+        n = min(self.wn-start,max_n)
+        buf = self.wbuf
+        for k in range(n):
+            ticks,channel,value = struct.unpack_from(RECORD_FMT,buf,(start+k)*RECORD_SIZE)
+            self.ticks[k] = ticks
+            self.channels[k] = channel
+            self.values[k] = value
+        self._pending_off = None
+        self._pending_ram = wi
+        self._pending_gen = self._gens[wi]
+        self._pending_n = n
+        return self._ticks_mv[:n],self._channels_mv[:n],self._values_mv[:n]
+
+    def _read(self,max_n):
+        '''从读指针解析最多max_n条记录到数组，返回(条数,消耗的字节数)'''
+        size = self._size(self.rseg)
+        if size <= self.roff:
+            return 0,0
+        f = open(self._seg_path(self.rseg),'rb')
+        try:
+            f.seek(self.roff)
+            nbytes = f.readinto(self.rmv[:min(size-self.roff,len(self.rbuf))])
+        finally:
+            f.close()
+        bs = self.block_size
+        off = self.roff
+        n = 0
+        i = 0
+        while n < max_n and i+RECORD_SIZE <= nbytes:
+            j = (off+i) % bs
+            if j+RECORD_SIZE > bs:#块末尾的填充
+                i += bs-j
+                continue
+            ticks,channel,value = struct.unpack_from(RECORD_FMT,self.rbuf,i)
+            i += RECORD_SIZE
+            if channel == PAD:
+                continue
+            self.ticks[n] = ticks
+            self.channels[n] = channel
+            self.values[n] = value
+            n += 1
+        return n,i
+
+    def _finish_segment(self):
+        '''读完的段删除，读指针移到下一段'''
+        seg = self.rseg
+        if seg in self.segments:
+            self.segments.remove(seg)
+            os.remove(self._seg_path(seg))
+        later = [s for s in self.segments if s > seg]
+        self.rseg = later[0] if later else self.head
+        self.roff = 0
+
+    def commit(self,persist = True):
+        '''提交上一次read_chunk读出的记录，persist为True时保存读指针'''
+        n = self._pending_n
+        b = self._pending_ram
+        if b is not None:
+            self._pending_ram = None
+            if self._gens[b] == self._pending_gen:
+                self._taken[b] += n
+            else:#读出之后这一块已写入flash，读指针停在块内已提交的位置
+                self.roff += n*RECORD_SIZE
+        elif self._pending_off is None:
+            return 0
+        else:
+            self.roff = self._pending_off
+            self._pending_off = None
+            if self.rseg != self.head and self._slots(self._size(self.rseg)) <= self._slots(self.roff):
+                self._finish_segment()
+        self.seq += n
+        if persist:
+            self._save_cursor()
+        return n
+
+    def close(self):
+        '''写入缓冲区中剩余的记录并关闭当前段'''
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {'segments':len(self.segments),'segment_size':self.segment_size,'appended':self.appended,
+                'committed':self.seq,'lost':self.lost,'blocks':self.blocks,'partial_blocks':self.partial_blocks,
+                'stalls':self.stalls,'write_us_max':self.write_us_max}
+
+
+if __name__ == '__main__':
+    from _device.ringbuf import CH_PRESSURE
+    log = FlashLog('/log',segment_size = 4*4096,max_segments = 4)
+    for i in range(1000):
+        log.append(CH_PRESSURE,100.0+i)
+    while True:
+        ticks,channels,values = log.read_chunk()
+        if not len(ticks):
+            break
+        print(len(ticks),values[0],values[-1])
+        log.commit()
+    print(log.stats())
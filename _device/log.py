@@ -0,0 +1,200 @@
+'''轻量日志，代替采样和中断路径上的print
+
+    >>> from _device.log import get_logger,DEBUG
+    >>> log = get_logger('xgzp')
+    >>> log.debug('pressure %s',p)#低于当前级别时只是一次方法调用和一次比较
+    >>> set_level(DEBUG)
+    >>> dump()#从串口输出环中的全部记录
+
+记录不在调用时格式化：环(LogRing)中只保存ticks_ms、级别、logger、格式串和最多两个参数的引用，
+所有数组和列表在创建时分配好，启用的调用也不创建字符串；dump时才按msg % args格式化。
+参数按引用保存，bytearray等会被改写的对象需要先拷贝。
+满了之后覆盖最旧的记录。echo为True时同时print，开发时使用。
+
+输出：
+
+    dump()                          # 串口(sys.stdout)
+    dump_udp(('10.0.0.2',46546))    # UDP，每个数据报最多1400字节
+    dump_ble(ble_sever,value_handle)# 蓝牙通知，按各连接的MTU分块
+'''
+from array import array
+import sys
+import time
+
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+OFF = 100
+LEVEL_NAMES = {DEBUG:'D',INFO:'I',WARN:'W',ERROR:'E'}
+_NONE = object() # 没有传参数
+
+
+class LogRing:
+    '''LogRing(capacity = 64)，预分配的日志记录环'''
+    def __init__(self,capacity = 64):
+        self.capacity = capacity
+        self.ticks = array('i',bytes(4*capacity))
+        self.levels = bytearray(capacity)
+        self.names = [None]*capacity
+        self.msgs = [None]*capacity
+        self.a = [None]*capacity
+        self.b = [None]*capacity
+        self.n = 0#写入的总条数
+
+    def put(self,level,name,msg,a,b):
+        i = self.n % self.capacity
+        self.ticks[i] = time.ticks_ms()
+        self.levels[i] = level
+        self.names[i] = name
+        self.msgs[i] = msg
+        self.a[i] = a
+        self.b[i] = b
+        self.n += 1
+
+    def __len__(self):
+        return min(self.n,self.capacity)
+
+    def clear(self):
+        self.n = 0
+
+    def format(self,i):
+        '''第i条(0为最旧)记录格式化后的一行'''
+        j = (self.n-len(self)+i) % self.capacity
+        msg,a,b = self.msgs[j],self.a[j],self.b[j]
+        try:
+            if a is _NONE:
+                text = msg
+            elif b is _NONE:
+                text = msg % (a,)
+            else:
+                text = msg % (a,b)
+        except (TypeError,ValueError):
+            text = f"{msg} {a} {b}"
+        return f"{self.ticks[j]} {LEVEL_NAMES.get(self.levels[j],'?')} {self.names[j]}: {text}\n"
+
+    def lines(self):
+        for i in range(len(self)):
+            yield self.format(i)
+
+
+RING = LogRing()
+_loggers = {}
+_level = WARN
+
+
+class Logger:
+    '''Logger(name,level = None,ring = RING,echo = False)，level为None时使用全局级别'''
+    def __init__(self,name,level = None,ring = RING,echo = False):
+        self.name = name
+        self.level = _level if level is None else level
+        self.ring = ring
+        self.echo = echo
+
+    def enabled(self,level):
+        '''格式化本身很贵时，调用处先判断：if log.enabled(DEBUG): ...'''
+        return level >= self.level
+
+    def log(self,level,msg,a = _NONE,b = _NONE):
+        if level < self.level:
+            return
+        self.ring.put(level,self.name,msg,a,b)
+        if self.echo:
+            print(self.ring.format(len(self.ring)-1),end = '')
+
+    # 固定参数个数，禁用时调用不分配元组
+    def debug(self,msg,a = _NONE,b = _NONE):
+        if self.level <= DEBUG:
+            self.log(DEBUG,msg,a,b)
+
+    def info(self,msg,a = _NONE,b = _NONE):
+        if self.level <= INFO:
+            self.log(INFO,msg,a,b)
+
+    def warn(self,msg,a = _NONE,b = _NONE):
+        if self.level <= WARN:
+            self.log(WARN,msg,a,b)
+
+    def error(self,msg,a = _NONE,b = _NONE):
+        if self.level <= ERROR:
+            self.log(ERROR,msg,a,b)
+
+
+def get_logger(name):
+    '''同名的logger只创建一次'''
+    logger = _loggers.get(name)
+    if logger is None:
+        logger = _loggers[name] = Logger(name)
+    return logger
+
+
+def set_level(level,name = None,echo = None):
+    '''设置某个logger或者全部logger(包括之后创建的)的级别'''
+    global _level
+    targets = [_loggers[name]] if name is not None else list(_loggers.values())
+    if name is None:
+        _level = level
+    for logger in targets:
+        logger.level = level
+        if echo is not None:
+            logger.echo = echo
+
+
+def dump(write = None,max_bytes = None,ring = RING,clear = False):
+    '''把环中的记录从旧到新交给write，max_bytes不为None时把多行合并成不超过max_bytes的块(bytes)，
+    write缺省为sys.stdout.write，返回输出的行数'''
+    if write is None:
+        write = sys.stdout.write
+    n = 0
+    chunk = []
+    size = 0
+    for line in ring.lines():
+        n += 1
+        if max_bytes is None:
+            write(line)
+            continue
+        data = line.encode()[:max_bytes]
+        if size+len(data) > max_bytes and chunk:
+            write(b''.join(chunk))
+            chunk = []
+            size = 0
+        chunk.append(data)
+        size += len(data)
+    if chunk:
+        write(b''.join(chunk))
+    if clear:
+        ring.clear()
+    return n
+
+
+def dump_udp(obj_address,sock = None,max_bytes = 1400,ring = RING,clear = False):
+    '''用UDP发送环中的记录'''
+    import socket
+    own = sock is None
+    if own:
+        sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
+    try:
+        return dump(lambda data: sock.sendto(data,obj_address),max_bytes,ring,clear)
+    finally:
+        if own:
+            sock.close()
+
+
+def dump_ble(sever,value_handle,ring = RING,clear = False):
+    '''通过BaseBLESever的value_handle向每个连接发送通知，每块不超过连接的MTU-3字节'''
+    n = 0
+    for conn_handle,info in sever.connections.items():
+        mtu = info.get('mtu') or 23
+        n = dump(lambda data: sever.ble.gatts_notify(conn_handle,value_handle,data),mtu-3,ring)
+    if clear:
+        ring.clear()
+    return n
+
+
+if __name__ == '__main__':
+    log = get_logger('demo')
+    set_level(DEBUG)
+    for i in range(5):
+        log.debug('sample %d value %s',i,i*0.5)
+    log.warn('link down')
+    dump()
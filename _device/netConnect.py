@@ -1,5 +1,247 @@
 import network
 import time
+import json
+import struct
+from array import array
+from _device.log import get_logger
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+_log = get_logger('netConnect')
+
+WLAN_CACHE = '/wlan.json'
+#最近一次连接的耗时等，见wlan_connect_stats()
+CONNECT_STATS = {'attempts':0,'fast_ok':0,'fast_fail':0,'scan_ok':0,'plain_ok':0,'fail':0,'last_ms':None,'last_path':None,'recent_ms':[]}
+RECENT_N = 16
+#RTC内存中缓存的开头：RTC_MAGIC加上uint16长度
+RTC_MAGIC = b'WLC1'
+
+
+def _rtc_memory(data = None):
+    '''读写RTC内存，软复位和深度睡眠后仍然保留，不磨损flash；不支持时返回None
+
+    RTC.memory()整块归本模块所有(ESP32上最多2KB)，每次保存WLAN缓存都会整块覆盖，其他代码不要再使用它；
+    内容用_rtc_pack加上RTC_MAGIC和长度，读出时不是本模块写的内容就忽略，不会当成缓存解析'''
+    try:
+        from machine import RTC
+        rtc = RTC()
+        if data is None:
+            return rtc.memory()
+        rtc.memory(data)
+        return data
+    except (ImportError,AttributeError,OSError,ValueError):
+        return None
+
+
+def _rtc_pack(raw):
+    return RTC_MAGIC+struct.pack('<H',len(raw))+raw
+
+
+def _rtc_unpack(mem):
+    '''取出_rtc_pack写入的内容，开头不是RTC_MAGIC或长度不对时返回None'''
+    if not mem or len(mem) < 6 or bytes(mem[:4]) != RTC_MAGIC:
+        return None
+    n = struct.unpack_from('<H',mem,4)[0]
+    if len(mem) < 6+n:
+        return None
+    return bytes(mem[6:6+n])
+
+
+def wlan_load_cache(ssid):
+    '''读出ssid上一次成功连接的{'ssid','bssid','channel','ifconfig'}，先查RTC内存再查flash中的WLAN_CACHE'''
+    raw = _rtc_unpack(_rtc_memory())
+    for source in ('rtc','file'):
+        if source == 'file':
+            try:
+                with open(WLAN_CACHE) as f:
+                    raw = f.read()
+            except OSError:
+                return None
+        if not raw:
+            continue
+        try:
+            cache = json.loads(raw)
+        except ValueError:
+            continue
+        if isinstance(cache,dict) and cache.get('ssid') == ssid:
+            return cache
+    return None
+
+
+def wlan_save_cache(ssid,bssid,channel,ifconfig):
+    '''保存连接参数，RTC内存每次都写，flash中的文件只在内容变化时写'''
+    cache = {'ssid':ssid,'bssid':bssid,'channel':channel,'ifconfig':list(ifconfig)}
+    raw = json.dumps(cache)
+    _rtc_memory(_rtc_pack(raw.encode()))
+    try:
+        with open(WLAN_CACHE) as f:
+            if f.read() == raw:
+                return cache
+    except OSError:
+        pass
+    with open(WLAN_CACHE,'w') as f:
+        f.write(raw)
+    return cache
+
+
+POLL_MS = 10
+
+
+def _wait_status(wlan,timeout_ms):
+    '''轮询连接状态的生成器，每次yield需要等待的毫秒数，连上返回True，密码错误、找不到AP或超时返回False，
+    期间不重复调用connect'''
+    start = time.ticks_ms()
+    fail = tuple(getattr(network,name) for name in ('STAT_WRONG_PASSWORD','STAT_NO_AP_FOUND','STAT_CONNECT_FAIL')
+                 if hasattr(network,name))
+    while time.ticks_diff(time.ticks_ms(),start) < timeout_ms:
+        if wlan.isconnected():
+            return True
+        if wlan.status() in fail:
+            return False
+        yield POLL_MS
+    return wlan.isconnected()
+
+
+def _record(path,start):
+    stats = CONNECT_STATS
+    ms = time.ticks_diff(time.ticks_ms(),start)
+    stats['last_ms'] = ms
+    stats['last_path'] = path
+    recent = stats['recent_ms']
+    recent.append(ms)
+    if len(recent) > RECENT_N:
+        recent.pop(0)
+    return ms
+
+
+def _best_ap(wlan,ssid):
+    '''扫描(阻塞)，返回ssid中信号最强的AP的scan()条目，没有时返回None'''
+    best = None
+    for info in wlan.scan():
+        if info[0].decode('utf-8') == ssid and (best is None or info[3] > best[3]):
+            best = info
+    return best
+
+
+def _connected_ap(wlan,ssid,scan):
+    '''已连上的AP的(bssid十六进制,信道)。先查wlan.config('bssid')和config('channel')，移植版本不支持时，
+    scan为True则扫描一次取信号最强的AP，否则返回None'''
+    try:
+        bssid = wlan.config('bssid')
+        channel = wlan.config('channel')
+        if bssid:
+            return bytes(bssid).hex(),channel
+    except (ValueError,OSError,TypeError,AttributeError):
+        pass
+    if not scan:
+        return None
+    try:
+        best = _best_ap(wlan,ssid)
+    except OSError:
+        return None
+    return (best[1].hex(),best[2]) if best else None
+
+
+def _fast_connect_steps(wlan,ssid,password,timeout_ms,reuse_ip,scan = True):
+    '''wlan_fast_connect的步骤，yield等待的毫秒数，最后返回bool；阻塞版本用sleep_ms驱动，WLANManager用asyncio驱动。
+    scan为False时回退不调用阻塞的wlan.scan()，直接connect(ssid,password)由驱动自己找AP，只轮询状态；
+    连上后用wlan.config('bssid')取得AP写入缓存，移植版本不支持时只在还没有缓存时扫描一次(已连上，先让出一次)，
+    之后就走缓存的快速路径'''
+    stats = CONNECT_STATS
+    stats['attempts'] += 1
+    start = time.ticks_ms()
+    cache = wlan_load_cache(ssid)
+    if cache:
+        if reuse_ip and cache.get('ifconfig'):
+            wlan.ifconfig(tuple(cache['ifconfig']))
+        try:
+            wlan.connect(ssid,password,bssid = bytes.fromhex(cache['bssid']))
+            if (yield from _wait_status(wlan,timeout_ms)):
+                stats['fast_ok'] += 1
+                _record('fast',start)
+                if not reuse_ip:#更新DHCP分到的地址
+                    wlan_save_cache(ssid,cache['bssid'],cache['channel'],wlan.ifconfig())
+                return True
+        except OSError:
+            pass
+        stats['fast_fail'] += 1
+        wlan.disconnect()
+        if reuse_ip:
+            wlan.ifconfig('dhcp')
+    if not scan:
+        try:
+            wlan.connect(ssid,password)
+            ok = yield from _wait_status(wlan,timeout_ms)
+        except OSError:
+            ok = False
+        if not ok:
+            wlan.disconnect()#停止驱动内部的重连，下一次由调用者按退避重试
+            stats['fail'] += 1
+            _record('fail',start)
+            return False
+        stats['plain_ok'] += 1
+        _record('plain',start)
+        if cache is None:
+            yield 0
+        ap = _connected_ap(wlan,ssid,cache is None)
+        if ap is not None:
+            wlan_save_cache(ssid,ap[0],ap[1],wlan.ifconfig())
+        return True
+    #回退：扫描，选信号最强的AP；scan本身是阻塞的，只在阻塞的wlan_fast_connect中使用
+    best = _best_ap(wlan,ssid)
+    if best is None:
+        stats['fail'] += 1
+        _record('fail',start)
+        return False
+    try:
+        wlan.connect(ssid,password,bssid = best[1])
+        ok = yield from _wait_status(wlan,timeout_ms)
+    except OSError:
+        ok = False
+    if not ok:
+        stats['fail'] += 1
+        _record('fail',start)
+        return False
+    stats['scan_ok'] += 1
+    _record('scan',start)
+    wlan_save_cache(ssid,best[1].hex(),best[2],wlan.ifconfig())
+    return True
+
+
+def _drive(steps):
+    '''用time.sleep_ms驱动步骤生成器，返回它的结果'''
+    try:
+        while True:
+            time.sleep_ms(next(steps))
+    except StopIteration as e:
+        return e.value
+
+
+def wlan_fast_connect(ssid,password,timeout_ms = 5000,reuse_ip = False,wlan = None):
+    '''先用缓存的BSSID直接连接，失败再扫描，返回(wlan,bool)
+
+    wlan.connect(ssid,password,bssid = ...)跳过全信道扫描，只等待一次关联，轮询isconnected而不反复connect。
+    reuse_ip为True时直接用缓存的ifconfig，省去DHCP，但租约过期被分给别的设备时会冲突，只在路由器设置了
+    静态分配时使用。MicroPython的STA接口不能指定信道，信道只保存下来用于诊断。
+    CONNECT_STATS中记录每次连接的耗时(last_ms,recent_ms)和走的路径(fast或scan)
+    '''
+    if wlan is None:
+        wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    if wlan.isconnected():
+        return wlan,True
+    return wlan,_drive(_fast_connect_steps(wlan,ssid,password,timeout_ms,reuse_ip))
+
+
+def wlan_connect_stats():
+    '''返回连接耗时统计，recent_ms为最近RECENT_N次的毫秒数'''
+    stats = dict(CONNECT_STATS)
+    recent = stats['recent_ms']
+    stats['avg_ms'] = sum(recent)//len(recent) if recent else None
+    return stats
+
 
 def wlan_do_connected(ssid,password):
     '''
@@ -14,58 +256,29 @@ def wlan_do_connected(ssid,password):
 
     1.对于wifi无法连接的操作，有两种处理方法，一种是直接抛出错误，另一种是采取堵塞的方式，直到wifi正常连接，不然不会处理，
     分别对应派生出的wlan_must_connected(ssid,password)和wlan_wait_connected(ssid,password)
+    2.改用wlan_fast_connect，不再每次先扫描、反复调用connect，上一次连接的BSSID缓存在RTC内存和WLAN_CACHE中
     '''
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if wlan.isconnected():
-        print(f'{ssid} has connected')
-        return wlan,True
-    if not wlan_is_exit(wlan,ssid):
-        print("wlan is not exit")
-        return wlan,False
-    else:                   #尝试连接十次
-        for i in range(10):
-            if wlan.isconnected():
-                print('wifi connected')
-                return wlan,True
-            wlan.connect(ssid,password)
-            time.sleep(1)
-        return wlan,False
+    wlan,ok = wlan_fast_connect(ssid,password)
+    print('wifi connected' if ok else "wifi connected failed")
+    return wlan,ok
     
 def wlan_must_connected(ssid,password):
     '''如果wifi无法连接，则报错'''
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if wlan.isconnected():
-        print(f'{ssid} is connected')
-        return wlan,True
-    if not wlan_is_exit(wlan,ssid):
-        raise ConnectError("wifi connected failed")
-    else:                   #尝试连接十次
-        for i in range(10):
-            if wlan.isconnected():
-                print('wifi connected')
-                return wlan,True
-            wlan.connect(ssid,password)
-            time.sleep(1)
+    wlan,ok = wlan_fast_connect(ssid,password)
+    if not ok:
         raise ConnectError("wifi connected failed")
+    print('wifi connected')
+    return wlan,True
 
-def wlan_wait_connected(ssid,password):
+def wlan_wait_connected(ssid,password,retry_ms = 1000):
     '''阻塞，直到wifi连接'''
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if wlan.isconnected():
-        print(f'{ssid} has connected')
-        return wlan,True
     print("WIFI connecting...")
-    while not wlan.isconnected():
-        try:
-            wlan.connect(ssid,password)
-            time.sleep(1)
-            print('.',end = '')
-        except:
-            pass
-    return wlan,True
+    while True:
+        wlan,ok = wlan_fast_connect(ssid,password)
+        if ok:
+            return wlan,True
+        print('.',end = '')
+        time.sleep_ms(retry_ms)
 
 
 def wlan_is_exit(wlan:network.WLAN,ssid):
@@ -107,6 +320,184 @@ class ConnectError(Exception):
     pass
 
 
+class WLANManager:
+    '''在后台维持STA连接或AP热点的asyncio协程，断线时采样和缓存照常运行
+    example:
+
+    wm = WLANManager(ssid,password,buffer = rb)
+
+    wm.on_up(lambda: client.drainLog(log))#连上时调用，返回协程时创建任务
+
+    wm.start()
+
+    await wm.wait_up()
+
+    STA模式下用wlan_fast_connect的步骤连接(缓存的BSSID优先)，轮询时await而不阻塞事件循环，回退时不扫描，
+    直接connect(ssid,password)后轮询；连上后把AP的BSSID写入缓存(wlan.config('bssid')不支持时，
+    只在第一次、还没有缓存时扫描一次)，下一次重连就走缓存；
+    失败后等待backoff_ms再试，每次翻倍，不超过max_backoff_ms。连上后每check_ms检查一次isconnected，
+    每rssi_ms采样一次信号强度，存入rssi_history，给出buffer(RingBuffer)时同时写入CH_RSSI通道。
+    ap = True时打开热点(ssid,password为热点的名称和密码)，有设备接入时为UP。
+
+    status为DOWN,CONNECTING,UP之一，每次变化时设置changed事件，up和down两个事件与当前状态一致，
+    on_up和on_down注册的回调在状态变化时依次调用。wlan为None时创建network.WLAN，也可以传入已有的接口
+    '''
+    DOWN = 0
+    CONNECTING = 1
+    UP = 2
+    RSSI_N = 32
+
+    def __init__(self,ssid,password = None,ap = False,buffer = None,backoff_ms = 1000,max_backoff_ms = 60000,
+                 check_ms = 1000,rssi_ms = 10000,timeout_ms = 5000,reuse_ip = False,wlan = None):
+        self.ssid = ssid
+        self.password = password
+        self.ap = ap
+        self.buffer = buffer
+        self.backoff_ms = backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.check_ms = check_ms
+        self.rssi_ms = rssi_ms
+        self.timeout_ms = timeout_ms
+        self.reuse_ip = reuse_ip
+        self.wlan = wlan if wlan is not None else network.WLAN(network.AP_IF if ap else network.STA_IF)
+        self.status = WLANManager.DOWN
+        self.up = asyncio.Event()
+        self.down = asyncio.Event()
+        self.down.set()
+        self.changed = asyncio.Event()
+        self._on_up = []
+        self._on_down = []
+        self.rssi = None
+        self.rssi_history = array('b',bytes(WLANManager.RSSI_N))
+        self.rssi_n = 0
+        self.task = None
+        self.stats = {'ups':0,'downs':0,'connect_failures':0,'backoff_ms':0,'last_up_ms':None,'up_ms':0}
+
+    def on_up(self,callback):
+        '''注册连上时的回调，例如让传输层发送积压的数据'''
+        self._on_up.append(callback)
+
+    def on_down(self,callback):
+        self._on_down.append(callback)
+
+    def is_up(self):
+        return self.status == WLANManager.UP
+
+    async def wait_up(self):
+        await self.up.wait()
+
+    async def wait_down(self):
+        await self.down.wait()
+
+    def _set_status(self,status):
+        if status == self.status:
+            return
+        was_up = self.status == WLANManager.UP
+        self.status = status
+        now = time.ticks_ms()
+        stats = self.stats
+        if status == WLANManager.UP:
+            stats['ups'] += 1
+            stats['last_up_ms'] = now
+            self.down.clear()
+            self.up.set()
+            callbacks = self._on_up
+        elif was_up:
+            stats['downs'] += 1
+            stats['up_ms'] += time.ticks_diff(now,stats['last_up_ms'])
+            self.up.clear()
+            self.down.set()
+            callbacks = self._on_down
+        else:
+            callbacks = ()
+        self.changed.set()
+        self.changed = asyncio.Event()#等待者各自持有旧的事件对象
+        for callback in callbacks:
+            try:
+                result = callback()
+                if result is not None and hasattr(result,'send'):#协程
+                    asyncio.create_task(result)
+            except Exception as e:
+                _log.error('callback error %s',e)
+
+    def _sample_rssi(self):
+        try:
+            rssi = self.wlan.status('rssi')
+        except (OSError,ValueError,TypeError):
+            return
+        self.rssi = rssi
+        self.rssi_history[self.rssi_n % WLANManager.RSSI_N] = max(-128,min(127,rssi))
+        self.rssi_n += 1
+        if self.buffer is not None:
+            from _device.ringbuf import CH_RSSI
+            self.buffer.put(CH_RSSI,rssi)
+
+    async def _connect(self):
+        '''用asyncio驱动_fast_connect_steps，连接前不扫描，返回bool'''
+        wlan = self.wlan
+        wlan.active(True)
+        if wlan.isconnected():
+            return True
+        steps = _fast_connect_steps(wlan,self.ssid,self.password,self.timeout_ms,self.reuse_ip,False)
+        try:
+            while True:
+                await asyncio.sleep(next(steps)/1000)
+        except StopIteration as e:
+            return e.value
+        except OSError:
+            return False
+
+    async def _run_sta(self):
+        backoff = self.backoff_ms
+        last_rssi = time.ticks_add(time.ticks_ms(),-self.rssi_ms)
+        while True:
+            if not self.wlan.isconnected():
+                self._set_status(WLANManager.CONNECTING)
+                if not await self._connect():
+                    self.stats['connect_failures'] += 1
+                    self.stats['backoff_ms'] = backoff
+                    self._set_status(WLANManager.DOWN)
+                    await asyncio.sleep(backoff/1000)
+                    backoff = min(backoff*2,self.max_backoff_ms)
+                    continue
+                backoff = self.backoff_ms
+                self._set_status(WLANManager.UP)
+            if self.rssi_ms and time.ticks_diff(time.ticks_ms(),last_rssi) >= self.rssi_ms:
+                last_rssi = time.ticks_ms()
+                self._sample_rssi()
+            await asyncio.sleep(self.check_ms/1000)
+            if not self.wlan.isconnected():
+                self._set_status(WLANManager.DOWN)
+
+    async def _run_ap(self):
+        ap = self.wlan
+        if self.password:
+            ap.config(essid = self.ssid,password = self.password)
+        else:
+            ap.config(essid = self.ssid)
+        while True:
+            if not ap.active():
+                ap.active(True)
+            self._set_status(WLANManager.UP if ap.isconnected() else WLANManager.DOWN)
+            await asyncio.sleep(self.check_ms/1000)
+
+    async def run(self):
+        if self.ap:
+            await self._run_ap()
+        else:
+            await self._run_sta()
+
+    def start(self):
+        '''在当前事件循环中创建后台任务'''
+        self.task = asyncio.create_task(self.run())
+        return self.task
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
 if __name__ == '__main__':
     from _device import wlan_AP_open,UDPClient
     essid = "esp32"
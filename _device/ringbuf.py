@@ -0,0 +1,157 @@
+'''预分配的采样环形缓冲区，传感器(XGZP,VEML7700)向里写，网络和蓝牙(UDPClient,TCPClient,BLESever)从里读
+
+每条记录为(ticks_ms,channel,value)，分别存放在array('i'),array('B'),array('f')中，容量创建时固定，
+运行中不再分配内存。读端通过peek取得连续的memoryview切片直接发送，发送完再consume，不需要拷贝。
+
+example:
+
+    >>> from _device.ringbuf import RingBuffer,CH_PRESSURE,CH_TEMPERATURE
+    >>> rb = RingBuffer(256)
+    >>> p,t = xgzp.getDataBurst()
+    >>> rb.put(CH_PRESSURE,p)
+    >>> rb.put(CH_TEMPERATURE,t)
+    >>> ticks,channels,values = rb.peek()
+    >>> sock.send(values)
+    >>> rb.consume(len(values))
+
+head只由写端修改，tail只由读端修改(OVERWRITE策略在满时例外，写端会推进tail丢弃最旧的记录)，
+因此一个写端(例如micropython.schedule回调)和一个读端(主循环)可以同时使用。
+'''
+from array import array
+import time
+
+# 通道号，各模块共用
+CH_PRESSURE = 0
+CH_TEMPERATURE = 1
+CH_ALS = 2
+CH_WHITE = 3
+CH_LUX = 4
+CH_RSSI = 5 # WLANManager采样的信号强度，dBm
+
+# 记录的二进制格式，用于蓝牙L2CAP批量传输等：uint32 ticks_ms,uint8 channel,float32 value
+RECORD_FMT = '<IBf'
+RECORD_SIZE = 9
+
+
+class RingBuffer:
+    '''RingBuffer(capacity,policy = RingBuffer.OVERWRITE)
+
+    policy为OVERWRITE时，满了覆盖最旧的记录；为BLOCK时，put最多等待timeout_ms，仍然满则丢弃新记录并返回False
+    '''
+    OVERWRITE = 0
+    BLOCK = 1
+
+    def __init__(self,capacity,policy = OVERWRITE):
+        self.capacity = capacity
+        self.policy = policy
+        self.ticks = array('i',bytes(4*capacity))
+        self.channels = array('B',bytes(capacity))
+        self.values = array('f',bytes(4*capacity))
+        self._ticks_mv = memoryview(self.ticks)
+        self._channels_mv = memoryview(self.channels)
+        self._values_mv = memoryview(self.values)
+        # head,tail在[0,2*capacity)内循环，用来区分空和满
+        self.head = 0
+        self.tail = 0
+        # 统计
+        self.written = 0
+        self.high_water = 0
+        self.overwritten = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return (self.head-self.tail) % (2*self.capacity)
+
+    def is_empty(self):
+        return self.head == self.tail
+
+    def is_full(self):
+        return len(self) == self.capacity
+
+    def put(self,channel,value,ticks = None,timeout_ms = 0):
+        '''写入一条记录，ticks缺省为当前time.ticks_ms()，成功返回True'''
+        cap = self.capacity
+        if len(self) == cap:
+            if self.policy == RingBuffer.OVERWRITE:
+                self.tail = (self.tail+1) % (2*cap)
+                self.overwritten += 1
+            elif not self._wait(timeout_ms):
+                self.dropped += 1
+                return False
+        i = self.head % cap
+        self.ticks[i] = time.ticks_ms() if ticks is None else ticks
+        self.channels[i] = channel
+        self.values[i] = value
+        self.head = (self.head+1) % (2*cap)
+        self.written += 1
+        n = len(self)
+        if n > self.high_water:
+            self.high_water = n
+        return True
+
+    def _wait(self,timeout_ms):
+        if timeout_ms <= 0:
+            return False
+        start = time.ticks_ms()
+        while len(self) == self.capacity:
+            if time.ticks_diff(time.ticks_ms(),start) >= timeout_ms:
+                return False
+            time.sleep_ms(1)
+        return True
+
+    def get(self):
+        '''取出最旧的一条记录(ticks,channel,value)，空时返回None'''
+        if self.head == self.tail:
+            return None
+        i = self.tail % self.capacity
+        record = self.ticks[i],self.channels[i],self.values[i]
+        self.tail = (self.tail+1) % (2*self.capacity)
+        return record
+
+    def peek(self,max_n = None):
+        '''返回从最旧记录开始、在底层数组中连续的一段(ticks,channels,values)memoryview，不移动读指针，
+        绕回数组开头的部分需要consume之后再peek一次'''
+        n = len(self)
+        start = self.tail % self.capacity
+        if start+n > self.capacity:
+            n = self.capacity-start
+        if max_n is not None and n > max_n:
+            n = max_n
+        end = start+n
+        return self._ticks_mv[start:end],self._channels_mv[start:end],self._values_mv[start:end]
+
+    def consume(self,n):
+        '''读端处理完peek得到的n条记录后调用，释放空间'''
+        if n > len(self):
+            n = len(self)
+        self.tail = (self.tail+n) % (2*self.capacity)
+        return n
+
+    def first_seq(self):
+        '''缓冲区中最旧一条记录的绝对序号，所有写入的记录从0开始依次编号'''
+        return self.written-len(self)
+
+    def span_from(self,seq,max_n = None):
+        '''不移动读指针，返回从绝对序号seq开始、在底层数组中连续的一段(seq,ticks,channels,values)，
+        seq对应的记录已被覆盖时从最旧的一条开始，用于断点续传'''
+        n = len(self)
+        first = self.written-n
+        if seq < first:
+            seq = first
+        start = (self.tail % self.capacity+seq-first) % self.capacity
+        n = self.written-seq
+        if n < 0:
+            n = 0
+        if start+n > self.capacity:
+            n = self.capacity-start
+        if max_n is not None and n > max_n:
+            n = max_n
+        end = start+n
+        return seq,self._ticks_mv[start:end],self._channels_mv[start:end],self._values_mv[start:end]
+
+    def clear(self):
+        self.tail = self.head
+
+    def stats(self):
+        return {'len':len(self),'capacity':self.capacity,'written':self.written,
+                'high_water':self.high_water,'overwritten':self.overwritten,'dropped':self.dropped}
@@ -0,0 +1,147 @@
+'''按截止时间调度多个传感器的采样，结果写入RingBuffer
+
+每个任务有自己的周期，下一次的截止时间在上一次截止时间上累加周期，而不是在读完之后再sleep，
+所以传输多慢都不会让采样节奏漂移。硬件Timer只负责产生节拍，真正的i2c读取通过micropython.schedule
+推迟到主线程执行，不在中断里做。
+
+example:
+
+    >>> from machine import Pin,SoftI2C
+    >>> from _device import XGZP,VEML7700,RingBuffer
+    >>> from _device.ringbuf import CH_PRESSURE,CH_TEMPERATURE,CH_ALS
+    >>> from _device.scheduler import Sampler
+    >>> i2c = SoftI2C(scl = Pin(18),sda = Pin(19),freq = 400000)
+    >>> xgzp = XGZP(i2c)
+    >>> xgzp.setMode(XGZP.CMD_DORMANT_MOD[0])
+    >>> als = VEML7700(i2c)
+    >>> rb = RingBuffer(512)
+    >>> sampler = Sampler(rb)
+    >>> sampler.add(xgzp.getDataBurst,(CH_PRESSURE,CH_TEMPERATURE),period_ms = 64)
+    >>> sampler.add(als.read_lux,(CH_ALS,),period_ms = 1000)#read_als_out返回两个字节，不能对应一个通道
+    >>> sampler.start()#之后主循环只管从rb里取数据发送
+'''
+import micropython
+import time
+from machine import Timer
+
+
+class SampleTask:
+    '''一个采样任务，func()返回一个值或者与channels一一对应的元组'''
+    def __init__(self,func,channels,period_ms,phase_ms = 0):
+        self.func = func
+        self.channels = channels
+        self.period_ms = period_ms
+        self.phase_ms = phase_ms
+        self.deadline = 0
+        # 统计
+        self.runs = 0
+        self.missed = 0
+        self.errors = 0
+        self.jitter_last = 0
+        self.jitter_max = 0
+        self.jitter_sum = 0
+
+    def run(self,buffer,now,late):
+        '''late为本次执行相对截止时间的延迟(ms)'''
+        period = self.period_ms
+        if late >= period:#错过了整周期，直接跳到下一个未来的截止时间
+            skipped = late//period
+            self.missed += skipped
+            late -= skipped*period
+            self.deadline = time.ticks_add(self.deadline,skipped*period)
+        self.deadline = time.ticks_add(self.deadline,period)
+        try:
+            value = self.func()
+        except OSError:
+            self.errors += 1
+            return
+        self.runs += 1
+        self.jitter_last = late#抖动只统计成功的采样，jitter_mean按runs平均
+        self.jitter_sum += late
+        if late > self.jitter_max:
+            self.jitter_max = late
+        channels = self.channels
+        if len(channels) == 1:
+            buffer.put(channels[0],value,now)
+        else:
+            for i in range(len(channels)):
+                buffer.put(channels[i],value[i],now)
+
+    def stats(self):
+        return {'period_ms':self.period_ms,'runs':self.runs,'missed':self.missed,'errors':self.errors,
+                'jitter_last':self.jitter_last,'jitter_max':self.jitter_max,
+                'jitter_mean':self.jitter_sum/self.runs if self.runs else 0}
+
+
+class Sampler:
+    '''Sampler(buffer,tick_ms = 4,timer_id = 1)
+
+    tick_ms为硬件Timer的节拍，决定调度精度，应不大于最短周期；Timer(0)已被蓝牙的状态灯占用，默认用Timer(1)
+    '''
+    def __init__(self,buffer,tick_ms = 4,timer_id = 1):
+        self.buffer = buffer
+        self.tick_ms = tick_ms
+        self.timer_id = timer_id
+        self.timer = None
+        self.tasks = []
+        self._pending = False
+        self._run_ref = self._run#预先绑定，避免在中断里分配内存
+        self.overruns = 0
+
+    def add(self,func,channels,period_ms,phase_ms = 0):
+        task = SampleTask(func,channels,period_ms,phase_ms)
+        task.deadline = time.ticks_add(time.ticks_ms(),phase_ms)
+        self.tasks.append(task)
+        return task
+
+    def start(self):
+        '''以硬件Timer节拍驱动'''
+        now = time.ticks_ms()
+        for task in self.tasks:
+            task.deadline = time.ticks_add(now,task.phase_ms)
+        self.timer = Timer(self.timer_id)
+        self.timer.init(mode = Timer.PERIODIC,period = self.tick_ms,callback = self._irq)
+
+    def stop(self):
+        if self.timer:
+            self.timer.deinit()
+            self.timer = None
+
+    def _irq(self,timer):
+        if self._pending:#上一次调度还没执行
+            return
+        self._pending = True
+        try:
+            micropython.schedule(self._run_ref,0)
+        except RuntimeError:#调度队列已满
+            self._pending = False
+            self.overruns += 1
+
+    def _run(self,_):
+        self._pending = False
+        self.poll()
+
+    def poll(self):
+        '''执行所有到期的任务，返回距离下一个截止时间的毫秒数；每个任务重新读取ticks_ms，
+        前面的任务读得慢时后面的任务按实际时刻计算延迟和时间戳'''
+        wait = None
+        for task in self.tasks:
+            now = time.ticks_ms()
+            late = time.ticks_diff(now,task.deadline)
+            if late >= 0:
+                task.run(self.buffer,now,late)
+                now = time.ticks_ms()
+            remain = time.ticks_diff(task.deadline,now)
+            if wait is None or remain < wait:
+                wait = remain
+        return wait
+
+    def run_forever(self):
+        '''不使用Timer时的阻塞式调度，按最近的截止时间睡眠'''
+        while True:
+            wait = self.poll()
+            if wait is not None and wait > 0:
+                time.sleep_ms(wait)
+
+    def stats(self):
+        return [task.stats() for task in self.tasks]
@@ -1,6 +1,16 @@
-from _device import wlan_wait_connected
 import socket
 import time
+from array import array
+from _device.wire import FrameEncoder,HEADER_SIZE,RECORD_SIZE
+from _device.log import get_logger
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+_log = get_logger('socket_client')
+
+
 class AbstractClient:
     '''客户端的基类，支持将给定句柄发送到指定端口，infos是一个元组列表
     发送数据的形式为元组列表的元组的关键字形式
@@ -34,15 +44,40 @@ class AbstractClient:
 
         client.begin_sever()
 
+    二进制帧:
+
+    client = UDPClient(obj_address,node_id = 1)
+
+    传入node_id后，infos按序号作为通道号，使用_device.wire的二进制帧发送，handle需要返回数值；
+    不传node_id时仍然发送"name:value\\n"文本。infos中的元组可以带第三项作为handle的参数，(name,handle,args)
+
+    批量发送(需要node_id):
+
+    client.setBatch(max_bytes = 1472,max_latency_ms = 1000)
+
+    之后sends的每个周期只采样不发送，采样攒在一帧里，帧长达到max_bytes(UDP取路径MTU减去IP和UDP头)
+    或第一条采样已等待max_latency_ms时发送，两者先到为准。sends在两次采样之间睡眠时不会越过截止时间，
+    给定times时结束前发送剩下的采样。batch_stats记录包数、记录数和触发发送的原因：
+    flush_full帧满，flush_dt与帧的第一条相差超过65535ms，flush_deadline等待超时，flush_manual调用flush
+
+    压缩(需要node_id):
+
+    client = UDPClient(obj_address,node_id = 1,delta = DeltaEncoder({0:1,1:2}))
+
+    帧改为_device.delta的增量+varint编码(VERSION_DELTA)，主机端decode_frame同样可以解码。
+    批量模式下帧的记录数仍按未压缩的7字节计算，慢变化的值压缩后远小于max_bytes；但压缩帧的上限是
+    每条记录10字节加上通道块头(见delta.max_size)，相邻值跳变很大时一帧可能超过max_bytes，UDP会被分片
     '''
     SEND = 1
     RECV = 2
     SEND_RECV = 3
-    def __init__(self,obj_address,address = None,send_code = 'utf-8',recv_code = 'utf-8') -> None:
+    def __init__(self,obj_address,address = None,send_code = 'utf-8',recv_code = 'utf-8',node_id = None,max_records = 64,delta = None) -> None:
         self.obj_address = obj_address
         self.address = address if address else None
         self.send_code = 'utf-8'
         self.recv_code = 'utf-8'
+        self.encoder = FrameEncoder(node_id,max_records,delta) if node_id is not None else None
+        self.batching = False
 
     def __enter__(self):
         return self
@@ -59,6 +94,135 @@ class AbstractClient:
     def setInfos(self,infos):
         '''infos是一个元组列表,[(name,handle),...]'''
         self.infos = infos
+
+    @staticmethod
+    def callInfo(info):
+        return info[1](*info[2]) if len(info) > 2 else info[1]()
+
+    def encodeInfos(self):
+        '''调用infos中的全部handle，编码成一帧二进制数据或者一段文本'''
+        if self.encoder is None:
+            lines = []
+            for info in self.infos:
+                lines.append(info[0] + ':' + str(AbstractClient.callInfo(info)) + '\n')
+            return ''.join(lines).encode(self.send_code)
+        encoder = self.encoder
+        now = time.ticks_ms()
+        encoder.begin(now)
+        for i in range(len(self.infos)):
+            encoder.add(i,AbstractClient.callInfo(self.infos[i]),now)
+        return encoder.finish()
+
+    def formatRecords(self,ticks,channels,values):
+        '''把一批(ticks,channel,value)记录编码成"channel:value\\n"文本'''
+        lines = []
+        for i in range(len(channels)):
+            lines.append(str(channels[i]) + ':' + str(values[i]) + '\n')
+        return ''.join(lines).encode(self.send_code)
+
+    def write(self,data):
+        '''向obj_address发送一段数据'''
+        pass
+
+    def sendRecords(self,ticks,channels,values):
+        '''发送一批记录，用于BLEGateway等转发缓冲区中的数据，二进制模式下按帧容量分成多帧'''
+        if self.batching:
+            for i in range(len(channels)):
+                self.addSample(channels[i],values[i],ticks[i])
+            self.poll()
+            return
+        if self.encoder is None:
+            self.write(self.formatRecords(ticks,channels,values))
+            return
+        encoder = self.encoder
+        i,n = 0,len(channels)
+        while i < n:
+            encoder.begin(ticks[i])
+            while i < n and encoder.add(channels[i],values[i],ticks[i]):
+                i += 1
+            self.write(encoder.finish())
+
+    def drainLog(self,log,max_records = None):
+        '''恢复连接后把FlashLog中积压的记录成块发送，每块发送成功后提交，返回发送的记录数；
+        发送出错时异常向外抛出，未提交的块下次重发'''
+        total = 0
+        while True:
+            ticks,channels,values = log.read_chunk(max_records)
+            n = len(ticks)
+            if not n:
+                break
+            self.sendRecords(ticks,channels,values)
+            if self.batching:
+                self.flush()
+            log.commit()
+            total += n
+        return total
+
+    def setBatch(self,max_bytes = 1472,max_latency_ms = 1000):
+        '''开启批量发送，max_bytes为一帧的字节数上限，max_latency_ms为一条采样最多等待的时间'''
+        if self.encoder is None:
+            raise ValueError("batching needs binary frames, create the client with node_id")
+        max_records = (max_bytes-HEADER_SIZE)//RECORD_SIZE
+        self.encoder = FrameEncoder(self.encoder.node_id,max_records,self.encoder.delta)
+        self.max_latency_ms = max_latency_ms
+        self.batch_start = 0
+        self.batching = True
+        self.batch_stats = {'packets':0,'records':0,'max_records':0,'flush_full':0,'flush_dt':0,'flush_deadline':0,
+                            'flush_manual':0}
+
+    def addSample(self,channel,value,ticks = None):
+        '''批量模式下追加一条采样，帧满时立即发送'''
+        encoder = self.encoder
+        now = time.ticks_ms() if ticks is None else ticks
+        if encoder.n == 0:
+            encoder.begin(now)
+            self.batch_start = time.ticks_ms()
+        if not encoder.add(channel,value,now):#帧满，或者时间偏移超出uint16
+            self.flush('flush_full' if encoder.n >= encoder.max_records else 'flush_dt')
+            encoder.begin(now)
+            self.batch_start = time.ticks_ms()
+            encoder.add(channel,value,now)
+        if encoder.n >= encoder.max_records:
+            self.flush('flush_full')
+
+    def poll(self):
+        '''第一条采样等待超过max_latency_ms时发送'''
+        if self.encoder.n and time.ticks_diff(time.ticks_ms(),self.batch_start) >= self.max_latency_ms:
+            self.flush('flush_deadline')
+
+    def flush(self,reason = 'flush_manual'):
+        '''发送已攒下的采样'''
+        encoder = self.encoder
+        n = encoder.n
+        if not n:
+            return
+        self.write(encoder.finish())
+        encoder.n = 0
+        stats = self.batch_stats
+        stats['packets'] += 1
+        stats['records'] += n
+        stats[reason] += 1
+        if n > stats['max_records']:
+            stats['max_records'] = n
+
+    def batchSleep(self,time_sleep):
+        '''sends两次采样之间的睡眠。批量模式下有未发送的采样时，先睡到截止时间发送，再睡余下的时间，
+        min(time_sleep,剩余等待时间)，不会因为time_sleep较长而越过max_latency_ms'''
+        ms = int(time_sleep*1000)
+        if self.batching and self.encoder.n:
+            remain = max(0,self.max_latency_ms-time.ticks_diff(time.ticks_ms(),self.batch_start))
+            if remain < ms:
+                time.sleep_ms(remain)
+                self.poll()
+                ms -= remain
+        time.sleep_ms(ms)
+
+    def collect(self):
+        '''批量模式下的一个周期：采样infos并检查是否需要发送'''
+        now = time.ticks_ms()
+        for i in range(len(self.infos)):
+            self.addSample(i,AbstractClient.callInfo(self.infos[i]),now)
+        self.poll()
     
 
    
@@ -102,8 +266,8 @@ class UDPClient(AbstractClient):
 
     udp_client.sends(times=50)
     '''
-    def __init__(self,ojb_address,address = None,send_code = 'utf-8',recv_code = 'utf-8'):
-        super().__init__(ojb_address,address,send_code,recv_code)
+    def __init__(self,ojb_address,address = None,send_code = 'utf-8',recv_code = 'utf-8',node_id = None,max_records = 64,delta = None):
+        super().__init__(ojb_address,address,send_code,recv_code,node_id,max_records,delta)
         self.client = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
     
     def close(self):
@@ -125,25 +289,27 @@ class UDPClient(AbstractClient):
         pass
 
     def sends(self,time_sleep = 1,times = None):
-        print('sends begin:',end='')
+        _log.info('sends begin')
         #发送服务
         if not times:
             while True:
                 self.sendto(self.obj_address)
-                time.sleep(time_sleep)
+                self.batchSleep(time_sleep)
         else:
             for i in range(times):
                 self.sendto(self.obj_address)
-                time.sleep(time_sleep)
+                self.batchSleep(time_sleep)
+            if self.batching:#剩下的采样不再等待截止时间
+                self.flush()
     
+    def write(self,data):
+        return self.client.sendto(data,self.obj_address)
+
     def sendto(self,obj_address):
-        print('.',end='')
-        data = ''
-        for info in self.infos:
-            data_item = info[0] + ':' + str(info[1](*info[2])) + '\n'
-            data_item = data_item.encode(self.send_code)
-            data = data + data_item
-        self.client.sendto(data,obj_address)
+        _log.debug('sendto %s',obj_address)
+        if self.batching:
+            return self.collect()
+        self.client.sendto(self.encodeInfos(),obj_address)
     
 class TCPClient(AbstractClient):
     '''服务基类用于将获取的信息发送到指定端口
@@ -165,8 +331,8 @@ class TCPClient(AbstractClient):
 
     udp_client.sends(times=50)
     '''
-    def __init__(self,ojb_address,address = None,send_code = 'utf-8',recv_code = 'utf-8'):
-        super().__init__(ojb_address,address,send_code,recv_code)
+    def __init__(self,ojb_address,address = None,send_code = 'utf-8',recv_code = 'utf-8',node_id = None,max_records = 64,delta = None):
+        super().__init__(ojb_address,address,send_code,recv_code,node_id,max_records,delta)
         self.client = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
     
     def close(self):
@@ -188,29 +354,31 @@ class TCPClient(AbstractClient):
         pass
 
     def sends(self,time_sleep = 1,times = None):
-        print('sends begin:',end='')
+        _log.info('sends begin')
         #发送服务
         if not times:
             while True:
                 self.send()
-                time.sleep(time_sleep)
+                self.batchSleep(time_sleep)
         else:
             for i in range(times):
                 self.send()
-                time.sleep(time_sleep)
+                self.batchSleep(time_sleep)
+            if self.batching:#剩下的采样不再等待截止时间
+                self.flush()
     
+    def write(self,data):
+        return self.client.send(data)
+
     def send(self):
-        print('.',end='')
-        data = b''
-        for info in self.infos:
-            data_item = info[0] + ':' + str(info[1](*info[2])) + '\n'
-            data_item = data_item.encode(self.send_code)
-            data = data+data_item
-        self.client.send(data)
+        _log.debug('send')
+        if self.batching:
+            return self.collect()
+        self.client.send(self.encodeInfos())
 
     def connect(self,obj_address = None):
         obj_addr = obj_address if obj_address else self.obj_address
-        print("TCP connecting...")
+        _log.info('connecting %s',obj_addr)
         return self.client.connect(obj_addr)
 
 
@@ -220,8 +388,217 @@ class TCPClient(AbstractClient):
 
 
 
+class AsyncTCPClient(AbstractClient):
+    '''基于asyncio流的TCP客户端，网络阻塞或断开时不影响同一事件循环中的采样协程
+    example:
+
+    client = AsyncTCPClient(obj_addr,node_id = 1)
+
+    client.setInfos(infos)
+
+    client.start(period_ms = 1000)#一个协程按周期采样入队，另一个协程负责连接和发送
+
+    asyncio.run(main())#main中运行其他协程
+
+    write(data)只把数据拷贝进发送队列后立即返回。队列为queue_size个预分配的槽，每个槽最多slot_size字节，
+    满时按policy丢弃最旧(DROP_OLDEST)或最新(DROP_NEWEST)的一帧。发送协程每写一帧都等待drain()，
+    对端读得慢时在这里阻塞，超过send_timeout_ms视为断线；断线后按backoff_ms翻倍(不超过max_backoff_ms)重连，
+    未确认写出的那一帧留在队首，重连后重发。stats记录发送、丢弃和重连次数，backoff_ms为上一次重连前等待的时间。
+    队列每次清空时设置self.empty，drainLog等它而不是轮询q_len
+    '''
+    DROP_OLDEST = 0
+    DROP_NEWEST = 1
+
+    def __init__(self,obj_address,node_id = None,max_records = 64,delta = None,queue_size = 16,slot_size = None,
+                 policy = DROP_OLDEST,backoff_ms = 500,max_backoff_ms = 30000,connect_timeout_ms = 5000,send_timeout_ms = 5000):
+        super().__init__(obj_address,None,'utf-8','utf-8',node_id,max_records,delta)
+        if slot_size is None:
+            slot_size = len(self.encoder.buf) if self.encoder else 512
+        self.slot_size = slot_size
+        self.slots = [bytearray(slot_size) for _ in range(queue_size)]
+        self.slot_mvs = [memoryview(slot) for slot in self.slots]
+        self.lens = array('H',bytes(2*queue_size))
+        self.queue_size = queue_size
+        self.q_head = 0
+        self.q_len = 0
+        self.policy = policy
+        self.backoff_ms = backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.connect_timeout_ms = connect_timeout_ms
+        self.send_timeout_ms = send_timeout_ms
+        self.writer = None
+        self.connected = False
+        self.running = False
+        self.tasks = []
+        self.event = asyncio.Event()#有帧入队
+        self.empty = asyncio.Event()#队列已清空
+        self.stats = {'frames':0,'bytes':0,'dropped_oldest':0,'dropped_newest':0,'oversize':0,
+                      'connects':0,'connect_failures':0,'disconnects':0,'queue_high':0,'backoff_ms':backoff_ms}
+
+    def setBatch(self,max_bytes = 1472,max_latency_ms = 1000):
+        '''同AbstractClient.setBatch；先把攒下的采样入队，槽放不下新的一帧时换成更大的槽，
+        已入队的帧按原来的位置拷过去，q_head和q_len不变，发送协程正在等待drain的那一帧照常出队'''
+        if self.batching:
+            self.flush()
+        super().setBatch(max_bytes,max_latency_ms)
+        if len(self.encoder.buf) > self.slot_size:#槽要放得下一整帧
+            self.slot_size = len(self.encoder.buf)
+            slots = [bytearray(self.slot_size) for _ in range(self.queue_size)]
+            for k in range(self.q_len):
+                i = (self.q_head+k) % self.queue_size
+                slots[i][:self.lens[i]] = self.slot_mvs[i][:self.lens[i]]
+            self.slots = slots
+            self.slot_mvs = [memoryview(slot) for slot in slots]
+
+    def write(self,data):
+        '''把一帧拷贝进发送队列，被丢弃时返回False'''
+        n = len(data)
+        stats = self.stats
+        if n > self.slot_size:
+            stats['oversize'] += 1
+            return False
+        if self.q_len == self.queue_size:
+            if self.policy == AsyncTCPClient.DROP_NEWEST:
+                stats['dropped_newest'] += 1
+                return False
+            self.q_head = (self.q_head+1) % self.queue_size
+            self.q_len -= 1
+            stats['dropped_oldest'] += 1
+        i = (self.q_head+self.q_len) % self.queue_size
+        self.slot_mvs[i][:n] = data
+        self.lens[i] = n
+        self.q_len += 1
+        if self.q_len > stats['queue_high']:
+            stats['queue_high'] = self.q_len
+        self.event.set()
+        return True
+
+    def send(self):
+        '''采样一次并入队，不会阻塞'''
+        if self.batching:
+            return self.collect()
+        return self.write(self.encodeInfos())
+
+    async def drainLog(self,log,max_records = None):
+        '''协程版本的drainLog，每块等发送队列清空之后再读，积压的记录不会被队列丢弃'''
+        total = 0
+        while self.running:
+            while self.q_len and self.running:
+                self.empty.clear()
+                await self.empty.wait()
+            if not self.running:
+                break
+            ticks,channels,values = log.read_chunk(max_records)
+            n = len(ticks)
+            if not n:
+                break
+            self.sendRecords(ticks,channels,values)
+            if self.batching:
+                self.flush()
+            log.commit()
+            total += n
+        return total
+
+    async def _connect(self):
+        host,port = self.obj_address[0],self.obj_address[1]
+        _,self.writer = await asyncio.wait_for(asyncio.open_connection(host,port),self.connect_timeout_ms/1000)
+        self.connected = True
+        self.stats['connects'] += 1
+
+    async def _close_writer(self):
+        writer = self.writer
+        self.writer = None
+        self.connected = False
+        if writer is None:
+            return
+        try:
+            writer.close()
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+    async def _drain_queue(self):
+        '''发送队列中的全部帧，每一帧drain成功后才出队'''
+        writer = self.writer
+        timeout = self.send_timeout_ms/1000
+        while self.q_len:
+            i = self.q_head
+            n = self.lens[i]
+            writer.write(self.slot_mvs[i][:n])
+            await asyncio.wait_for(writer.drain(),timeout)
+            if self.q_head == i and self.q_len:#等待期间没有被DROP_OLDEST挤掉
+                self.q_head = (i+1) % self.queue_size
+                self.q_len -= 1
+                if not self.q_len:
+                    self.empty.set()
+            self.stats['frames'] += 1
+            self.stats['bytes'] += n
+
+    async def run(self):
+        '''连接和发送协程，断线自动重连，直到stop()'''
+        backoff = self.backoff_ms
+        self.running = True
+        while self.running:
+            if self.writer is None:
+                try:
+                    await self._connect()
+                    backoff = self.stats['backoff_ms'] = self.backoff_ms
+                except (OSError,asyncio.TimeoutError):
+                    self.stats['connect_failures'] += 1
+                    self.stats['backoff_ms'] = backoff
+                    await asyncio.sleep(backoff/1000)
+                    backoff = min(backoff*2,self.max_backoff_ms)
+                    continue
+            try:
+                await self._drain_queue()
+                self.event.clear()
+                if not self.q_len:
+                    await self.event.wait()
+            except (OSError,asyncio.TimeoutError):
+                self.stats['disconnects'] += 1
+                await self._close_writer()
+        await self._close_writer()
+
+    async def sends(self,period_ms = 1000,times = None):
+        '''采样协程，每period_ms采样一次入队'''
+        start = time.ticks_ms()
+        i = 0
+        while self.running and (not times or i < times):
+            self.send()
+            i += 1
+            start = time.ticks_add(start,period_ms)
+            await asyncio.sleep(max(0,time.ticks_diff(start,time.ticks_ms()))/1000)
+
+    def start(self,period_ms = None):
+        '''在当前事件循环中创建发送协程，给出period_ms时同时创建采样协程'''
+        self.running = True
+        self.tasks = [asyncio.create_task(self.run())]
+        if period_ms:
+            self.tasks.append(asyncio.create_task(self.sends(period_ms)))
+        return self.tasks
+
+    def stop(self):
+        self.running = False
+        self.event.set()
+        self.empty.set()
+        for task in self.tasks[1:]:
+            task.cancel()
+
+    def close(self):
+        self.stop()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            self.connected = False
+
+    def getClient(self):
+        '''获取asyncio的StreamWriter，未连接时为None'''
+        return self.writer
+
+
 
 if __name__ == '__main__':
+    from _device.netConnect import wlan_wait_connected
     #网络连接
     ssid='wawu'
     password='long13044'
@@ -0,0 +1,1017 @@
+'''设备驱动的离线测试，不需要真实的传感器，直接在板子上运行本文件即可
+
+    >>> import _device.test
+    >>> _device.test.run()
+'''
+from _device.xgzp import XGZP,RetryPolicy,I2CReadError
+from _device.xgzp_convert import convert_frames
+from _device.ringbuf import RingBuffer,CH_PRESSURE,CH_TEMPERATURE
+from _device.VEML7700 import VEML7700
+from _device.wire import FrameEncoder,decode_frame,frame_size,SeqTracker,HEADER_SIZE,RECORD_SIZE
+from _device.delta import DeltaEncoder,decode as delta_decode
+from _device.flashlog import FlashLog
+from _device import log as _logmod
+from _device import netConnect as _net
+from _device.netConnect import WLANManager
+from _device.socket_client import UDPClient,AsyncTCPClient
+from _device import scheduler as _sched
+from _device import ble as _ble
+import network
+import os
+import sys
+import time
+try:
+    import asyncio
+except ImportError:
+    import uasyncio as asyncio
+
+
+class FakeI2C:
+    '''模拟i2c总线，寄存器地址自增，并统计总线事务次数'''
+    def __init__(self,regs):
+        self.regs = regs
+        self.transactions = 0
+        self.fail = 0
+
+    def readfrom_mem(self,addr,memaddr,nbytes):
+        buf = bytearray(nbytes)
+        self.readfrom_mem_into(addr,memaddr,buf)
+        return bytes(buf)
+
+    def readfrom_mem_into(self,addr,memaddr,buf):
+        self.transactions += 1
+        if self.fail > 0:
+            self.fail -= 1
+            raise OSError(19)# ENODEV,设备无应答
+        for i in range(len(buf)):
+            buf[i] = self.regs[(addr,memaddr+i)]
+
+    def writeto_mem(self,addr,memaddr,buf):
+        self.transactions += 1
+        for i in range(len(buf)):
+            self.regs[(addr,memaddr+i)] = buf[i]
+
+
+class FakeWordI2C(FakeI2C):
+    '''每个命令码对应一个16位寄存器的i2c设备，如VEML7700'''
+    def readfrom_mem_into(self,addr,memaddr,buf):
+        self.transactions += 1
+        buf[:] = self.regs[(addr,memaddr)][:len(buf)]
+
+    def writeto_mem(self,addr,memaddr,buf):
+        self.transactions += 1
+        self.regs[(addr,memaddr)] = bytes(buf)
+
+
+class FakeVEML7700(FakeWordI2C):
+    '''照度固定的VEML7700，ALS计数按当前config的增益和积分时间换算，并在0xFFFF饱和'''
+    def __init__(self,lux):
+        super().__init__({(VEML7700.Device_ADDR,VEML7700.ALS_CONFIG_0):b'\x00\x00'})
+        self.lux = lux
+
+    def readfrom_mem_into(self,addr,memaddr,buf):
+        if memaddr != VEML7700.ALS:
+            return super().readfrom_mem_into(addr,memaddr,buf)
+        self.transactions += 1
+        word = self.regs[(addr,VEML7700.ALS_CONFIG_0)]
+        config = word[0] | word[1]<<8
+        for gain,it,it_ms,res in VEML7700.RANGE_TABLE:
+            if (gain,it) == (config>>11 & 0b11,config>>6 & 0b1111):
+                counts = min(int(self.lux/res),0xFFFF)
+                buf[0],buf[1] = counts & 0xFF,counts>>8
+                return
+        raise AssertionError(f"config {config:#06x} not in RANGE_TABLE")
+
+
+class FakeWLAN:
+    '''模拟STA接口，ok为True时connect立即连上，否则报告找不到AP；aps为None时不能scan(会阻塞事件循环)，
+    否则scan返回aps，指定bssid的connect只在aps中有这个AP时连上；ap为(bssid,channel)时支持config查询'''
+    def __init__(self,aps = None,ap = None):
+        self.ok = False
+        self.connected = False
+        self.bssids = []
+        self.aps = aps
+        self.ap = ap
+        self.scans = 0
+
+    def active(self,*args):
+        return True
+
+    def isconnected(self):
+        return self.connected
+
+    def status(self,param = None):
+        if param == 'rssi':
+            return -60
+        return 0 if self.connected else getattr(network,'STAT_NO_AP_FOUND',201)
+
+    def connect(self,ssid,password = None,bssid = None):
+        self.bssids.append(bssid)
+        self.connected = self.ok and (bssid is None or self.aps is None or any(info[1] == bssid for info in self.aps))
+
+    def disconnect(self):
+        self.connected = False
+
+    def scan(self):
+        if self.aps is None:
+            raise AssertionError('scan() in the event loop')
+        self.scans += 1
+        return list(self.aps)
+
+    def config(self,name):
+        if self.ap is None or name not in ('bssid','channel'):
+            raise ValueError('unknown config param')
+        return self.ap[0] if name == 'bssid' else self.ap[1]
+
+    def ifconfig(self,*args):
+        return ('192.168.4.2','255.255.255.0','192.168.4.1','192.168.4.1')
+
+
+def _xgzp_regs(p_adc,t_adc):
+    regs = {}
+    raw = (p_adc>>16&0xFF,p_adc>>8&0xFF,p_adc&0xFF,t_adc>>8&0xFF,t_adc&0xFF)
+    for addr,byte in zip(XGZP.ADDR_PT,raw):
+        regs[(XGZP.ADDR,addr)] = byte
+    return regs
+
+
+def test_xgzp_burst():
+    i2c = FakeI2C(_xgzp_regs(0x012345,0x1A40))
+    xgzp = XGZP(i2c)
+    pressure,temperature = xgzp.getDataBurst()
+    assert pressure == 0x012345/XGZP.K[0],pressure
+    assert temperature == 0x1A40/XGZP.K[1],temperature
+    assert i2c.transactions == 1,i2c.transactions
+    assert xgzp.getPressBurst() == pressure
+    assert xgzp.getTempBurst() == temperature
+    assert i2c.transactions == 3,i2c.transactions
+
+
+def test_xgzp_burst_matches_single():
+    i2c = FakeI2C(_xgzp_regs(0x00F00D,0x0C80))
+    xgzp = XGZP(i2c)
+    single = xgzp.getData()
+    assert i2c.transactions == 5,i2c.transactions
+    assert xgzp.getDataBurst() == single
+    assert i2c.transactions == 6,i2c.transactions
+
+
+def test_xgzp_retry():
+    i2c = FakeI2C(_xgzp_regs(0x001000,0x0100))
+    xgzp = XGZP(i2c,RetryPolicy(attempts = 3,backoff_ms = 1,deadline_ms = 50))
+    i2c.fail = 2
+    assert xgzp.getDataBurst() == (1.0,1.0)
+    assert (xgzp.nacks,xgzp.retries,xgzp.failures) == (2,2,0)
+    i2c.fail = 10
+    try:
+        xgzp.getDataBurst()
+        raise AssertionError("I2CReadError expected")
+    except I2CReadError:
+        pass
+    assert (xgzp.nacks,xgzp.retries,xgzp.failures) == (5,4,1)
+    assert i2c.transactions == 6,i2c.transactions
+
+
+def test_convert_frames():
+    # 第一帧为负压-1Pa,-1℃，第二帧为16Pa,25℃
+    frames = bytearray([0xFF,0xF0,0x00,0xFF,0x00,0x01,0x00,0x00,0x19,0x00])
+    press,temp = convert_frames(frames)
+    assert list(press) == [-10,160],press
+    assert list(temp) == [-100,2500],temp
+
+
+def test_ringbuf_wrap():
+    rb = RingBuffer(4)
+    for i in range(6):
+        rb.put(i % 2,i*1.5,ticks = i)
+    assert len(rb) == 4 and rb.overwritten == 2 and rb.high_water == 4
+    ticks,channels,values = rb.peek()
+    assert list(ticks) == [2,3] and list(values) == [3.0,4.5]
+    rb.consume(len(ticks))
+    ticks,channels,values = rb.peek()
+    assert list(ticks) == [4,5] and list(channels) == [0,1]
+    rb.consume(2)
+    assert rb.is_empty() and rb.get() is None
+    block = RingBuffer(1,RingBuffer.BLOCK)
+    assert block.put(0,1.0) and not block.put(0,2.0)
+    assert block.dropped == 1 and block.get()[2] == 1.0
+
+
+def test_veml7700_registers():
+    addr = VEML7700.Device_ADDR
+    i2c = FakeWordI2C({(addr,VEML7700.ALS):b'\x34\xF2',(addr,VEML7700.WHITE):b'\xFF\xFF',
+                       (addr,VEML7700.ALS_INT):b'\x00\x80'})
+    als = VEML7700(i2c)
+    assert als.read_als() == 0xF234
+    assert als.read_als_out() == (0xF2,0x34)
+    assert als.read_als_white() == (0xF234,0xFFFF)
+    assert als.read_ALS_INT() == (1,0)
+    als.set_config(VEML7700.CONF_ARGS['1/4x'],VEML7700.CONF_ARGS['800ms'],'10',0,0)
+    assert i2c.regs[(addr,VEML7700.ALS_CONFIG_0)] == b'\xE0\x18'
+    als.set_config(ALS_SD = 1)#其余字段保持不变
+    assert i2c.regs[(addr,VEML7700.ALS_CONFIG_0)] == b'\xE1\x18'
+    als.set_wh(0xAB,0xCD)
+    assert i2c.regs[(addr,VEML7700.ALS_WH)] == b'\xCD\xAB'
+
+
+def test_veml7700_auto_range():
+    table = VEML7700.RANGE_TABLE
+    als = VEML7700(FakeVEML7700(2000.0))
+    als.set_range(2)#1x,25ms
+    lux = als.read_lux()
+    assert abs(lux-2000.0) < 1,lux#1x不做非线性修正
+    assert als.range_index == 0 and als.range_ready is not None#换到1/8x，但没有等待
+    start = time.ticks_ms()
+    lux = als.read_lux()
+    assert time.ticks_diff(time.ticks_ms(),start) >= 25+25,'旧档位和新档位的积分时间都要等待'
+    assert als.range_ready is None and als.range_index == 0
+    counts = int(2000.0/table[0][3])
+    assert lux == VEML7700.correct_lux(counts*table[0][3]),lux
+    als.i2c.lux = 30000.0#2x,25ms下饱和，当次换档重测
+    als.set_range(3)
+    lux = als.read_lux()
+    assert als.range_index == 0 and lux == VEML7700.correct_lux(int(30000.0/table[0][3])*table[0][3]),lux
+    als.i2c.lux = 3.0#计数过小，逐级换到更灵敏的档位
+    als.read_lux()
+    assert als.range_index is not None and 3.0/table[als.range_index][3] >= VEML7700.AUTO_LOW
+    gain,it = table[als.range_index][:2]
+    assert (als.config>>11 & 0b11,als.config>>6 & 0b1111) == (gain,it)
+
+
+class FakePin:
+    '''代替VEML7700模块中的Pin，记录irq的handler，测试中调用fire()模拟INT引脚拉低'''
+    IN = 0
+    PULL_UP = 1
+    IRQ_FALLING = 2
+
+    def __init__(self,pin,*args):
+        self.pin = pin
+        self.handler = None
+
+    def irq(self,trigger = None,handler = None):
+        self.handler = handler
+
+    def fire(self):
+        self.handler(self)
+
+
+def test_veml7700_events():
+    module = sys.modules['_device.VEML7700']
+    real = module.Pin
+    module.Pin = FakePin
+    try:
+        addr = VEML7700.Device_ADDR
+        i2c = FakeVEML7700(100.0)
+        i2c.regs[(addr,VEML7700.ALS_INT)] = b'\x00\x00'
+        als = VEML7700(i2c)
+        als.set_range(2)
+        events = []
+        als.enable_events(4,lambda *event: events.append(event),window = 0.1,min_span = 10)
+        def window():
+            wh,wl = i2c.regs[(addr,VEML7700.ALS_WH)],i2c.regs[(addr,VEML7700.ALS_WL)]
+            return wl[0] | wl[1]<<8,wh[0] | wh[1]<<8
+        def around(counts):
+            span = max(int(counts*0.1),10)
+            return max(counts-span,0),min(counts+span,0xFFFF)
+        counts = als.read_als()
+        first = window()
+        assert first == around(counts),first
+        assert als.config>>1 & 1,'ALS_INT_EN'
+        pin = als.int_pin
+        assert pin.pin == 4 and pin.handler is not None
+        i2c.lux = 300.0#越过上限
+        i2c.regs[(addr,VEML7700.ALS_INT)] = b'\x00\x80'
+        async def main():
+            pin.fire()
+            return await asyncio.wait_for(als.wait_event(),1)
+        event = asyncio.run(main())
+        counts = als.read_als()
+        assert event == als.last_event == (counts,1,0) and events == [event] and als.events == 1,events
+        assert window() != first and window() == around(counts),'以新的读数为中心重新设置窗口'
+        als.disable_events()
+        assert als.int_pin is None and pin.handler is None and not als.config>>1 & 1
+    finally:
+        module.Pin = real
+
+
+def test_veml7700_plan():
+    addr = VEML7700.Device_ADDR
+    i2c = FakeVEML7700(50.0)
+    als = VEML7700(i2c)
+    plan = als.plan_refresh(1200,resolution = 0.01)
+    #刷新时间不超过1200ms且分辨率不低于0.01lx的只有400ms积分+PSM0
+    assert (plan['psm'],plan['it'],plan['refresh_ms'],plan['resolution']) == (0,0b0010,900,0.0072),plan
+    gain,it,it_ms,res = VEML7700.RANGE_TABLE[als.range_index]
+    assert (gain,it) == (VEML7700.config_ALS_GAIN['2x'],plan['it']),'range_index与计划的增益和积分时间一致'
+    config = i2c.regs[(addr,VEML7700.ALS_CONFIG_0)]
+    assert config[0] | config[1]<<8 == gain<<11 | it<<6
+    psm = i2c.regs[(addr,VEML7700.ALS_PSM)]
+    assert psm[0] == plan['psm']<<1 | 1
+    lux = als.read_lux(auto = False)
+    assert abs(lux-50.0) < res,lux
+    assert i2c.regs[(addr,VEML7700.ALS_CONFIG_0)] == config,'不自动换档时保持计划的配置'
+    try:
+        als.plan_refresh(100)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('没有刷新时间不超过100ms的组合')
+
+
+def test_veml7700_correct_lux():
+    assert VEML7700.correct_lux(0) == 0
+    assert abs(VEML7700.correct_lux(1000)-1074.997) < 0.01
+    assert abs(VEML7700.correct_lux(10)-10.031) < 0.001
+    last = 0
+    for lux in (1,100,1000,10000,100000):#在量程内单调增加
+        value = VEML7700.correct_lux(lux)
+        assert value > last and value >= lux,(lux,value)
+        last = value
+
+
+def test_veml7700_export():
+    import _device.VEML7700#子模块先被导入，本文件开头也已经导入过
+    from _device import VEML7700 as exported
+    assert exported is VEML7700,exported
+
+
+def test_wire_roundtrip():
+    enc = FrameEncoder(node_id = 7,max_records = 2)
+    enc.begin(1000)
+    assert enc.add(0,1.5,1000) and enc.add(3,-2.25,1040)
+    assert not enc.add(1,0.0,1050)#帧已满
+    node_id,seq,base_ticks,records = decode_frame(bytes(enc.finish()))
+    assert (node_id,seq,base_ticks) == (7,0,1000)
+    assert records == [(1000,0,1.5),(1040,3,-2.25)],records
+    enc.begin(2000)
+    assert not enc.add(0,1.0,2000+0x10000)#超过uint16毫秒偏移
+    tracker = SeqTracker()
+    assert tracker.check(7,0) == 0 and tracker.check(7,3) == 2 and tracker.lost == 2
+
+
+class FakeBLE:
+    '''模拟bluetooth.BLE，记录广播、通知和中心设备的操作，不打开射频'''
+    def __init__(self):
+        self.handler = None
+        self.adv = None
+        self.values = {}
+        self.notified = []
+        self.calls = []
+
+    def active(self,*args):
+        return True
+
+    def config(self,*args,**kwargs):
+        return None
+
+    def irq(self,handler):
+        self.handler = handler
+
+    def gap_advertise(self,interval_us,adv_data = None,resp_data = None):
+        self.adv = (bytes(adv_data) if adv_data else b'',bytes(resp_data) if resp_data else b'')
+
+    def gatts_register_services(self,services):
+        handles = []
+        handle = 10
+        for uuid,chars in services:
+            service = []
+            for char in chars:
+                service.append(handle)
+                handle += 3 if char[1] & (_ble.bluetooth.FLAG_NOTIFY | _ble.bluetooth.FLAG_INDICATE) else 2
+            handles.append(tuple(service))
+        return tuple(handles)
+
+    def gatts_write(self,handle,data,send_update = False):
+        self.values[handle] = bytes(data)
+
+    def gatts_read(self,handle):
+        return self.values.get(handle,b'')
+
+    def gatts_notify(self,conn_handle,handle,data = None):
+        self.notified.append((conn_handle,handle,None if data is None else bytes(data)))
+
+    def gap_scan(self,*args):
+        self.calls.append(('gap_scan',))
+
+    def gap_connect(self,addr_type,addr):
+        self.calls.append(('gap_connect',bytes(addr)))
+
+    def gap_disconnect(self,conn_handle):
+        self.calls.append(('gap_disconnect',conn_handle))
+
+    def gattc_discover_services(self,conn_handle):
+        self.calls.append(('gattc_discover_services',conn_handle))
+
+    def gattc_discover_characteristics(self,conn_handle,start,end):
+        self.calls.append(('gattc_discover_characteristics',conn_handle))
+
+    def gattc_write(self,conn_handle,value_handle,data,mode = 0):
+        self.calls.append(('gattc_write',conn_handle,value_handle))
+
+
+class FakeBluetooth:
+    '''代替ble模块中的bluetooth，BLE()返回FakeBLE，其余属性取自真的模块'''
+    def __init__(self,module):
+        self.module = module
+
+    def BLE(self):
+        return FakeBLE()
+
+    def __getattr__(self,name):
+        return getattr(self.module,name)
+
+
+class FakeTimer:
+    PERIODIC = 1
+    ONE_SHOT = 0
+
+    def __init__(self,timer_id = 0):
+        pass
+
+    def init(self,**kwargs):
+        pass
+
+    def deinit(self):
+        pass
+
+
+def _with_fake_ble(func):
+    '''在FakeBLE和FakeTimer下运行func'''
+    real = _ble.bluetooth,_ble.Timer
+    _ble.bluetooth,_ble.Timer = FakeBluetooth(real[0]),FakeTimer
+    try:
+        return func()
+    finally:
+        _ble.bluetooth,_ble.Timer = real
+
+
+def test_ble_stream_reconfigure():
+    def body():
+        IRQ = _ble.IRQ
+        values = [101325.0,25.0]
+        sever = _ble.BLESever('T',[[lambda: values[0],lambda: values[1]]])
+        ble = sever.ble
+        sever._dft_iqr(IRQ.IRQ_CENTRAL_CONNECT,(1,0,bytes(6)))
+        sever._dft_iqr(IRQ.IRQ_MTU_EXCHANGED,(1,100))
+        sever.start_stream(100,batch_latency_ms = 1000)
+        values[0] += 10
+        sever.refresh()
+        assert not ble.notified and any(batch.used for batch in sever.batches.values())
+        sever.start_stream(100)#不再打包，先发出攒下的通知
+        assert not any(batch.used for batch in sever.batches.values())
+        #两个打包的通知，之后start_cache立即刷新一次，按单个值通知
+        assert [data is None for _,_,data in ble.notified] == [False,False,True,True],ble.notified
+        values[0] += 10
+        sever.refresh()#攒下的通知已清空，不会拿None和等待时间比较
+        assert len(ble.notified) == 6 and ble.notified[-1][2] is None,ble.notified
+    _with_fake_ble(body)
+
+
+def test_ble_advertise_service_uuid():
+    def body():
+        for name in ('T','T'*26):#名称太长时服务UUID移到扫描响应
+            sever = _ble.BLESever(name,[[lambda: 1.0,lambda: 2.0]])
+            adv_data,resp_data = sever.ble.adv
+            assert len(adv_data) <= _ble.BaseBLESever.ADV_MAX and len(resp_data) <= _ble.BaseBLESever.ADV_MAX
+            assert b'\x03\x03\x1a\x18' in adv_data+resp_data,(adv_data,resp_data)
+            assert (b'\x03\x03\x1a\x18' in adv_data) == (name == 'T')
+            gateway = _ble.BLEGateway(RingBuffer(8))#默认只按服务UUID识别
+            assert gateway._match(adv_data) or gateway._match(resp_data)
+        assert not gateway._match(b'\x02\x01\x06\x02\x09T')
+    _with_fake_ble(body)
+
+
+def _gateway_attach(gateway,conn_handle,addr,handles = (10,13)):
+    '''模拟连接addr后的服务发现和订阅，handles为压力和温度特性值的句柄'''
+    IRQ = _ble.IRQ
+    gateway._irq(IRQ.IRQ_PERIPHERAL_CONNECT,(conn_handle,0,addr))
+    gateway._irq(IRQ.IRQ_GATTC_SERVICE_RESULT,(conn_handle,1,20,_ble.bluetooth.UUID(0x181A)))
+    gateway._irq(IRQ.IRQ_GATTC_SERVICE_DONE,(conn_handle,0))
+    for handle,uuid in zip(handles,(0x2A6D,0x2A6E)):
+        gateway._irq(IRQ.IRQ_GATTC_CHARACTERISTIC_RESULT,(conn_handle,handle+2,handle,_ble.bluetooth.FLAG_NOTIFY,
+                                                          _ble.bluetooth.UUID(uuid)))
+    gateway._irq(IRQ.IRQ_GATTC_CHARACTERISTIC_DONE,(conn_handle,0))
+    for handle in handles:
+        gateway._irq(IRQ.IRQ_GATTC_WRITE_DONE,(conn_handle,handle+1,0))
+
+
+def test_ble_gateway_notify():
+    def body():
+        IRQ = _ble.IRQ
+        values = [101325.5,25.25]
+        sever = _ble.BLESever('T',[[lambda: values[0],lambda: values[1]]])
+        sever._dft_iqr(IRQ.IRQ_CENTRAL_CONNECT,(1,0,bytes(6)))
+        sever._dft_iqr(IRQ.IRQ_MTU_EXCHANGED,(1,100))
+        sever.start_stream(100,batch_latency_ms = 1000)
+        values[0] += 10
+        sever.refresh()
+        sever.start_stream(100)#发出多采样通知，之后按单个值通知
+        rb = RingBuffer(16)
+        gateway = _ble.BLEGateway(rb)
+        _gateway_attach(gateway,1,b'\x01'*6)
+        notified = sever.ble.notified
+        assert any(data is not None for _,_,data in notified)
+        for _,handle,data in notified:#按CODECS编码的通知在网关解码
+            gateway._irq(IRQ.IRQ_GATTC_NOTIFY,(1,handle,sever.ble.values[handle] if data is None else data))
+        assert gateway.notifications == len(notified) and gateway.decode_errors == 0
+        ticks,channels,values = rb.peek(16)
+        by_channel = {}
+        for channel,value in zip(channels,values):
+            by_channel.setdefault(channel,[]).append(value)
+        assert by_channel == {CH_PRESSURE:[101325.5,101335.5,101335.5],CH_TEMPERATURE:[25.25]*3},by_channel
+        gateway._irq(IRQ.IRQ_GATTC_NOTIFY,(1,10,b'\x00'*4+b'\x00'*5))#多采样通知不完整
+        gateway._irq(IRQ.IRQ_GATTC_NOTIFY,(1,13,b'\x00'*4))#空的多采样通知(温度单个值是2字节)
+        assert gateway.decode_errors == 2 and len(rb) == 6
+    _with_fake_ble(body)
+
+
+def test_ble_gateway_reconnect():
+    def body():
+        IRQ = _ble.IRQ
+        gateway = _ble.BLEGateway(RingBuffer(8),name_prefix = 'X',rescan_ms = 100)
+        ble = gateway.ble
+        adv = bytes([2,0x09,ord('X')])
+        a,b = b'\x01'*6,b'\x02'*6
+        gateway.scan(100)
+        gateway._irq(IRQ.IRQ_SCAN_RESULT,(0,a,0,-50,adv))
+        gateway._irq(IRQ.IRQ_SCAN_RESULT,(0,b,0,-50,adv))
+        gateway._irq(IRQ.IRQ_SCAN_DONE,())
+        assert not gateway.scanning and gateway.connecting == a and ble.calls[-1] == ('gap_connect',a)
+        _gateway_attach(gateway,1,a)
+        assert gateway.connecting == b,'一个外设订阅完成后才连接下一个'
+        _gateway_attach(gateway,2,b)
+        assert not gateway.busy and gateway.nodes[2]['index'] == 1
+        del ble.calls[:]
+        gateway._irq(IRQ.IRQ_PERIPHERAL_DISCONNECT,(1,0,a))
+        assert a in gateway.missing and gateway.scanning and ble.calls == [('gap_scan',)]
+        gateway._irq(IRQ.IRQ_SCAN_RESULT,(0,a,0,-50,adv))
+        gateway._irq(IRQ.IRQ_SCAN_DONE,())
+        _gateway_attach(gateway,3,a)
+        assert gateway.nodes[3]['index'] == 0,'重连后节点序号不变'
+        assert not gateway.missing and gateway.reconnects == 1 and not gateway.busy
+        gateway._irq(IRQ.IRQ_PERIPHERAL_DISCONNECT,(3,0,a))
+        gateway._irq(IRQ.IRQ_SCAN_RESULT,(0,a,0,-50,adv))
+        gateway._irq(IRQ.IRQ_SCAN_DONE,())
+        gateway._irq(IRQ.IRQ_PERIPHERAL_DISCONNECT,(65535,0,a))#连接超时
+        assert not gateway.busy and a in gateway.missing and gateway.scanning,'连接超时后继续扫描'
+        gateway._irq(IRQ.IRQ_PERIPHERAL_CONNECT,(4,0,b'\x03'*6))
+        gateway._irq(IRQ.IRQ_GATTC_SERVICE_DONE,(4,0))#没有环境传感服务
+        gateway._irq(IRQ.IRQ_PERIPHERAL_DISCONNECT,(4,0,b'\x03'*6))
+        assert ble.calls[-1] == ('gap_disconnect',4) and b'\x03'*6 not in gateway.missing
+    _with_fake_ble(body)
+
+
+def test_batching():
+    max_records = 3
+    client = UDPClient(('127.0.0.1',9),node_id = 5)
+    sent = []
+    client.write = lambda data: sent.append((time.ticks_ms(),decode_frame(bytes(data))[3]))#不真的发送
+    try:
+        client.setBatch(max_bytes = HEADER_SIZE+max_records*RECORD_SIZE,max_latency_ms = 1000)
+        client.setInfos([('a',lambda: 1.5)])
+        for i in range(4):
+            client.collect()
+        assert len(sent) == 1 and len(sent[0][1]) == max_records and client.encoder.n == 1
+        client.addSample(0,2.5,(client.encoder.base+0x10000) & 0x3FFFFFFF)#超出uint16毫秒偏移
+        stats = client.batch_stats
+        assert (stats['flush_full'],stats['flush_dt'],len(sent)) == (1,1,2),stats
+        client.flush()
+        client.sends(time_sleep = 0.01,times = 1)#结束时发送剩下的采样
+        assert client.encoder.n == 0 and stats['flush_manual'] == 2 and len(sent) == 4,stats
+        assert stats['records'] == 6 and stats['packets'] == 4
+        client.max_latency_ms = 30
+        start = time.ticks_ms()
+        client.sends(time_sleep = 0.2,times = 2)
+        assert stats['flush_deadline'] == 2 and stats['flush_manual'] == 2,stats
+        assert time.ticks_diff(sent[4][0],start) < 100,'截止时间在time_sleep之前'
+    finally:
+        client.close()
+
+
+class FakeStreamWriter:
+    '''模拟asyncio的StreamWriter，fail次drain抛出OSError'''
+    def __init__(self,fail = 0):
+        self.frames = []
+        self.fail = fail
+        self.closed = False
+
+    def write(self,data):
+        self.frames.append(bytes(data))
+
+    async def drain(self):
+        if self.fail:
+            self.fail -= 1
+            self.frames.pop()
+            raise OSError('reset')
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+def test_async_tcp_queue_policy():
+    for policy,kept,dropped in ((AsyncTCPClient.DROP_OLDEST,[b'2',b'3',b'4'],'dropped_oldest'),
+                                (AsyncTCPClient.DROP_NEWEST,[b'0',b'1',b'2'],'dropped_newest')):
+        client = AsyncTCPClient(('127.0.0.1',9),queue_size = 3,slot_size = 4,policy = policy)
+        results = [client.write(str(i).encode()) for i in range(5)]
+        assert results == ([True]*5 if policy == AsyncTCPClient.DROP_OLDEST else [True]*3+[False]*2)
+        assert client.stats[dropped] == 2 and client.stats['queue_high'] == 3
+        assert not client.write(b'12345') and client.stats['oversize'] == 1
+        writer = FakeStreamWriter()
+        client.writer = writer
+        asyncio.run(client._drain_queue())
+        assert writer.frames == kept and client.q_len == 0 and client.empty.is_set()
+
+
+def test_async_tcp_set_batch():
+    client = AsyncTCPClient(('127.0.0.1',9),node_id = 3,queue_size = 4,slot_size = 4)
+    for i in range(5):
+        client.write(str(i).encode())#q_head不在0，b'0'被挤掉
+    client.setBatch(max_bytes = HEADER_SIZE+4*RECORD_SIZE)#槽变大，已入队的帧保留
+    assert client.slot_size > 4 and client.q_len == 4 and client.stats['dropped_oldest'] == 1
+    client.addSample(0,1.5)
+    client.setBatch(max_bytes = HEADER_SIZE+8*RECORD_SIZE)#攒下的采样先入队，队列满时按policy计数
+    assert client.encoder.n == 0 and client.q_len == 4 and client.stats['dropped_oldest'] == 2
+    writer = FakeStreamWriter()
+    client.writer = writer
+    asyncio.run(client._drain_queue())
+    assert writer.frames[:3] == [b'2',b'3',b'4'],writer.frames
+    assert [(c,v) for _,c,v in decode_frame(writer.frames[3])[3]] == [(0,1.5)]
+
+
+class FakeLog:
+    '''模拟FlashLog，read_chunk依次返回chunks'''
+    def __init__(self,chunks):
+        self.chunks = chunks
+        self.reads = 0
+        self.commits = 0
+
+    def flush(self):
+        pass
+
+    def read_chunk(self,max_records = None):
+        self.reads += 1
+        return self.chunks.pop(0) if self.chunks else ([],[],[])
+
+    def commit(self):
+        self.commits += 1
+
+
+def test_async_tcp_reconnect():
+    client = AsyncTCPClient(('127.0.0.1',9),queue_size = 4,slot_size = 16,backoff_ms = 10,max_backoff_ms = 40)
+    writers = [FakeStreamWriter(fail = 1),FakeStreamWriter()]
+    first,second = writers
+    log = FakeLog([([1,2],[0,1],[1.5,2.5])])
+    waits = []
+    reads = []
+    async def connect():#不用网络，前4次连接失败
+        waits.append(client.stats['backoff_ms'])
+        reads.append(log.reads)
+        if len(waits) <= 4:
+            raise OSError('refused')
+        client.writer = writers.pop(0)
+        client.connected = True
+        client.stats['connects'] += 1
+    client._connect = connect
+    async def main():
+        client.write(b'a')
+        client.write(b'b')
+        tasks = client.start()
+        assert await client.drainLog(log) == 2
+        while client.q_len:
+            await asyncio.sleep(0.005)
+        client.stop()
+        await tasks[0]
+    asyncio.run(main())
+    stats = client.stats
+    assert waits == [10,10,20,40,40,10],waits#退避翻倍到max_backoff_ms，连上后重新开始
+    assert stats['connect_failures'] == 4 and stats['connects'] == 2 and stats['disconnects'] == 1,stats
+    assert first.closed and first.frames == [],'断线时未写出的帧留在队首'
+    assert second.frames == [b'a',b'b',b'0:1.5\n1:2.5\n'],second.frames
+    assert reads == [0]*6 and log.commits == 1,'队列清空之前drainLog不读取积压的记录'
+
+
+class FakeClock:
+    '''代替scheduler模块中的time，ticks_ms由测试推进'''
+    def __init__(self,now = 0):
+        self.now = now
+
+    def ticks_ms(self):
+        return self.now
+
+    def ticks_add(self,a,b):
+        return time.ticks_add(a,b)
+
+    def ticks_diff(self,a,b):
+        return time.ticks_diff(a,b)
+
+
+class FakeBuffer:
+    def __init__(self):
+        self.records = []
+
+    def put(self,channel,value,ticks = None):
+        self.records.append((ticks,channel,value))
+        return True
+
+
+def test_sampler_cadence():
+    clock = FakeClock(1000)
+    real_time = _sched.time
+    _sched.time = clock
+    try:
+        buf = FakeBuffer()
+        sampler = _sched.Sampler(buf)
+        def slow():#读一次用去6ms
+            clock.now += 6
+            return 1.0
+        fast = sampler.add(slow,(0,),period_ms = 10)
+        other = sampler.add(lambda: 2.0,(1,),period_ms = 25,phase_ms = 5)
+        for now in (1000,1003,1013,1021,1030):
+            clock.now = now
+            sampler.poll()
+        #截止时间按周期累加，不随读取延迟漂移
+        assert [t for t,c,_ in buf.records if c == 0] == [1000,1013,1021,1030],buf.records
+        assert fast.deadline == 1040 and fast.runs == 4 and fast.missed == 0
+        assert fast.jitter_max == 3 and fast.jitter_sum == 4,fast.stats()
+        #第二个任务按前一个任务读完之后的时刻计算延迟和时间戳
+        assert [t for t,c,_ in buf.records if c == 1] == [1006,1036],buf.records
+        assert other.jitter_sum == 7 and other.jitter_max == 6 and other.deadline == 1055,other.stats()
+    finally:
+        _sched.time = real_time
+
+
+def test_sampler_overrun():
+    clock = FakeClock(0x3FFFFFF0)#跨过ticks的回绕
+    real_time = _sched.time
+    _sched.time = clock
+    try:
+        buf = FakeBuffer()
+        sampler = _sched.Sampler(buf)
+        fail = [1]
+        def read():
+            if fail[0]:
+                fail[0] -= 1
+                raise OSError(19)
+            return 3.0
+        task = sampler.add(read,(0,),period_ms = 10)
+        sampler.poll()
+        assert task.errors == 1 and task.runs == 0 and task.jitter_sum == 0,'失败的采样不计入抖动'
+        clock.now = time.ticks_add(0x3FFFFFF0,47)#错过3个整周期，晚7ms
+        wait = sampler.poll()
+        assert task.missed == 3 and task.runs == 1 and task.jitter_last == 7,task.stats()
+        assert task.deadline == time.ticks_add(0x3FFFFFF0,50) and wait == 3
+        assert task.stats()['jitter_mean'] == 7
+        saved = _sched.micropython
+        class Full:
+            @staticmethod
+            def schedule(func,arg):
+                raise RuntimeError('schedule queue full')
+        _sched.micropython = Full
+        try:
+            sampler._irq(None)
+            sampler._irq(None)
+        finally:
+            _sched.micropython = saved
+        assert sampler.overruns == 2 and not sampler._pending
+    finally:
+        _sched.time = real_time
+
+
+def test_delta_roundtrip():
+    ticks = [1000,1010,1020,1030,1040,1050,1060,1070,0x3FFFFFF0]
+    channels = [0,1,0,1,0,1,0,1,0]
+    values = [101325.1,25.5,101325.1,25.5,101325.1,25.5,101324.9,-3.25,101325.0]
+    enc = DeltaEncoder(exps = {0:1,1:2})
+    buf = bytearray(enc.max_size(len(values)))
+    end,n = enc.encode(ticks,channels,values,len(values),990,buf,0)
+    assert n == len(values)
+    records = sorted(delta_decode(buf,0,end,990))
+    expect = sorted((ticks[i],channels[i],round(values[i],2)) for i in range(len(values)))
+    assert [(t,c,round(v,2)) for t,c,v in records] == expect,records
+    assert end < len(values)*4,end#重复值按游程编码
+    frames = FrameEncoder(node_id = 2,max_records = 8,delta = enc)
+    frames.begin(1000)
+    for i in range(8):
+        frames.add(channels[i],values[i],ticks[i])
+    data = bytes(frames.finish())
+    assert frame_size(data) == len(data)
+    node_id,seq,base_ticks,records = decode_frame(data)
+    assert (node_id,seq,base_ticks,len(records)) == (2,0,1000,8)
+
+
+def test_delta_bounds():
+    inf = float('inf')
+    values = [1e30,-1e30,inf,-inf,float('nan'),0.0,-1e30,1e30,123.45,3e9]
+    n = len(values)
+    ticks = [(i*0x0FFFFFFF) & 0x3FFFFFFF for i in range(n)]#毫秒差接近TICKS_MASK
+    channels = [i % 3 for i in range(n)]
+    enc = DeltaEncoder(exps = {0:1},rle = False)
+    buf = bytearray(enc.max_size(n))
+    end,k = enc.encode(ticks,channels,values,n,0,buf,0)
+    assert k == n and end <= len(buf) and enc.clamped == 8,(end,k,enc.clamped)
+    got = {(t,c):v for t,c,v in delta_decode(buf,0,end,0)}
+    assert len(got) == n
+    q_max = 0x3FFFFFFF
+    assert got[(ticks[0],0)] == q_max/10 and got[(ticks[1],1)] == -q_max/100
+    assert got[(ticks[4],1)] == -q_max/100,'NaN取上一值'
+    assert abs(got[(ticks[8],2)]-123.45) < 1e-6
+    small = bytearray(24)#只放得下前几条
+    end,k = enc.encode(ticks,channels,values,n,0,small,0)
+    assert 0 < k < n and end <= len(small),(end,k)
+    expect = sorted(delta_decode(buf,0,enc.encode(ticks,channels,values,k,0,buf,0)[0],0))
+    assert sorted(delta_decode(small,0,end,0)) == expect
+
+
+def _remove_tree(path):
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return
+    for name in names:
+        os.remove(path+'/'+name)
+    os.rmdir(path)
+
+
+def test_flashlog():
+    path = '_test_log'#相对于当前目录，板子上就是/_test_log
+    _remove_tree(path)
+    try:
+        log = FlashLog(path,segment_size = 2*4096,max_segments = 3,chunk_records = 100,defer = False)
+        for i in range(log.per_block):
+            log.append(i % 3,float(i),i)
+        assert log.blocks == 0 and log._full and log.wn == 0,'写满的一块等待推迟写入'
+        assert len(log) == log.per_block
+        assert log.drain() == 1 and log.blocks == 1 and log.drain() == 0
+        for i in range(log.per_block,1000):
+            log.append(i % 3,float(i),i)
+        assert log.stalls == 0,log.stalls
+        log.close()
+        log = FlashLog(path,segment_size = 2*4096,max_segments = 3,chunk_records = 100)#重新打开，续读
+        got = []
+        while True:
+            ticks,channels,values = log.read_chunk()
+            if not len(ticks):
+                break
+            got.extend(values)
+            log.commit()
+        assert got == [float(i) for i in range(1000)],len(got)
+        log.close()
+    finally:
+        _remove_tree(path)
+
+
+def test_flashlog_ram_tail():
+    path = '_test_log'
+    _remove_tree(path)
+    try:
+        log = FlashLog(path,segment_size = 2*4096,max_segments = 3,chunk_records = 100,defer = False)
+        def drain(got):
+            while True:
+                ticks,channels,values = log.read_chunk()
+                if not len(ticks):
+                    return
+                got.extend(values)
+                log.commit()
+        got = []
+        for i in range(10):
+            log.append(0,float(i),i)
+        drain(got)
+        assert got == [float(i) for i in range(10)] and log.blocks == 0 and log.partial_blocks == 0,'读写缓冲区，不写flash'
+        assert len(log) == 0
+        for i in range(10,15):
+            log.append(0,float(i),i)
+        ticks,channels,values = log.read_chunk()
+        assert list(values) == [10.0,11.0,12.0,13.0,14.0]
+        for i in range(15,log.per_block+20):#读出之后、提交之前这一块写满并写入flash，其中前10条已经提交
+            log.append(0,float(i),i)
+        assert log.drain() == 1 and log.blocks == 1
+        got.extend(values)
+        log.commit()
+        drain(got)
+        assert got == [float(i) for i in range(log.per_block+20)],got[-3:]
+        for i in range(log.per_block+20,log.per_block+30):
+            log.append(0,float(i),i)
+        log.close()#掉电前写入不满的一块，读指针保存在cursor中
+        log = FlashLog(path,segment_size = 2*4096,max_segments = 3,chunk_records = 100)
+        drain(got)
+        assert got == [float(i) for i in range(log.per_block+30)],'重启后不重复也不丢失'
+        assert not len(log.read_chunk()[0]) and log.partial_blocks == 0
+        log.close()
+    finally:
+        _remove_tree(path)
+
+
+def _with_wlan_cache(func):
+    '''把WLAN_CACHE换成测试文件、RTC内存换成rtc[0]后运行func(rtc)，不动板子上真正的缓存'''
+    real = _net.WLAN_CACHE,_net._rtc_memory
+    rtc = [None]
+    def memory(data = None):
+        if data is None:
+            return rtc[0]
+        rtc[0] = bytes(data)
+        return data
+    _net.WLAN_CACHE,_net._rtc_memory = '_test_wlan.json',memory
+    try:
+        return func(rtc)
+    finally:
+        try:
+            os.remove(_net.WLAN_CACHE)
+        except OSError:
+            pass
+        _net.WLAN_CACHE,_net._rtc_memory = real
+
+
+def test_wlan_fast_connect():
+    def body(rtc):
+        near,far = b'\x01'*6,b'\x02'*6
+        wlan = FakeWLAN(aps = [(b'_test_ssid',far,1,-80,3,0),(b'_test_ssid',near,6,-40,3,0),(b'other',b'\x03'*6,11,-30,3,0)])
+        wlan.ok = True
+        before = dict(_net.CONNECT_STATS)
+        assert _net.wlan_fast_connect('_test_ssid','pw',wlan = wlan)[1]#没有缓存，扫描后连信号最强的AP
+        assert wlan.scans == 1 and wlan.bssids == [near]
+        assert _net._rtc_unpack(rtc[0]) is not None and rtc[0][:4] == _net.RTC_MAGIC
+        assert _net.wlan_load_cache('_test_ssid')['channel'] == 6
+        wlan.disconnect()
+        assert _net.wlan_fast_connect('_test_ssid','pw',wlan = wlan)[1]#缓存命中，不扫描
+        assert wlan.scans == 1 and wlan.bssids == [near,near]
+        wlan.disconnect()
+        wlan.aps = wlan.aps[:1]#缓存的AP不在了
+        assert _net.wlan_fast_connect('_test_ssid','pw',wlan = wlan)[1]
+        assert wlan.scans == 2 and wlan.bssids == [near,near,near,far]
+        assert _net.wlan_load_cache('_test_ssid')['bssid'] == far.hex()
+        stats = _net.wlan_connect_stats()
+        for key,n in (('attempts',3),('scan_ok',2),('fast_ok',1),('fast_fail',1),('fail',0)):
+            assert stats[key]-before[key] == n,(key,stats)
+        assert stats['last_path'] == 'scan' and stats['recent_ms'][-1] == stats['last_ms']
+        assert stats['avg_ms'] is not None
+        rtc[0] = b'\x00'*16#RTC内存被别人写过，回退到文件
+        assert _net.wlan_load_cache('_test_ssid')['bssid'] == far.hex()
+        os.remove(_net.WLAN_CACHE)
+        assert _net.wlan_load_cache('_test_ssid') is None
+        rtc[0] = _net._rtc_pack(b'{"ssid":"_test_ssid"}')[:-1]#长度不对
+        assert _net.wlan_load_cache('_test_ssid') is None
+    _with_wlan_cache(body)
+
+
+def test_wlan_manager():
+    _with_wlan_cache(lambda rtc: _wlan_manager(FakeWLAN(ap = (b'\x01'*6,6))))
+    _with_wlan_cache(lambda rtc: _wlan_manager(FakeWLAN(aps = [(b'_test_ssid',b'\x01'*6,6,-50,3,0)])))
+
+
+def _wlan_manager(wlan):
+    wm = WLANManager('_test_ssid','pw',backoff_ms = 10,max_backoff_ms = 40,check_ms = 5,rssi_ms = 0,
+                     timeout_ms = 50,wlan = wlan)
+    events = []
+    wm.on_up(lambda: events.append('up'))
+    wm.on_down(lambda: events.append('down'))
+    async def main():
+        wm.start()
+        await asyncio.sleep(0.2)#退避10,20,40,40...ms
+        assert not wm.is_up() and 4 <= wm.stats['connect_failures'] <= 8,wm.stats
+        assert wm.stats['backoff_ms'] == 40,wm.stats
+        changed = wm.changed
+        wlan.ok = True
+        await asyncio.wait_for(wm.wait_up(),1)
+        assert changed.is_set() and events == ['up'] and wm.stats['ups'] == 1
+        failures = wm.stats['connect_failures']
+        wlan.ok = False
+        wlan.connected = False#断线
+        await asyncio.wait_for(wm.wait_down(),1)
+        assert events == ['up','down'] and wm.stats['downs'] == 1
+        while wm.stats['connect_failures'] == failures:
+            await asyncio.sleep(0.001)
+        assert wm.stats['backoff_ms'] == 10,'连上后退避重新开始'
+        wm.stop()
+    asyncio.run(main())
+    assert wlan.bssids[0] is None and b'\x01'*6 in wlan.bssids,'连上后保存了BSSID，之后先走缓存'
+    assert _net.wlan_load_cache('_test_ssid')['bssid'] == '01'*6
+    assert wlan.scans <= 1,'不支持config时只扫描一次'
+
+
+def test_log():
+    ring = _logmod.LogRing(4)
+    log = _logmod.Logger('t',_logmod.INFO,ring)
+    log.debug('hidden %s',1)
+    assert len(ring) == 0
+    for i in range(6):
+        log.info('value %s of %s',i,6)
+    lines = []
+    assert _logmod.dump(lines.append,ring = ring) == 4
+    assert lines[0].endswith('I t: value 2 of 6\n') and lines[-1].endswith('value 5 of 6\n'),lines
+    chunks = []
+    _logmod.dump(chunks.append,40,ring)
+    assert all(len(c) <= 40 for c in chunks) and b''.join(chunks).decode() == ''.join(lines)
+
+
+def run():
+    for name,func in sorted(globals().items()):
+        if name.startswith('test_'):
+            func()
+            print(f"{name}: ok")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,170 @@
+'''UDPClient/TCPClient使用的二进制帧格式，设备端编码，主机端(CPython)解码
+
+一帧由帧头和若干条记录组成，全部为小端：
+
+    帧头14字节: uint8 MAGIC, uint8 VERSION, uint16 node_id, uint32 seq, uint32 base_ticks, uint16 记录数
+    记录7字节:  uint8 channel, uint16 相对base_ticks的毫秒数, float32 value
+
+MAGIC取0xF8，UTF-8编码的文本不会以它开头(0xF8~0xFF不出现在合法的UTF-8中)，所以同一端口上的"name:value\n"文本
+即使name是中文也不会被当成帧；接收端还应检查VERSION字节和长度，见host.ingest。
+seq每发一帧加1，接收端据此发现丢帧；一条"name:value\\n"文本约15~25字节，二进制记录为7字节。
+
+VERSION_DELTA(2)的帧头相同，之后是uint16的负载长度，负载为_device.delta的增量+varint编码，
+慢变化的传感器每条记录约2~3字节。
+
+example:
+
+    >>> from _device.wire import FrameEncoder,decode_frame
+    >>> enc = FrameEncoder(node_id = 1)
+    >>> enc.begin(time.ticks_ms())
+    >>> enc.add(0,101325.0,time.ticks_ms())
+    >>> sock.send(enc.finish())
+    主机端:
+    >>> node_id,seq,base_ticks,records = decode_frame(data)
+'''
+from array import array
+import struct
+from _device.delta import decode as delta_decode
+
+MAGIC = 0xF8 # 不是合法的UTF-8字节
+VERSION = 1
+VERSION_DELTA = 2
+HEADER_FMT = '<BBHIIH'
+HEADER_SIZE = 14
+RECORD_FMT = '<BHf'
+RECORD_SIZE = 7
+DELTA_LEN_SIZE = 2 # VERSION_DELTA帧头之后的uint16负载长度
+TICKS_MASK = 0x3FFFFFFF # MicroPython的ticks_ms在2**30处回绕
+
+
+class FrameError(ValueError):
+    pass
+
+
+class FrameEncoder:
+    '''FrameEncoder(node_id,max_records = 64,delta = None)，在预分配的bytearray中用struct.pack_into组帧，可重复使用，
+    delta为_device.delta.DeltaEncoder时发送VERSION_DELTA的压缩帧'''
+    def __init__(self,node_id,max_records = 64,delta = None):
+        self.node_id = node_id
+        self.max_records = max_records
+        self.delta = delta
+        if delta is None:
+            self.buf = bytearray(HEADER_SIZE+max_records*RECORD_SIZE)
+        else:#记录先存入数组，finish时再整体压缩
+            self.buf = bytearray(HEADER_SIZE+DELTA_LEN_SIZE+delta.max_size(max_records))
+            self.ticks = array('i',bytes(4*max_records))
+            self.channels = bytearray(max_records)
+            self.values = array('f',bytes(4*max_records))
+        self.mv = memoryview(self.buf)
+        self.seq = 0
+        self.base = 0
+        self.n = 0
+        self.end = HEADER_SIZE
+
+    def begin(self,base_ticks):
+        '''开始新的一帧，base_ticks一般为第一条记录的ticks_ms'''
+        self.base = base_ticks
+        self.n = 0
+
+    def add(self,channel,value,ticks):
+        '''追加一条记录，帧已满或者与base_ticks相差超过65535ms时返回False，需要另起一帧'''
+        if self.n >= self.max_records:
+            return False
+        dt = (ticks-self.base) & TICKS_MASK
+        if dt > 0xFFFF:
+            return False
+        if self.delta is None:
+            struct.pack_into(RECORD_FMT,self.buf,HEADER_SIZE+self.n*RECORD_SIZE,channel,dt,value)
+        else:
+            self.ticks[self.n] = ticks
+            self.channels[self.n] = channel
+            self.values[self.n] = value
+        self.n += 1
+        return True
+
+    def size(self):
+        '''未压缩时的帧长，压缩帧在finish之后才知道实际长度'''
+        return HEADER_SIZE+self.n*RECORD_SIZE
+
+    def finish(self):
+        '''写入帧头，返回整帧的memoryview，下一次begin之前有效'''
+        if self.delta is None:
+            version,end = VERSION,self.size()
+        else:
+            version = VERSION_DELTA
+            start = HEADER_SIZE+DELTA_LEN_SIZE
+            end,n = self.delta.encode(self.ticks,self.channels,self.values,self.n,self.base,self.buf,start)
+            if n != self.n:#buf按delta.max_size(max_records)分配，不会发生
+                raise FrameError("delta payload overflow")
+            struct.pack_into('<H',self.buf,HEADER_SIZE,end-start)
+        struct.pack_into(HEADER_FMT,self.buf,0,MAGIC,version,self.node_id,self.seq,self.base & TICKS_MASK,self.n)
+        self.seq = (self.seq+1) & 0xFFFFFFFF
+        self.end = end
+        return self.mv[:end]
+
+
+def decode_header(buf,offset = 0):
+    '''返回(version,node_id,seq,base_ticks,n)'''
+    if len(buf)-offset < HEADER_SIZE:
+        raise FrameError("frame too short")
+    magic,version,node_id,seq,base_ticks,n = struct.unpack_from(HEADER_FMT,buf,offset)
+    if magic != MAGIC:
+        raise FrameError(f"bad magic 0x{magic:02X}")
+    return version,node_id,seq,base_ticks,n
+
+
+def decode_frame(buf,offset = 0):
+    '''解码一帧，返回(node_id,seq,base_ticks,[(ticks,channel,value),...])'''
+    version,node_id,seq,base_ticks,n = decode_header(buf,offset)
+    if version == VERSION_DELTA:
+        start = offset+HEADER_SIZE+DELTA_LEN_SIZE
+        end = frame_size(buf,offset)+offset
+        if len(buf) < end:
+            raise FrameError("truncated frame")
+        try:
+            records = delta_decode(buf,start,end,base_ticks)
+        except IndexError:
+            raise FrameError("truncated frame")
+        if len(records) != n:
+            raise FrameError("record count mismatch")
+        return node_id,seq,base_ticks,records
+    if version != VERSION:
+        raise FrameError(f"unsupported version {version}")
+    if len(buf)-offset < HEADER_SIZE+n*RECORD_SIZE:
+        raise FrameError("truncated frame")
+    records = []
+    pos = offset+HEADER_SIZE
+    for _ in range(n):
+        channel,dt,value = struct.unpack_from(RECORD_FMT,buf,pos)
+        records.append(((base_ticks+dt) & TICKS_MASK,channel,value))
+        pos += RECORD_SIZE
+    return node_id,seq,base_ticks,records
+
+
+def frame_size(buf,offset = 0):
+    '''帧的总长度，用于从TCP字节流中切分帧，VERSION_DELTA需要buf中至少有HEADER_SIZE+2字节'''
+    version,_,_,_,n = decode_header(buf,offset)
+    if version == VERSION_DELTA:
+        if len(buf)-offset < HEADER_SIZE+DELTA_LEN_SIZE:
+            raise FrameError("frame too short")
+        return HEADER_SIZE+DELTA_LEN_SIZE+struct.unpack_from('<H',buf,offset+HEADER_SIZE)[0]
+    return HEADER_SIZE+n*RECORD_SIZE
+
+
+class SeqTracker:
+    '''按node_id记录上一帧的seq，统计丢帧'''
+    def __init__(self):
+        self.last = {}
+        self.lost = 0
+
+    def check(self,node_id,seq):
+        '''返回本帧之前丢失的帧数'''
+        last = self.last.get(node_id)
+        self.last[node_id] = seq
+        if last is None:
+            return 0
+        gap = (seq-last-1) & 0xFFFFFFFF
+        if gap >= 0x80000000:#乱序或重复
+            return 0
+        self.lost += gap
+        return gap
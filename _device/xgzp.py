@@ -1,5 +1,26 @@
 from machine import SoftI2C,Pin
 import time
+from _device.xgzp_convert import raw_pressure,raw_temperature,FRAME_SIZE
+from _device.log import get_logger
+
+_log = get_logger('xgzp')
+
+class I2CReadError(OSError):
+    pass
+
+
+class RetryPolicy:
+    '''i2c读取的重试策略:
+    
+    attempts为最多尝试次数，backoff_ms为第一次重试前的等待时间，之后每次翻倍，最多max_backoff_ms，
+    deadline_ms为一次读取允许的总时间
+    '''
+    def __init__(self,attempts = 5,backoff_ms = 1,max_backoff_ms = 20,deadline_ms = 100):
+        self.attempts = attempts
+        self.backoff_ms = backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.deadline_ms = deadline_ms
+
 
 class XGZP:
     '''集成了xgzp的模式设置，数据读取功能
@@ -38,6 +59,12 @@ class XGZP:
     而且猜测应该是SoftI2C的读取数据的问题,采用try.
     2.经过大量测试去掉前面的修改，类运转很正常，问题可以由其他方面引起
     3.发现问题是由于i2c通信时设备不存在所导致，由于这种错误无法避免因而需要加以处理，采用错误丢弃的方法，如果一直错误，则堵塞
+    4.增加突发读取getDataBurst,getPressBurst,getTempBurst，利用寄存器地址自增，一次i2c事务读出0x06~0x0A，
+    数据写入预分配的缓冲区，压力和温度来自同一次转换
+    5.去掉读取失败时的无限循环，改为按RetryPolicy有限次重试(指数退避+截止时间)，用尽后抛出I2CReadError，
+    同时统计nacks,retries,failures和最近一次成功读取的耗时last_latency_us
+    6.补码换算移到xgzp_convert，增加readRawInto只采集原始帧，由convert_frames批量换算成定点数
+    7.每次采样的print改为_device.log的debug记录，默认不输出，需要时set_level(DEBUG)或者dump()
     '''
     #指令集
     ADDR = 0x6D
@@ -53,27 +80,32 @@ class XGZP:
     CMD_DORMANT_MOD = (0x1B,0x2B,0xFB)#对应 63.5ms, 125ms, 1s
     K = [4096, 256]
 
-    def __init__(self,i2c):
+    def __init__(self,i2c,retry = None):
         self.i2c = i2c
+        self.retry = retry if retry else RetryPolicy()
+        # 总线状态统计
+        self.nacks = 0
+        self.retries = 0
+        self.failures = 0
+        self.last_latency_us = 0
+        # 突发读取用的预分配缓冲区，切片视图也预先建立，读取时不再分配内存
+        self._buf = bytearray(5)
+        self._mv = memoryview(self._buf)
+        self._mv_p = self._mv[0:3]
+        self._mv_t = self._mv[3:5]
 
     def __get_pressure(self,buf,_round):
-        p_ADC = 0
-        for i in range(3):
-            p_ADC = p_ADC << 4
-            p_ADC += buf[i]
-        #print(p_ADC,buf[0])
-        pressure = p_ADC/XGZP.K[0] if not buf[0]>>7 else (p_ADC-2^24)/XGZP.K[0]
+        pressure = raw_pressure(buf)/XGZP.K[0]
         if _round is not None:
             pressure = round(pressure,_round)
-        print(f"Data: pressure is {pressure}")
+        _log.debug('pressure %s',pressure)
         return pressure
     
     def __get_temperature(self,buf,_round = None):
-        N = buf[0]*256+buf[1]
-        temperature = N /XGZP.K[1] if N<2^15 else (N-2^16)/XGZP.K[1]
+        temperature = raw_temperature(buf)/XGZP.K[1]
         if _round is not None:
             temperature = round(temperature,_round)
-        print(f"Data: temperature is {temperature}")
+        _log.debug('temperature %s',temperature)
         return temperature
     
     def setI2c(self,i2c):
@@ -88,53 +120,79 @@ class XGZP:
         buf = bytearray([cmd_mode])
         try:
             self.i2c.writeto_mem(XGZP.ADDR,XGZP.ADDR_CMD,buf)
-            print(f"cmd_mode: success to set {cmd_mode}")
+            _log.info('set mode 0x%02X',cmd_mode)
         except:
-            print(f"cmd_mode: fail to set {cmd_mode}")
+            _log.error('fail to set mode 0x%02X',cmd_mode)
             raise
     
     def getData(self,_round = None):
         buf = bytearray(5)
+        mv = memoryview(buf)
         for i in range(5):
-            Flag = True
-            while Flag:
-                try:
-                    buf[i] = ord(self.i2c.readfrom_mem(XGZP.ADDR,XGZP.ADDR_PT[i],1))#此处可能会os错误，可能是设备断触导致的
-                    Flag = False
-                except:
-                    Flag = True
-            #print(f"Collection: XGZP.ADDR_PT[{i}] collection success!:{buf[i]}")
+            self._readInto(XGZP.ADDR_PT[i],mv[i:i+1])#此处可能会os错误，可能是设备断触导致的
         pressure = self.__get_pressure(buf[0:3],_round)
         temperature = self.__get_temperature(buf[3:5],_round)
         return pressure,temperature
 
     def getPress(self,_round = None):
         buf = bytearray(3)
+        mv = memoryview(buf)
         for i in range(3):
-            Flag = True
-            while Flag:
-                try:
-                    buf[i] = ord(self.i2c.readfrom_mem(XGZP.ADDR,XGZP.ADDR_P[i],1))
-                    Flag = False
-                except:
-                    Flag = True
-            #print(f"Collection: XGZP.ADDR_P[{i}] collection success!:{buf[i]}")
+            self._readInto(XGZP.ADDR_P[i],mv[i:i+1])
         pressure = self.__get_pressure(buf,_round)
         return pressure
 
     def getTemp(self,_round = None):
         buf = bytearray(2)
+        mv = memoryview(buf)
         for i in range(2):
-            Flag = True
-            while Flag:
-                try:
-                    buf[i] = ord(self.i2c.readfrom_mem(XGZP.ADDR,XGZP.ADDR_T[i],1))
-                    Flag = False
-                except:
-                    Flag = True
-                #print(f"{XGZP.ADDR_T[i]} collection success!:{buf[i]}")
+            self._readInto(XGZP.ADDR_T[i],mv[i:i+1])
         temperature = self.__get_temperature(buf,_round)
         return temperature
+
+    def _readInto(self,memaddr,buf):
+        '''按self.retry读取寄存器到buf，设备无应答时会引发OSError，计入nacks后退避重试，
+        次数或时间用尽时抛出I2CReadError'''
+        policy = self.retry
+        t0 = time.ticks_us()
+        delay = policy.backoff_ms
+        attempt = 0
+        while True:
+            try:
+                self.i2c.readfrom_mem_into(XGZP.ADDR,memaddr,buf)
+                self.last_latency_us = time.ticks_diff(time.ticks_us(),t0)
+                return buf
+            except OSError:
+                self.nacks += 1
+            attempt += 1
+            if attempt >= policy.attempts or (time.ticks_diff(time.ticks_us(),t0)+999)//1000+delay > policy.deadline_ms:
+                self.failures += 1
+                raise I2CReadError(f"read 0x{memaddr:02X} failed after {attempt} attempts")
+            self.retries += 1
+            time.sleep_ms(delay)
+            delay = min(delay*2,policy.max_backoff_ms)
+
+    def getDataBurst(self,_round = None):
+        '''一次i2c事务读取0x06~0x0A，返回(pressure,temperature)'''
+        self._readInto(XGZP.ADDR_PT[0],self._mv)
+        pressure = self.__get_pressure(self._mv_p,_round)
+        temperature = self.__get_temperature(self._mv_t,_round)
+        return pressure,temperature
+
+    def readRawInto(self,frames,index = 0):
+        '''把一帧5字节原始数据读入frames的第index帧，不做换算，配合xgzp_convert.convert_frames批量处理'''
+        off = index*FRAME_SIZE
+        self._readInto(XGZP.ADDR_PT[0],memoryview(frames)[off:off+FRAME_SIZE])
+
+    def getPressBurst(self,_round = None):
+        '''一次i2c事务读取0x06~0x08'''
+        self._readInto(XGZP.ADDR_P[0],self._mv_p)
+        return self.__get_pressure(self._mv_p,_round)
+
+    def getTempBurst(self,_round = None):
+        '''一次i2c事务读取0x09~0x0A'''
+        self._readInto(XGZP.ADDR_T[0],self._mv_t)
+        return self.__get_temperature(self._mv_t,_round)
     
 
 
@@ -0,0 +1,67 @@
+'''XGZP原始数据的批量转换，只使用整数运算
+
+一帧原始数据为5字节，依次对应寄存器0x06~0x0A：3字节压力ADC(24位补码)和2字节温度ADC(16位补码)。
+采集时只把原始帧存入bytearray/array('B')，攒够一批后调用convert_frames一次性换算成定点数，
+压力单位为1/P_SCALE Pa，温度单位为1/T_SCALE ℃，循环中不分配内存也不打印。
+
+example:
+
+    >>> from array import array
+    >>> from _device.xgzp_convert import convert_frames,FRAME_SIZE
+    >>> frames = bytearray(FRAME_SIZE*64)
+    >>> for i in range(64):
+    ...     xgzp.readRawInto(frames,i)
+    ...     time.sleep_ms(64)
+    >>> press,temp = convert_frames(frames)
+'''
+from array import array
+
+FRAME_SIZE = 5
+K_P = 4096 # 压力系数，与XGZP.K[0]一致
+K_T = 256  # 温度系数，与XGZP.K[1]一致
+P_SCALE = 10  # 压力定点单位0.1Pa
+T_SCALE = 100 # 温度定点单位0.01℃
+
+
+def raw_pressure(buf,offset = 0):
+    '''从buf[offset:offset+3]取出有符号的24位压力ADC值'''
+    adc = (buf[offset]<<16)|(buf[offset+1]<<8)|buf[offset+2]
+    if adc & 0x800000:
+        adc -= 0x1000000
+    return adc
+
+def raw_temperature(buf,offset = 0):
+    '''从buf[offset:offset+2]取出有符号的16位温度ADC值'''
+    adc = (buf[offset]<<8)|buf[offset+1]
+    if adc & 0x8000:
+        adc -= 0x10000
+    return adc
+
+def convert_frames(frames,n = None,press = None,temp = None,k_p = K_P,k_t = K_T):
+    '''把frames中的n帧原始数据换算成定点数，返回(press,temp)
+
+    press,temp可以传入预分配的array('i')重复使用，长度至少为n，不传时新建；
+    结果按四舍五入取整，压力为ADC*P_SCALE/k_p，温度为ADC*T_SCALE/k_t
+    '''
+    if n is None:
+        n = len(frames)//FRAME_SIZE
+    if press is None:
+        press = array('i',bytes(4*n))
+    if temp is None:
+        temp = array('i',bytes(4*n))
+    if len(press) < n or len(temp) < n:
+        raise ValueError("output array too short")
+    p_half = k_p>>1
+    t_half = k_t>>1
+    off = 0
+    for i in range(n):
+        adc = (frames[off]<<16)|(frames[off+1]<<8)|frames[off+2]
+        if adc & 0x800000:
+            adc -= 0x1000000
+        press[i] = (adc*P_SCALE+p_half)//k_p
+        adc = (frames[off+3]<<8)|frames[off+4]
+        if adc & 0x8000:
+            adc -= 0x10000
+        temp[i] = (adc*T_SCALE+t_half)//k_t
+        off += FRAME_SIZE
+    return press,temp
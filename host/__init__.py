@@ -0,0 +1,6 @@
+'''在电脑(CPython)上运行的接收端，与_device中的UDPClient,TCPClient,BLEGateway配套
+
+    python -m host.ingest --port 46545 --out data
+    python -m host.loadgen --nodes 300 --rate 10
+    python -m host.test
+'''
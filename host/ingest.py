@@ -0,0 +1,369 @@
+'''ESP32采样数据的接收服务，asyncio实现，同一端口上同时接收UDP和TCP，同时支持两种格式：
+
+    文本:   "name:value\\n"，UDPClient/TCPClient不传node_id时的格式
+    二进制: _device.wire的帧，VERSION和VERSION_DELTA都可以
+
+数据报以wire.MAGIC开头、第二个字节为VERSION或VERSION_DELTA且长度与帧头一致时按二进制处理，否则按文本处理；
+TCP连接按最初的两个字节决定一次格式。
+解码结果按列(node,seq,ticks,channel,value,recv_time)追加到预分配的NumPy数组，每列一个连续的数组，
+VERSION帧的记录部分直接用np.frombuffer整体转换，不逐条解析。列缓冲区满了或者每隔flush_s秒，
+拼成结构化数组交给后台线程用np.save追加写入当前文件，文件超过rotate_bytes后换新文件：
+
+    out/ingest-20261018-120000-0000.npy ...
+
+一个文件中是若干个连续保存的结构化数组，读取：
+
+    >>> from host.ingest import load
+    >>> data = load('out/ingest-20261018-120000-0000.npy')#按列拼好的结构化数组
+    >>> data['value'][data['channel'] == 0]
+
+文本格式没有node_id和通道号，node取发送端地址的序号，channel按name第一次出现的顺序编号，见Ingest.names。
+
+    python -m host.ingest --port 46545 --out data
+'''
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import time
+
+import numpy as np
+
+from _device.wire import (MAGIC,VERSION,VERSION_DELTA,HEADER_FMT,HEADER_SIZE,RECORD_SIZE,DELTA_LEN_SIZE,TICKS_MASK,
+                          FrameError,decode_frame,frame_size,SeqTracker)
+
+PORT = 46545
+RECORD_DTYPE = np.dtype([('channel','u1'),('dt','<u2'),('value','<f4')])
+COLUMNS = (('node','<u2'),('seq','<u4'),('ticks','<u4'),('channel','u1'),('value','<f4'),('recv_time','<f8'))
+ROW_DTYPE = np.dtype(list(COLUMNS)) # 写入文件的结构化数组
+
+
+class ColumnBuffer:
+    '''ColumnBuffer(capacity)，每个字段一个预分配的连续数组(self.node,self.seq,self.ticks,self.channel,
+    self.value,self.recv_time)，append_*一次追加一批，前n个元素有效'''
+    def __init__(self,capacity = 1 << 16):
+        self.capacity = capacity
+        self.columns = {}
+        for name,dtype in COLUMNS:
+            self.columns[name] = np.zeros(capacity,dtype)
+            setattr(self,name,self.columns[name])
+        self.n = 0
+
+    def room(self):
+        return self.capacity-self.n
+
+    def append_frame(self,node,seq,base_ticks,records,now):
+        '''records为VERSION帧中记录部分的RECORD_DTYPE数组'''
+        i = self.n
+        j = i+len(records)
+        self.node[i:j] = node
+        self.seq[i:j] = seq
+        np.bitwise_and(records['dt'].astype(np.uint32)+np.uint32(base_ticks),TICKS_MASK,out = self.ticks[i:j])
+        self.channel[i:j] = records['channel']
+        self.value[i:j] = records['value']
+        self.recv_time[i:j] = now
+        self.n = j
+
+    def append_rows(self,node,seq,ticks,channels,values,now):
+        i = self.n
+        j = i+len(values)
+        self.node[i:j] = node
+        self.seq[i:j] = seq
+        self.ticks[i:j] = ticks
+        self.channel[i:j] = channels
+        self.value[i:j] = values
+        self.recv_time[i:j] = now
+        self.n = j
+
+    def take(self):
+        '''取出已有的记录，拼成ROW_DTYPE的结构化数组(拷贝)并清空'''
+        rows = np.empty(self.n,ROW_DTYPE)
+        for name,column in self.columns.items():
+            rows[name] = column[:self.n]
+        self.n = 0
+        return rows
+
+
+class RotatingWriter:
+    '''RotatingWriter(directory,prefix = 'ingest',rotate_bytes = 64 MiB)，np.save追加写入，超过rotate_bytes换新文件'''
+    def __init__(self,directory,prefix = 'ingest',rotate_bytes = 64 << 20):
+        self.directory = directory
+        self.prefix = prefix
+        self.rotate_bytes = rotate_bytes
+        self.file = None
+        self.index = 0
+        self.files = 0
+        self.rows = 0
+        os.makedirs(directory,exist_ok = True)
+
+    def _open(self):
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.directory,f"{self.prefix}-{stamp}-{self.index:04d}.npy")
+        self.index += 1
+        self.files += 1
+        self.file = open(path,'wb')
+        self.path = path
+
+    def write(self,rows):
+        if self.file is None or self.file.tell() >= self.rotate_bytes:
+            self.close()
+            self._open()
+        np.save(self.file,rows,allow_pickle = False)
+        self.file.flush()
+        self.rows += len(rows)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def load(path):
+    '''读出RotatingWriter写的一个文件，拼成一个结构化数组'''
+    chunks = []
+    with open(path,'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            chunks.append(np.load(f,allow_pickle = False))
+    return np.concatenate(chunks) if chunks else np.zeros(0,ROW_DTYPE)
+
+
+class Ingest:
+    '''Ingest(writer = None,capacity = 1 << 16,flush_s = 1.0)，解码、统计并交给RotatingWriter写文件；
+    writer为None时只统计，不写文件(测量接收能力时使用)'''
+    def __init__(self,writer = None,capacity = 1 << 16,flush_s = 1.0):
+        self.writer = writer
+        self.buffer = ColumnBuffer(capacity)
+        self.flush_s = flush_s
+        self.seq = SeqTracker()
+        self.names = {}#文本格式的name -> 通道号
+        self.text_nodes = {}#文本格式的发送端地址 -> node
+        self.nodes = set()
+        self.stats = {'frames':0,'records':0,'bytes':0,'text_lines':0,'bad':0,'lost':0,'flushes':0,'write_s':0.0}
+        self._pending = []
+        self._writing = None
+
+    # 解码
+    def feed_frame(self,data,now = None):
+        '''解码一个完整的二进制帧'''
+        now = time.time() if now is None else now
+        stats = self.stats
+        try:
+            magic,version,node,seq,base_ticks,n = struct.unpack_from(HEADER_FMT,data,0)
+            if magic != MAGIC:
+                raise FrameError(f"bad magic 0x{magic:02X}")
+            if n > self.buffer.capacity:
+                raise FrameError("frame larger than the column buffer")
+            if self.buffer.room() < n:
+                self.flush()
+            if version == VERSION:
+                if len(data) < HEADER_SIZE+n*RECORD_SIZE:
+                    raise FrameError("truncated frame")
+                records = np.frombuffer(data,RECORD_DTYPE,n,HEADER_SIZE)
+                self.buffer.append_frame(node,seq,base_ticks,records,now)
+            elif version == VERSION_DELTA:
+                _,_,_,records = decode_frame(data)
+                if records:
+                    ticks,channels,values = zip(*records)
+                    self.buffer.append_rows(node,seq,ticks,channels,values,now)
+            else:
+                raise FrameError(f"unsupported version {version}")
+        except (FrameError,struct.error,ValueError):
+            stats['bad'] += 1
+            return
+        stats['frames'] += 1
+        stats['records'] += n
+        stats['bytes'] += len(data)
+        stats['lost'] += self.seq.check(node,seq)
+        self.nodes.add(node)
+
+    def feed_text(self,data,peer,now = None):
+        '''解码一段"name:value\\n"文本，最后不完整的一行原样返回'''
+        now = time.time() if now is None else now
+        node = self.text_nodes.get(peer)
+        if node is None:
+            node = self.text_nodes[peer] = 0x8000+len(self.text_nodes)#与二进制节点的node_id区分
+            self.nodes.add(node)
+        lines = data.split(b'\n')
+        rest = lines.pop()
+        channels = []
+        values = []
+        for line in lines:
+            name,sep,value = line.partition(b':')
+            if not sep:
+                self.stats['bad'] += 1
+                continue
+            try:
+                value = float(value)
+            except ValueError:
+                self.stats['bad'] += 1
+                continue
+            ch = self.names.get(name)
+            if ch is None:
+                ch = self.names[name] = len(self.names) & 0xFF
+            channels.append(ch)
+            values.append(value)
+        n = len(values)
+        if n:
+            if self.buffer.room() < n:
+                self.flush()
+            self.buffer.append_rows(node,0,int(now*1000) & TICKS_MASK,channels,values,now)
+        self.stats['text_lines'] += n
+        self.stats['records'] += n
+        self.stats['bytes'] += len(data)-len(rest)
+        return rest
+
+    # 写文件
+    def flush(self):
+        '''把列缓冲区交给后台线程写入，不阻塞事件循环'''
+        if not self.buffer.n:
+            return
+        rows = self.buffer.take()
+        self.stats['flushes'] += 1
+        if self.writer is None:
+            return
+        self._pending.append(rows)
+        if self._writing is None or self._writing.done():
+            self._writing = asyncio.get_running_loop().run_in_executor(None,self._write_pending)
+
+    def _write_pending(self):
+        start = time.perf_counter()
+        while self._pending:
+            self.writer.write(self._pending.pop(0))
+        self.stats['write_s'] += time.perf_counter()-start
+
+    async def flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_s)
+            self.flush()
+
+    async def close(self):
+        self.flush()
+        if self._writing is not None:
+            await self._writing
+        if self._pending:
+            self._write_pending()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def is_frame(data):
+    '''data是一个完整的wire帧时返回True：MAGIC，已知的VERSION，长度与帧头一致'''
+    if len(data) < HEADER_SIZE or data[0] != MAGIC or data[1] not in (VERSION,VERSION_DELTA):
+        return False
+    try:
+        return frame_size(data) == len(data)
+    except FrameError:
+        return False
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self,ingest):
+        self.ingest = ingest
+
+    def datagram_received(self,data,addr):
+        if not data:#空数据报
+            return
+        if is_frame(data):
+            self.ingest.feed_frame(data)
+        else:
+            self.ingest.feed_text(data if data.endswith(b'\n') else data+b'\n',addr)
+
+
+async def _handle_tcp(ingest,reader,writer):
+    '''一个TCP连接：最初的MAGIC和VERSION决定格式，二进制按frame_size从字节流中切帧'''
+    peer = writer.get_extra_info('peername')
+    buf = bytearray()
+    binary = None
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            buf += data
+            if binary is None:
+                if len(buf) < 2:
+                    continue
+                binary = buf[0] == MAGIC and buf[1] in (VERSION,VERSION_DELTA)
+            if binary:
+                pos = 0
+                while len(buf)-pos >= HEADER_SIZE:
+                    if buf[pos+1] == VERSION_DELTA and len(buf)-pos < HEADER_SIZE+DELTA_LEN_SIZE:
+                        break
+                    try:
+                        size = frame_size(buf,pos)
+                    except FrameError:#失去同步，丢弃这个连接
+                        ingest.stats['bad'] += 1
+                        return
+                    if len(buf)-pos < size:
+                        break
+                    ingest.feed_frame(bytes(buf[pos:pos+size]))
+                    pos += size
+                del buf[:pos]
+            else:
+                buf = bytearray(ingest.feed_text(bytes(buf),peer))
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(ingest,host = '0.0.0.0',port = PORT,udp = True,tcp = True,rcvbuf = 4 << 20):
+    '''启动UDP和TCP服务，返回(udp_transport,tcp_server)；rcvbuf为UDP的接收缓冲区，
+    事件循环偶尔被写文件等占用时，突发的数据报先排在内核里而不是被丢弃'''
+    loop = asyncio.get_running_loop()
+    transport = server = None
+    if udp:
+        transport,_ = await loop.create_datagram_endpoint(lambda: _UDPProtocol(ingest),local_addr = (host,port))
+        if rcvbuf:
+            transport.get_extra_info('socket').setsockopt(socket.SOL_SOCKET,socket.SO_RCVBUF,rcvbuf)
+    if tcp:
+        server = await asyncio.start_server(lambda r,w: _handle_tcp(ingest,r,w),host,port)
+    return transport,server
+
+
+async def report(ingest,interval_s = 5.0):
+    '''每interval_s秒打印一次接收速率'''
+    last = dict(ingest.stats)
+    while True:
+        await asyncio.sleep(interval_s)
+        stats = ingest.stats
+        rate = (stats['records']-last['records'])/interval_s
+        frames = (stats['frames']-last['frames'])/interval_s
+        print(f"nodes {len(ingest.nodes)}  {rate:.0f} records/s  {frames:.0f} frames/s  "
+              f"lost {stats['lost']}  bad {stats['bad']}  write {stats['write_s']:.2f}s")
+        last = dict(stats)
+
+
+async def main(args):
+    writer = RotatingWriter(args.out,rotate_bytes = args.rotate_mb << 20) if args.out else None
+    ingest = Ingest(writer,flush_s = args.flush_s)
+    transport,server = await serve(ingest,args.host,args.port,not args.no_udp,not args.no_tcp)
+    tasks = [asyncio.create_task(ingest.flusher()),asyncio.create_task(report(ingest,args.report_s))]
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if transport is not None:
+            transport.close()
+        if server is not None:
+            server.close()
+        await ingest.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'ESP32 sample ingest server')
+    parser.add_argument('--host',default = '0.0.0.0')
+    parser.add_argument('--port',type = int,default = PORT)
+    parser.add_argument('--out',default = 'data',help = '输出目录，为空时不写文件')
+    parser.add_argument('--rotate-mb',type = int,default = 64)
+    parser.add_argument('--flush-s',type = float,default = 1.0)
+    parser.add_argument('--report-s',type = float,default = 5.0)
+    parser.add_argument('--no-udp',action = 'store_true')
+    parser.add_argument('--no-tcp',action = 'store_true')
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
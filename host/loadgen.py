@@ -0,0 +1,169 @@
+'''模拟大量ESP32节点向host.ingest发送数据，用于测量一个接收端能承受多少设备
+
+每个节点一个socket，按rate(帧/秒)发送，每帧records条记录，格式与_device.socket_client相同。
+--local时在同一进程中启动Ingest(不写文件，除非给出--out)，结束后对比发送和接收的记录数：
+
+    python -m host.loadgen --nodes 300 --rate 10 --records 8 --local
+    python -m host.loadgen --nodes 300 --proto tcp --host 192.168.1.10
+
+--sweep时从--nodes开始每轮节点数翻倍，直到接收率低于--min-ratio，报告最后一个达标的节点数。
+--local时发送端和接收端共用一个事件循环和CPU核，得到的是下限；要测接收端本身，在另一台机器或另一个进程中运行。
+
+UDP接收缓冲区的影响(--rcvbuf 0为系统缺省的net.core.rmem_default，缺省为serve的4 MiB)，--seed固定各节点的相位和发送时刻：
+
+    python -m host.loadgen --nodes 250 --rate 20 --records 8 --local --seed 1 --rcvbuf 0
+    python -m host.loadgen --nodes 250 --rate 20 --records 8 --local --seed 1
+    python -m host.loadgen --nodes 200 --rate 10 --records 8 --local --seed 1
+
+接收率取决于CPU和内核参数(SO_RCVBUF不超过net.core.rmem_max)，事件循环跟得上时两者都是100%；
+系统缺省的缓冲区只能容纳几百个数据报，写文件等偶尔占住事件循环时先丢的是它。
+'''
+import argparse
+import asyncio
+import math
+import random
+import time
+
+from _device.wire import FrameEncoder,TICKS_MASK
+from _device.delta import DeltaEncoder
+from host.ingest import Ingest,RotatingWriter,serve,PORT
+
+
+class Node:
+    '''一个模拟节点，产生缓慢变化的压力和温度'''
+    def __init__(self,node_id,records,text = False,delta = False):
+        self.node_id = node_id
+        self.records = records
+        self.text = text
+        self.encoder = FrameEncoder(node_id,records,DeltaEncoder({0:1,1:2}) if delta else None)
+        self.phase = random.random()*6.28
+        self.sent = 0
+
+    def frame(self,now_ms):
+        '''生成一帧，records条记录在压力和温度两个通道间交替'''
+        if self.text:
+            lines = []
+            for i in range(self.records):
+                value = self._value(i & 1,now_ms)
+                lines.append(('pressure' if i & 1 == 0 else 'temperature')+':'+str(value)+'\n')
+            self.sent += self.records
+            return ''.join(lines).encode()
+        enc = self.encoder
+        enc.begin(now_ms & TICKS_MASK)
+        for i in range(self.records):
+            enc.add(i & 1,self._value(i & 1,now_ms),(now_ms+i) & TICKS_MASK)
+        self.sent += self.records
+        return bytes(enc.finish())
+
+    def _value(self,channel,now_ms):
+        if channel == 0:
+            return round(101325.0+50*math.sin(self.phase+now_ms/10000),1)
+        return round(25.0+math.sin(self.phase+now_ms/60000),2)
+
+
+async def _run_udp(node,host,port,rate,until):
+    loop = asyncio.get_running_loop()
+    transport,_ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol,remote_addr = (host,port))
+    try:
+        await _pace(node,rate,until,transport.sendto)
+    finally:
+        transport.close()
+
+
+async def _run_tcp(node,host,port,rate,until):
+    _,writer = await asyncio.open_connection(host,port)
+    async def send(data):
+        writer.write(data)
+        await writer.drain()
+    try:
+        await _pace(node,rate,until,send)
+    finally:
+        writer.close()
+
+
+async def _pace(node,rate,until,send):
+    period = 1/rate
+    next_t = time.monotonic()+random.random()*period#错开各节点的发送时刻
+    while True:
+        now = time.monotonic()
+        if now >= until:
+            return
+        if next_t > now:
+            await asyncio.sleep(next_t-now)
+        result = send(node.frame(int(time.time()*1000)))
+        if result is not None:
+            await result
+        next_t += period
+
+
+async def run_load(args,nodes_n):
+    '''以nodes_n个节点运行duration秒，返回(发送的记录数,接收的记录数或None)'''
+    ingest = transport = server = None
+    if args.local:
+        writer = RotatingWriter(args.out) if args.out else None
+        ingest = Ingest(writer)
+        transport,server = await serve(ingest,args.host,args.port,args.proto == 'udp',args.proto == 'tcp',args.rcvbuf)
+        flusher = asyncio.create_task(ingest.flusher())
+    nodes = [Node(i,args.records,args.text,args.delta) for i in range(nodes_n)]
+    until = time.monotonic()+args.duration
+    run = _run_udp if args.proto == 'udp' else _run_tcp
+    start = time.perf_counter()
+    await asyncio.gather(*(run(node,args.host,args.port,args.rate,until) for node in nodes))
+    elapsed = time.perf_counter()-start
+    sent = sum(node.sent for node in nodes)
+    received = None
+    if ingest is not None:
+        await asyncio.sleep(0.5)#等待最后的数据报
+        flusher.cancel()
+        if transport is not None:
+            transport.close()
+        if server is not None:
+            server.close()
+        await ingest.close()
+        received = ingest.stats['records']
+    rate = sent/elapsed
+    line = f"nodes {nodes_n}  sent {sent} records ({rate:.0f}/s)"
+    if received is not None:
+        line += f"  received {received} ({received/max(sent,1):.1%})  lost frames {ingest.stats['lost']}"
+    print(line)
+    return sent,received
+
+
+async def main(args):
+    if args.seed is not None:
+        random.seed(args.seed)
+    if not args.sweep:
+        await run_load(args,args.nodes)
+        return
+    if not args.local:
+        raise SystemExit("--sweep needs --local to count received records")
+    best = 0
+    nodes_n = args.nodes
+    while nodes_n <= args.max_nodes:
+        sent,received = await run_load(args,nodes_n)
+        if received < sent*args.min_ratio:
+            break
+        best = nodes_n
+        nodes_n *= 2
+    print(f"max nodes at >= {args.min_ratio:.0%} delivery: {best}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'simulate many ESP32 nodes sending to host.ingest')
+    parser.add_argument('--host',default = '127.0.0.1')
+    parser.add_argument('--port',type = int,default = PORT)
+    parser.add_argument('--proto',choices = ('udp','tcp'),default = 'udp')
+    parser.add_argument('--nodes',type = int,default = 100)
+    parser.add_argument('--rate',type = float,default = 10.0,help = '每个节点每秒的帧数')
+    parser.add_argument('--records',type = int,default = 8,help = '每帧的记录数')
+    parser.add_argument('--duration',type = float,default = 10.0)
+    parser.add_argument('--text',action = 'store_true',help = '发送"name:value\\n"文本')
+    parser.add_argument('--delta',action = 'store_true',help = '发送VERSION_DELTA压缩帧')
+    parser.add_argument('--local',action = 'store_true',help = '在本进程中启动Ingest')
+    parser.add_argument('--out',default = None,help = '--local时的输出目录，缺省不写文件')
+    parser.add_argument('--rcvbuf',type = int,default = 4 << 20,help = '--local时UDP的接收缓冲区字节数，0为系统缺省值')
+    parser.add_argument('--seed',type = int,default = None,help = '各节点发送时刻和相位的随机种子')
+    parser.add_argument('--sweep',action = 'store_true')
+    parser.add_argument('--max-nodes',type = int,default = 10000)
+    parser.add_argument('--min-ratio',type = float,default = 0.99)
+    asyncio.run(main(parser.parse_args()))
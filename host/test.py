@@ -0,0 +1,177 @@
+'''host的离线测试，用_device.wire.FrameEncoder组帧，不需要网络，在电脑上运行：
+
+    python -m host.test
+'''
+import asyncio
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from _device.wire import FrameEncoder,MAGIC,HEADER_SIZE,RECORD_SIZE,TICKS_MASK
+from _device.delta import DeltaEncoder
+from host.ingest import Ingest,ColumnBuffer,RotatingWriter,load,ROW_DTYPE,_UDPProtocol,_handle_tcp,is_frame
+
+
+def _records(base,n):
+    '''n条记录(ticks,channel,value)，两个通道交替'''
+    return [((base+i*5) & TICKS_MASK,i & 1,round(101325.0+i*0.5,1) if i & 1 == 0 else round(25.0+i*0.01,2))
+            for i in range(n)]
+
+
+def _frame(enc,base,records):
+    enc.begin(base)
+    for ticks,channel,value in records:
+        assert enc.add(channel,value,ticks)
+    return bytes(enc.finish())
+
+
+def _check_rows(buf,start,node,seq,records,now):
+    n = len(records)
+    assert list(buf.node[start:start+n]) == [node]*n
+    assert list(buf.seq[start:start+n]) == [seq]*n
+    assert list(buf.ticks[start:start+n]) == [t for t,_,_ in records]
+    assert list(buf.channel[start:start+n]) == [c for _,c,_ in records]
+    assert np.allclose(buf.value[start:start+n],[v for _,_,v in records])
+    assert list(buf.recv_time[start:start+n]) == [now]*n
+
+
+def test_column_buffer():
+    buf = ColumnBuffer(8)
+    for name,dtype in (('node','<u2'),('ticks','<u4'),('value','<f4'),('recv_time','<f8')):
+        column = getattr(buf,name)
+        assert column.dtype == np.dtype(dtype) and column.flags['C_CONTIGUOUS'] and len(column) == 8
+    buf.append_rows(3,1,[10,20],[0,1],[1.5,2.5],100.0)
+    rows = buf.take()
+    assert buf.n == 0 and rows.dtype == ROW_DTYPE
+    assert list(rows['ticks']) == [10,20] and list(rows['value']) == [1.5,2.5]
+
+
+def test_feed_frame():
+    ingest = Ingest(capacity = 64)
+    enc = FrameEncoder(7,16)
+    base = TICKS_MASK-10#dt加上base后在2**30处回绕
+    first = _records(base,5)
+    ingest.feed_frame(_frame(enc,base,first),now = 1.0)
+    _check_rows(ingest.buffer,0,7,0,first,1.0)
+    enc.seq = 3#丢了两帧
+    second = _records(1000,4)
+    ingest.feed_frame(_frame(enc,1000,second),now = 2.0)
+    _check_rows(ingest.buffer,5,7,3,second,2.0)
+    delta = FrameEncoder(8,16,DeltaEncoder({0:1,1:2}))
+    third = _records(5000,6)
+    ingest.feed_frame(_frame(delta,5000,third),now = 3.0)
+    third.sort(key = lambda r: r[1])#增量帧按通道分组解码
+    _check_rows(ingest.buffer,9,8,0,third,3.0)
+    stats = ingest.stats
+    assert stats['frames'] == 3 and stats['records'] == 15 and stats['lost'] == 2 and stats['bad'] == 0,stats
+    assert ingest.nodes == {7,8}
+    data = _frame(enc,0,_records(0,3))
+    ingest.feed_frame(data[:-1])#截断
+    ingest.feed_frame(bytes([MAGIC,1]))#帧头不完整
+    assert stats['bad'] == 2 and ingest.buffer.n == 15
+
+
+def test_feed_frame_flush():
+    ingest = Ingest(capacity = 8)
+    enc = FrameEncoder(1,8)
+    async def main():
+        for i in range(3):
+            ingest.feed_frame(_frame(enc,i*100,_records(i*100,5)))
+    asyncio.run(main())
+    assert ingest.stats['flushes'] == 2 and ingest.buffer.n == 5 and ingest.stats['records'] == 15
+
+
+def test_feed_text():
+    ingest = Ingest(capacity = 16)
+    rest = ingest.feed_text(b'pressure:101325.5\ntemperature:25.25\nbroken\npressure:x\npress',('10.0.0.2',1),now = 2.0)
+    assert rest == b'press'
+    rest = ingest.feed_text(rest+b'ure:101326\n',('10.0.0.2',1),now = 2.5)
+    assert rest == b''
+    ingest.feed_text(b'temperature:26\n',('10.0.0.3',1),now = 3.0)
+    buf = ingest.buffer
+    assert buf.n == 4 and ingest.names == {b'pressure':0,b'temperature':1}
+    assert list(buf.node[:4]) == [0x8000,0x8000,0x8000,0x8001]
+    assert list(buf.channel[:4]) == [0,1,0,1]
+    assert np.allclose(buf.value[:4],[101325.5,25.25,101326,26])
+    assert buf.ticks[0] == 2000 and buf.ticks[2] == 2500
+    assert ingest.stats['bad'] == 2 and ingest.stats['text_lines'] == 4
+
+
+def test_udp_empty_datagram():
+    ingest = Ingest()
+    _UDPProtocol(ingest).datagram_received(b'',('10.0.0.2',1))
+    assert ingest.buffer.n == 0 and ingest.stats['bad'] == 0
+
+
+class FakeReader:
+    '''按chunks依次返回的StreamReader'''
+    def __init__(self,chunks):
+        self.chunks = list(chunks)
+
+    async def read(self,n):
+        return self.chunks.pop(0) if self.chunks else b''
+
+
+class FakeWriter:
+    def get_extra_info(self,name):
+        return ('10.0.0.9',1)
+
+    def close(self):
+        pass
+
+
+def test_chinese_text():
+    ingest = Ingest(capacity = 16)
+    line = '压力:101325.5\n'.encode()#"压"的UTF-8以0xE5开头
+    _UDPProtocol(ingest).datagram_received(line,('10.0.0.2',1))
+    assert ingest.stats['frames'] == 0 and ingest.stats['text_lines'] == 1 and ingest.stats['bad'] == 0,ingest.stats
+    chunks = ['温度'.encode()[:1],'温度:25.5\n压力:1'.encode()[1:],b'01326\n']#第一次只收到1个字节
+    asyncio.run(_handle_tcp(ingest,FakeReader(chunks),FakeWriter()))
+    enc = FrameEncoder(4,8)
+    frames = _frame(enc,0,_records(0,3))+_frame(enc,100,_records(100,2))
+    first = frames[:HEADER_SIZE+3*RECORD_SIZE]
+    assert is_frame(first) and not is_frame(first[:-1]) and not is_frame(bytes([MAGIC,9])+first[2:])
+    asyncio.run(_handle_tcp(ingest,FakeReader([frames[:1],frames[1:20],frames[20:]]),FakeWriter()))
+    assert ingest.names == {'压力'.encode():0,'温度'.encode():1}
+    buf = ingest.buffer
+    assert list(buf.channel[:3]) == [0,1,0] and np.allclose(buf.value[:3],[101325.5,25.5,101326])
+    assert ingest.stats['frames'] == 2 and buf.n == 8 and list(buf.node[3:8]) == [4]*5
+
+
+def test_writer_load():
+    directory = tempfile.mkdtemp()
+    try:
+        writer = RotatingWriter(directory,rotate_bytes = 1024)
+        ingest = Ingest(writer,capacity = 32)
+        enc = FrameEncoder(2,16)
+        delta = FrameEncoder(3,16,DeltaEncoder())
+        async def main():
+            for i in range(40):
+                ingest.feed_frame(_frame(delta if i & 1 else enc,i*100,_records(i*100,8)),now = float(i))
+            await ingest.close()
+        asyncio.run(main())
+        assert writer.rows == 320 and writer.files > 1
+        paths = sorted(os.path.join(directory,name) for name in os.listdir(directory))
+        assert len(paths) == writer.files
+        data = np.concatenate([load(path) for path in paths])
+        assert data.dtype == ROW_DTYPE and len(data) == 320
+        assert list(np.unique(data['node'])) == [2,3]
+        first = data[data['recv_time'] == 0.0]
+        assert list(first['ticks']) == [t for t,_,_ in _records(0,8)]
+        assert np.allclose(first['value'],[v for _,_,v in _records(0,8)])
+        assert len(load(paths[0])) < 320
+    finally:
+        shutil.rmtree(directory)
+
+
+def run():
+    for name,func in sorted(globals().items()):
+        if name.startswith('test_'):
+            func()
+            print(f"{name}: ok")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,82 @@
+'''用mpy-cross把_device编译成.mpy，可选复制到板子上并测量导入耗时，在电脑上运行：
+
+    pip install mpy-cross mpremote
+    python tools/build_mpy.py                    # 输出到build/_device/*.mpy
+    python tools/build_mpy.py --deploy --profile # 复制到板子的/_device/，再运行tools/import_profile.py
+
+.mpy省去了板子上的编译，导入更快，编译时的临时内存也不再需要。mpy-cross的版本要与固件一致(mpy v6.x)，
+ESP32用-march=xtensawin。要冻结进固件时，在编译固件时用FROZEN_MANIFEST指向tools/manifest.py。
+'''
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = '_device'
+SKIP = ('test.py',) # 不上传到板子的文件，需要时用--with-tests
+
+
+def sources(with_tests = False):
+    src = os.path.join(ROOT,PACKAGE)
+    for name in sorted(os.listdir(src)):
+        if name.endswith('.py') and (with_tests or name not in SKIP):
+            yield os.path.join(src,name)
+
+
+def build(out,mpy_cross = 'mpy-cross',march = 'xtensawin',opt = 0,with_tests = False):
+    '''编译全部模块，返回[(模块,源文件字节,.mpy字节),...]'''
+    target = os.path.join(out,PACKAGE)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    results = []
+    for path in sources(with_tests):
+        name = os.path.basename(path)
+        mpy = os.path.join(target,name[:-3]+'.mpy')
+        cmd = [mpy_cross,f'-march={march}',f'-O{opt}','-s',f'{PACKAGE}/{name}','-o',mpy,path]
+        subprocess.run(cmd,check = True)
+        results.append((name,os.path.getsize(path),os.path.getsize(mpy)))
+    return results
+
+
+def deploy(out,mpremote = 'mpremote'):
+    '''把build目录中的文件复制到板子的/_device/，并删除板子上同名的.py，避免先被导入'''
+    target = os.path.join(out,PACKAGE)
+    cmd = [mpremote,'fs','mkdir',f':{PACKAGE}']
+    subprocess.run(cmd,stderr = subprocess.DEVNULL)
+    for name in sorted(os.listdir(target)):
+        subprocess.run([mpremote,'fs','cp',os.path.join(target,name),f':{PACKAGE}/{name}'],check = True)
+        if name.endswith('.mpy'):
+            subprocess.run([mpremote,'fs','rm',f':{PACKAGE}/{name[:-4]}.py'],stderr = subprocess.DEVNULL)
+
+
+def profile(mpremote = 'mpremote'):
+    subprocess.run([mpremote,'run',os.path.join(ROOT,'tools','import_profile.py')],check = True)
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'cross-compile _device to .mpy')
+    parser.add_argument('--out',default = os.path.join(ROOT,'build'))
+    parser.add_argument('--mpy-cross',default = 'mpy-cross')
+    parser.add_argument('--march',default = 'xtensawin')
+    parser.add_argument('--opt',type = int,default = 0,help = 'mpy-cross -O级别，>0时去掉assert')
+    parser.add_argument('--with-tests',action = 'store_true')
+    parser.add_argument('--deploy',action = 'store_true',help = '用mpremote复制到板子')
+    parser.add_argument('--profile',action = 'store_true',help = '在板子上运行tools/import_profile.py')
+    parser.add_argument('--mpremote',default = 'mpremote')
+    args = parser.parse_args(argv)
+    results = build(args.out,args.mpy_cross,args.march,args.opt,args.with_tests)
+    print(f"{'module':<20}{'.py bytes':>10}{'.mpy bytes':>12}")
+    for name,py,mpy in results:
+        print(f"{name:<20}{py:>10}{mpy:>12}")
+    print(f"{'total':<20}{sum(r[1] for r in results):>10}{sum(r[2] for r in results):>12}")
+    if args.deploy:
+        deploy(args.out,args.mpremote)
+    if args.profile:
+        profile(args.mpremote)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
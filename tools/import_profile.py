@@ -0,0 +1,55 @@
+'''在板子上测量_device各模块的导入耗时和占用的内存，电脑上运行：
+
+    mpremote run tools/import_profile.py
+
+每次测量前把已加载的_device子模块从sys.modules中移除并gc.collect()，
+所以每一行是"只需要这个模块的脚本"付出的代价，包含它依赖的模块(例如wire会带上delta)。
+板子上是.mpy时不需要编译，耗时明显更短，见tools/build_mpy.py
+'''
+import gc
+import sys
+import time
+
+MODULES = ('_device','xgzp','xgzp_convert','ringbuf','flashlog','scheduler','VEML7700','wire','delta',
+           'ble','netConnect','socket_client','log')
+
+
+def _unload():
+    for name in list(sys.modules):
+        if name == '_device' or name.startswith('_device.'):
+            del sys.modules[name]
+    gc.collect()
+
+
+def profile(modules = MODULES):
+    '''返回[(模块,耗时us,内存字节),...]，导入失败的模块耗时为None'''
+    results = []
+    for module in modules:
+        name = module if module == '_device' else '_device.'+module
+        _unload()
+        free = gc.mem_free()
+        start = time.ticks_us()
+        try:
+            __import__(name)
+        except ImportError as e:
+            results.append((module,None,str(e)))
+            continue
+        us = time.ticks_diff(time.ticks_us(),start)
+        gc.collect()
+        results.append((module,us,free-gc.mem_free()))
+    _unload()
+    return results
+
+
+def report(results):
+    print(f"{'module':<16}{'import ms':>10}{'heap bytes':>12}")
+    for module,us,mem in results:
+        if us is None:
+            print(f"{module:<16}{'-':>10}  {mem}")
+        else:
+            print(f"{module:<16}{us/1000:>10.1f}{mem:>12}")
+    print(f"mem_free {gc.mem_free()}")
+
+
+if __name__ == '__main__':
+    report(profile())
@@ -0,0 +1,19 @@
+# 把_device冻结进ESP32固件，模块直接从flash执行，不占用堆来保存字节码：
+#     make BOARD=ESP32_GENERIC FROZEN_MANIFEST=/path/to/tools/manifest.py
+# 只冻结下面列出的模块，和build_mpy.py的SKIP一致，不包括test.py；_device中新增模块时在这里加上
+include("$(PORT_DIR)/boards/manifest.py")
+package("_device", files=(
+    "__init__.py",
+    "VEML7700.py",
+    "ble.py",
+    "delta.py",
+    "flashlog.py",
+    "log.py",
+    "netConnect.py",
+    "ringbuf.py",
+    "scheduler.py",
+    "socket_client.py",
+    "wire.py",
+    "xgzp.py",
+    "xgzp_convert.py",
+), base_path="..")